@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from app.services.openai_service import OpenAIService
+from app.services.openai_service import OpenAIService, model_router, prompt_library, response_cache, similarity_cache
+from app.services.response_cache import cache_key
 
 router = APIRouter()
 
@@ -50,54 +51,35 @@ async def generate_structure(request: StructureRequest):
     生成学术论文结构
     """
     try:
-        # 构建提示词
-        prompt = f"""
-请为以下学术论文生成详细的结构：
-
-标题：{request.title}
-论文类型：{request.paper_type}
-学科领域：{request.discipline}
-引用格式：{request.citation_style}
-研究问题：{request.research_question or '未指定'}
-关键词：{request.keywords or '未指定'}
-
-要求：
-1. 生成适合该学科和论文类型的完整结构
-2. 包含标题、摘要和详细的章节安排
-3. 每个章节要有描述和子章节
-4. 提供引用格式指南
-5. 结构要符合学术写作规范
-
-请按以下JSON格式返回：
-{{
-  "title": "论文标题",
-  "abstract": "摘要内容",
-  "sections": [
-    {{
-      "title": "章节标题",
-      "description": "章节描述",
-      "subsections": [
-        {{"title": "子章节标题", "description": "子章节描述"}}
-      ]
-    }}
-  ],
-  "citationGuide": "引用格式指南"
-}}
-"""
+        template = prompt_library.get("structure")
+        route = model_router.resolve("structure")
         
-        # 调用OpenAI服务生成结构
-        messages = [
-            {"role": "system", "content": "你是一个专业的学术写作助手，擅长生成符合学术规范的论文结构。请严格按照JSON格式返回结果。"},
-            {"role": "user", "content": prompt}
-        ]
+        # 相同的论文信息直接返回缓存的结构
+        key = None
+        if response_cache.cacheable("structure", route.temperature):
+            key = cache_key("structure", route.model, {**request.model_dump(), "prompt_version": template.version})
+            cached = await response_cache.get(key)
+            if cached is not None:
+                return StructureResponse(**cached)
+        
+        # 构建消息：要求和JSON格式在模板的系统消息中，用户消息只包含论文信息
+        messages = template.render(
+            title=request.title,
+            paper_type=request.paper_type,
+            discipline=request.discipline,
+            citation_style=request.citation_style,
+            research_question=request.research_question or '未指定',
+            keywords=request.keywords or '未指定'
+        )
         
         # 使用非流式调用获取完整响应
         response = await OpenAIService._call_openai_api(
-            model="gpt-3.5-turbo",
+            model=route.model,
             messages=messages,
-            max_tokens=2000,
-            temperature=0.7,
-            stream=False
+            max_tokens=route.max_tokens,
+            temperature=route.temperature,
+            stream=False,
+            timeout=route.timeout
         )
         
         # 解析响应
@@ -107,7 +89,11 @@ async def generate_structure(request: StructureRequest):
         import json
         try:
             structure_data = json.loads(content)
-            return StructureResponse(**structure_data)
+            structure = StructureResponse(**structure_data)
+            # 只缓存模型生成的结构，不缓存后备模板
+            if key is not None:
+                await response_cache.put(key, "structure", structure.model_dump())
+            return structure
         except (json.JSONDecodeError, ValueError):
             # 如果JSON解析失败，返回默认结构
             pass
@@ -303,47 +289,49 @@ async def generate_outline(request: OutlineRequest):
         doc_type = type_descriptions.get(request.paper_type, "学术文章")
         discipline_context = discipline_contexts.get(request.discipline, "学术")
         
-        prompt = f"""
-请为以下主题生成一个详细的{doc_type}大纲：
-
-主题：{request.topic}
-类型：{doc_type}
-领域：{discipline_context}
-
-要求：
-1. 生成5-8个主要章节，每个章节包含2-4个子章节
-2. 章节标题要具体、有逻辑性，并能充分展开主题
-3. 适合{discipline_context}领域的写作风格和结构
-4. 确保内容层次分明，逻辑连贯
-5. 包含引言、正文展开和结论部分
-
-请按以下JSON格式返回：
-{{
-  "topic": "{request.topic}",
-  "outline": [
-    {{"title": "引言", "level": 1, "description": "简要描述"}},
-    {{"title": "主题背景", "level": 2, "description": "详细说明"}},
-    {{"title": "核心论述", "level": 1, "description": "简要描述"}},
-    {{"title": "具体观点一", "level": 2, "description": "详细说明"}},
-    {{"title": "具体观点二", "level": 2, "description": "详细说明"}},
-    {{"title": "结论与展望", "level": 1, "description": "简要描述"}}
-  ]
-}}
-"""
+        template = prompt_library.get("outline")
+        # 大纲使用质量档位的模型，较低的温度以提高一致性（见模型路由表）
+        route = model_router.resolve("outline")
         
-        # 调用OpenAI服务生成大纲
-        messages = [
-            {"role": "system", "content": "你是一个专业的写作助手，擅长生成结构化的文章大纲。请严格按照JSON格式返回结果，确保内容专业、逻辑清晰。"},
-            {"role": "user", "content": prompt}
-        ]
+        # 相同的主题直接返回缓存的大纲
+        key = None
+        if response_cache.cacheable("outline", route.temperature):
+            key = cache_key(
+                "outline",
+                route.model,
+                {"doc_type": doc_type, "discipline": discipline_context, "prompt_version": template.version},
+                request.topic
+            )
+            cached = await response_cache.get(key)
+            if cached is not None:
+                return OutlineResponse(topic=request.topic, outline=[OutlineItem(**item) for item in cached])
+        
+        # 文档类型和学科相同且主题相近时复用已有大纲
+        scope = None
+        if similarity_cache.cacheable(route.temperature):
+            scope = cache_key(
+                "outline",
+                route.model,
+                {"doc_type": doc_type, "discipline": discipline_context, "prompt_version": template.version}
+            )
+            similar = similarity_cache.lookup(scope, request.topic)
+            if similar is not None:
+                return OutlineResponse(topic=request.topic, outline=[OutlineItem(**item) for item in similar[0]])
+        
+        # 构建消息：要求和JSON格式在模板的系统消息中，用户消息只包含主题信息
+        messages = template.render(
+            topic=request.topic,
+            doc_type=doc_type,
+            discipline=discipline_context
+        )
         
-        # 使用更好的模型和参数
         response = await OpenAIService._call_openai_api(
-            model="gpt-4" if hasattr(OpenAIService, '_use_gpt4') else "gpt-3.5-turbo",
+            model=route.model,
             messages=messages,
-            max_tokens=1500,
-            temperature=0.6,  # 降低温度以提高一致性
-            stream=False
+            max_tokens=route.max_tokens,
+            temperature=route.temperature,
+            stream=False,
+            timeout=route.timeout
         )
         
         # 解析响应
@@ -354,8 +342,10 @@ async def generate_outline(request: OutlineRequest):
         try:
             outline_data = json.loads(content)
             outline_items = outline_data.get("outline", [])
+            generated = True
         except json.JSONDecodeError:
             # 如果JSON解析失败，返回默认大纲
+            generated = False
             outline_items = [
                 {"title": f"{request.topic} - 引言", "level": 1},
                 {"title": "背景介绍", "level": 2},
@@ -377,6 +367,13 @@ async def generate_outline(request: OutlineRequest):
             for item in outline_items
         ]
         
+        # 只缓存模型生成的大纲，不缓存后备模板
+        if generated and outline:
+            if key is not None:
+                await response_cache.put(key, "outline", [item.model_dump() for item in outline])
+            if scope is not None:
+                similarity_cache.add(scope, request.topic, [item.model_dump() for item in outline])
+        
         return OutlineResponse(
             topic=request.topic,
             outline=outline
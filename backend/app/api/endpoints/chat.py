@@ -5,10 +5,10 @@ AI聊天端点
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 import time
 
-from app.services.openai_service import OpenAIService
+from app.services.openai_service import OpenAIService, conversation_store
 from app.core.logger import logger
 from app.core.rate_limiter import api_limiter
 
@@ -21,14 +21,86 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     context: Optional[str] = None
-    conversation_history: Optional[List[ChatMessage]] = []
-    max_tokens: Optional[int] = 500
-    temperature: Optional[float] = 0.7
+    conversation_id: Optional[str] = None  # 服务端对话ID，提供时历史由服务端保存，无需发送 conversation_history
+    conversation_history: Optional[List[ChatMessage]] = []  # 仅在创建对话时作为初始历史
+    max_tokens: Optional[int] = None  # 不提供时按模型路由表
+    temperature: Optional[float] = None
 
 class ChatResponse(BaseModel):
     response: str
     status: str = "success"
     request_id: str
+    conversation_id: Optional[str] = None
+
+def validate_history(history: Optional[List[ChatMessage]]) -> List[Dict[str, str]]:
+    """
+    整理客户端提供的对话历史
+    
+    参数:
+    - history: 对话历史
+    
+    返回:
+    - 最近10条中角色交替、以用户消息开头的消息
+    """
+    if not history:
+        return []
+    recent_history = history[-10:]
+    
+    # 确保历史对话以用户消息开始
+    filtered_history = []
+    for msg in recent_history:
+        if msg.role in ["user", "assistant"]:
+            filtered_history.append({"role": msg.role, "content": msg.content})
+    
+    # 检查并确保角色交替
+    if not filtered_history:
+        return []
+    
+    # 如果历史对话不是以user开始，跳过第一条消息
+    if filtered_history[0]["role"] != "user":
+        filtered_history = filtered_history[1:]
+    
+    # 验证剩余消息的角色交替
+    valid_history = []
+    expected_role = "user"
+    
+    for msg in filtered_history:
+        if msg["role"] == expected_role:
+            valid_history.append(msg)
+            expected_role = "assistant" if expected_role == "user" else "user"
+        else:
+            # 如果角色不匹配，重新开始
+            if msg["role"] == "user":
+                valid_history = [msg]
+                expected_role = "assistant"
+            else:
+                # 跳过这条消息
+                continue
+    
+    # 末尾未得到回复的用户消息会与当前消息相邻，丢弃
+    if valid_history and valid_history[-1]["role"] == "user":
+        valid_history.pop()
+    return valid_history
+
+async def _generate_reply(messages: List[Dict[str, str]], request: ChatRequest, user_id: str, standalone: bool = False) -> str:
+    """调用OpenAI服务生成完整回复，没有生成内容时返回空字符串"""
+    response_content = ""
+    
+    async for chunk in OpenAIService.generate_chat_completion(
+        messages=messages,
+        max_tokens=request.max_tokens,
+        temperature=request.temperature,
+        stream=False,
+        user_key=user_id,
+        standalone=standalone
+    ):
+        if chunk["type"] == "end":
+            response_content = chunk["response"]
+            break
+        elif chunk["type"] == "error":
+            raise HTTPException(status_code=500, detail=chunk["error"])
+    
+    return response_content
 
 @router.post("/completion", response_model=ChatResponse)
 async def chat_completion(request: ChatRequest) -> ChatResponse:
@@ -38,7 +110,8 @@ async def chat_completion(request: ChatRequest) -> ChatResponse:
     参数:
     - message: 用户消息
     - context: 当前文档上下文
-    - conversation_history: 对话历史
+    - conversation_id: 对话ID（服务端保存历史）
+    - conversation_history: 对话历史（仅在创建对话时使用）
     - max_tokens: 最大生成token数
     - temperature: 生成温度
     
@@ -65,98 +138,51 @@ async def chat_completion(request: ChatRequest) -> ChatResponse:
         "request_id": request_id,
         "user_message_length": len(request.message),
         "has_context": bool(request.context),
+        "conversation_id": request.conversation_id,
         "history_length": len(request.conversation_history) if request.conversation_history else 0
     })
     
     try:
-        # 构建系统提示词，包含上下文信息（如果有）
-        system_prompt = """你是墨井智能写作助手的AI聊天助手。你的职责是：
-
-1. **写作指导**: 提供专业的写作建议、技巧和改进方案
-2. **内容创作**: 帮助用户续写、完善、修改文本内容
-3. **结构优化**: 协助改善文章结构、逻辑和表达
-4. **风格调整**: 根据需求调整写作风格和语调
-5. **问题解答**: 回答关于写作、语言和表达的问题
-
-回复要求：
-- 保持专业、友好、有帮助的语调
-- 提供具体、可操作的建议
-- 回复简洁明了，重点突出
-- 根据上下文提供相关的写作帮助
-- 如果用户提供了文档内容，结合内容给出针对性建议"""
-
-        # 如果有上下文信息，添加到系统提示词中
-        if request.context and request.context.strip():
-            system_prompt += f"\n\n用户当前文档内容片段：\n\n{request.context}\n\n请基于这个上下文回答用户的问题。"
-
-        # 构建消息列表，确保角色交替
-        messages = [{"role": "system", "content": system_prompt}]
+        # 获取服务端保存的对话；未提供或已不存在时创建新对话，以客户端提供的历史作为初始历史
+        conversation = await conversation_store.get_or_create(
+            request.conversation_id,
+            validate_history(request.conversation_history)
+        )
         
-        # 添加对话历史（限制最近10条，确保角色交替）
-        if request.conversation_history:
-            recent_history = request.conversation_history[-10:]
+        # 同一对话的请求依次处理，保证消息按轮次写入
+        async with conversation.lock:
+            # 按上下文预算组装消息：系统消息、滚动摘要、最近的历史消息、当前消息（附带文档上下文）
+            messages, prompt_info = OpenAIService.build_chat_messages(
+                request.message,
+                context=request.context,
+                history=conversation.messages(),
+                summary=conversation.summary,
+                max_tokens=request.max_tokens
+            )
             
-            # 确保历史对话以用户消息开始
-            filtered_history = []
-            for msg in recent_history:
-                if msg.role in ["user", "assistant"]:
-                    filtered_history.append({"role": msg.role, "content": msg.content})
+            # 调试日志：记录最终的消息结构
+            logger.info({
+                "message": "构建的消息结构",
+                "request_id": request_id,
+                "conversation_id": conversation.id,
+                "message_count": len(messages),
+                "roles": [msg["role"] for msg in messages],
+                "role_sequence": " -> ".join([msg["role"] for msg in messages]),
+                **prompt_info
+            })
             
-            # 检查并确保角色交替
-            if filtered_history:
-                # 如果历史对话不是以user开始，跳过第一条消息
-                if filtered_history[0]["role"] != "user":
-                    filtered_history = filtered_history[1:]
-                
-                # 验证剩余消息的角色交替
-                valid_history = []
-                expected_role = "user"
-                
-                for msg in filtered_history:
-                    if msg["role"] == expected_role:
-                        valid_history.append(msg)
-                        expected_role = "assistant" if expected_role == "user" else "user"
-                    else:
-                        # 如果角色不匹配，重新开始
-                        if msg["role"] == "user":
-                            valid_history = [msg]
-                            expected_role = "assistant"
-                        else:
-                            # 跳过这条消息
-                            continue
-                
-                messages.extend(valid_history)
-        
-        # 添加当前用户消息
-        messages.append({"role": "user", "content": request.message})
-        
-        # 调试日志：记录最终的消息结构
-        logger.info({
-            "message": "构建的消息结构",
-            "request_id": request_id,
-            "message_count": len(messages),
-            "roles": [msg["role"] for msg in messages],
-            "role_sequence": " -> ".join([msg["role"] for msg in messages])
-        })
-        
-        # 调用OpenAI API进行聊天对话
-        response_content = ""
-        
-        # 使用OpenAI服务生成回复
-        async for chunk in OpenAIService.generate_chat_completion(
-            messages=messages,
-            max_tokens=request.max_tokens,
-            temperature=request.temperature,
-            stream=False
-        ):
-            if chunk["type"] == "end":
-                response_content = chunk["response"]
-                break
-            elif chunk["type"] == "error":
-                raise HTTPException(status_code=500, detail=chunk["error"])
-        
-        if not response_content:
-            response_content = "抱歉，我现在无法生成回复。请稍后重试。"
+            # 没有文档上下文和历史的独立提问可以复用相同提问的回复
+            standalone = not request.context and not conversation.turns and not conversation.summary
+            response_content = await _generate_reply(messages, request, user_id, standalone)
+            
+            # 保存本轮对话，超出预算时在后台压缩较早的消息；没有生成回复时本轮不写入对话
+            if response_content:
+                await conversation_store.append(conversation, [
+                    {"role": "user", "content": request.message},
+                    {"role": "assistant", "content": response_content}
+                ])
+            else:
+                response_content = "抱歉，我现在无法生成回复。请稍后重试。"
         
         # 记录成功日志
         duration = time.time() - start_time
@@ -171,7 +197,8 @@ async def chat_completion(request: ChatRequest) -> ChatResponse:
         return ChatResponse(
             response=response_content,
             status="success",
-            request_id=request_id
+            request_id=request_id,
+            conversation_id=conversation.id
         )
         
     except Exception as e:
@@ -196,17 +223,32 @@ async def chat_completion(request: ChatRequest) -> ChatResponse:
             raise HTTPException(status_code=500, detail="AI服务暂时不可用，请稍后再试")
 
 @router.get("/history")
-async def get_chat_history():
+async def get_chat_history(conversation_id: str):
     """
-    获取用户聊天历史（预留接口）
+    获取对话的聊天记录
+    
+    参数:
+    - conversation_id: 对话ID
+    
+    返回:
+    - 全部消息和较早对话的滚动摘要
     """
-    # TODO: 实现聊天历史存储和检索
-    return {"message": "聊天历史功能开发中", "history": []}
+    conversation = await conversation_store.get(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="对话不存在")
+    return {
+        "conversation_id": conversation.id,
+        "summary": conversation.summary,
+        "history": await conversation_store.history(conversation_id)
+    }
 
 @router.delete("/history")
-async def clear_chat_history():
+async def clear_chat_history(conversation_id: str):
     """
-    清除用户聊天历史（预留接口）
+    删除对话的聊天记录
+    
+    参数:
+    - conversation_id: 对话ID
     """
-    # TODO: 实现聊天历史清除
+    await conversation_store.delete(conversation_id)
     return {"message": "聊天历史已清除", "status": "success"}
\ No newline at end of file
@@ -1,19 +1,93 @@
 import asyncio
 import json
 import time
-from typing import Optional, Dict, Any
+import uuid
+from contextlib import aclosing
+from typing import Optional, Dict, Any, Tuple
 
 from fastapi import APIRouter, WebSocket, HTTPException, Request, Depends, status, WebSocketDisconnect
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 from app.api.endpoints.websocket import manager
-from app.models.completion import CompletionRequest, CompletionResponse
-from app.services.openai_service import OpenAIService
+from app.api.endpoints.chat import ChatMessage, validate_history
+from app.models.completion import (
+    CompletionRequest,
+    CompletionResponse,
+    StreamToken,
+    BatchOptimizeRequest,
+    BatchOptimizeResult
+)
+from app.services.openai_service import OpenAIService, context_window_manager, context_classifier, upstream_governor, upstream_pool, conversation_store
+from app.services.document_session import document_sessions, DocumentSyncError
+from app.services.completion_cache import typeahead_cache, completion_prefix_tail, CompletionEntry
 from app.core.rate_limiter import ws_limiter, api_limiter
+from app.core.config import settings
 from app.core.logger import logger
 
 router = APIRouter()
 
+async def stream_reused_completion(
+    websocket: WebSocket,
+    connection_id: str,
+    entry: CompletionEntry,
+    typed: int,
+    request_id: str
+):
+    """
+    沿用户已输入的部分推进已有建议，下发剩余内容，不请求上游
+    
+    参数:
+    - websocket: WebSocket连接
+    - connection_id: 连接ID
+    - entry: 被复用的建议（可能仍在生成中）
+    - typed: 用户已输入的建议字符数
+    - request_id: 当前请求ID
+    """
+    # 接管建议的下发，原生成任务继续生成但不再发送
+    entry.owner_id = request_id
+    
+    logger.info({
+        "message": "复用已有补全建议",
+        "connection_id": connection_id,
+        "request_id": request_id,
+        "producer_id": entry.producer_id,
+        "typed_chars": typed,
+        "in_flight": not entry.done
+    })
+    
+    if not await manager.send_json(websocket, {"type": "start", "status": "processing", "request_id": request_id}):
+        return
+    
+    if entry.done:
+        remainder = entry.text[typed:]
+        await manager.send_json(websocket, {"type": "token", "token": remainder, "status": "processing", "request_id": request_id})
+    else:
+        typed_text = entry.raw_text[:typed].lstrip()
+        async for piece in entry.follow(typed):
+            if entry.owner_id != request_id:
+                return
+            if not await manager.send_json(websocket, {"type": "token", "token": piece, "status": "processing", "request_id": request_id}):
+                return
+        
+        if entry.failed:
+            await manager.send_json(websocket, {
+                "type": "error",
+                "error": entry.error or "生成文本时出错",
+                "action": "completion",
+                "status": "error",
+                "request_id": request_id
+            })
+            return
+        
+        # 后处理会去掉开头空白，按处理后的文本计算剩余部分
+        final_text = entry.text
+        if final_text.startswith(typed_text):
+            remainder = final_text[len(typed_text):]
+        else:
+            remainder = entry.raw_text[typed:]
+    
+    await manager.send_json(websocket, {"type": "end", "completion": remainder, "status": "success", "request_id": request_id})
+
 async def process_streaming_completion(
     websocket: WebSocket, 
     connection_id: str,
@@ -22,7 +96,10 @@ async def process_streaming_completion(
     context_before: Optional[str] = None, 
     context_after: Optional[str] = None, 
     cursor_position: Optional[int] = None, 
-    temperature: float = 0.7
+    temperature: Optional[float] = None,
+    target_language: Optional[str] = None,
+    request_id: Optional[str] = None,
+    reuse: Optional[Tuple[CompletionEntry, int]] = None
 ):
     """
     处理流式文本生成，使用OpenAI API
@@ -32,6 +109,9 @@ async def process_streaming_completion(
     - connection_id: 连接ID
     - action: 操作类型，可选值为 "completion"(补全), "rewrite"(改写), "expand"(扩写), "simplify"(简化)
     - cursor_position: 光标位置，用于上下文窗口管理
+    - target_language: 目标语言代码，仅用于翻译操作
+    - request_id: 请求ID，会写入每条下发的消息，客户端可据此取消请求
+    - reuse: 可复用的已有建议及用户已输入的字符数
     """
     # 检查连接是否仍然有效
     if websocket.client_state.name != "CONNECTED":
@@ -41,6 +121,11 @@ async def process_streaming_completion(
             "action": action
         })
         return
+    
+    # 复用已有建议不请求上游，不消耗速率限制令牌
+    if reuse is not None:
+        await stream_reused_completion(websocket, connection_id, reuse[0], reuse[1], request_id)
+        return
         
     # 检查速率限制
     # 不同操作类型消耗不同的令牌数
@@ -53,50 +138,47 @@ async def process_streaming_completion(
             "error": f"请求过于频繁，请等待{retry_after}秒后再试",
             "action": action,
             "status": "rate_limited",
-            "retry_after": retry_after
+            "retry_after": retry_after,
+            "request_id": request_id
         })
         if not success:
             logger.info({"message": "发送速率限制消息失败，连接可能已关闭", "connection_id": connection_id})
         return
     
+    entry = None
     try:
         # 根据操作类型选择不同的处理方法
         if action in ["rewrite", "expand", "simplify", "translate"]:
-            # 获取目标语言参数（如果有的话）
-            target_language = request_data.get("target_language")
-            
             # 使用文本优化服务
-            async for chunk in OpenAIService.optimize_text(
+            generator = OpenAIService.optimize_text(
                 text=text,
                 action=action,
                 temperature=temperature,
                 stream=True,
-                target_language=target_language
-            ):
-                # 检查连接状态
-                if websocket.client_state.name != "CONNECTED":
-                    logger.info({
-                        "message": "WebSocket连接已关闭，停止发送数据",
-                        "connection_id": connection_id,
-                        "action": action
-                    })
-                    break
-                    
-                # 将API响应转发给WebSocket客户端
-                success = await manager.send_json(websocket, chunk)
-                if not success:
-                    break
+                target_language=target_language,
+                user_key=connection_id
+            )
         else:
             # 使用文本补全服务
-            async for chunk in OpenAIService.generate_completion(
+            generator = OpenAIService.generate_completion(
                 text=text,
                 context_before=context_before,
                 context_after=context_after,
                 cursor_position=cursor_position,
-                max_tokens=50,
                 temperature=temperature,
-                stream=True
-            ):
+                stream=True,
+                session_key=connection_id
+            )
+            # 登记建议，供后续输入的请求跟随
+            entry = typeahead_cache.start(
+                connection_id,
+                completion_prefix_tail(text, context_before, cursor_position),
+                request_id or ""
+            )
+        
+        # 使用aclosing确保提前退出时生成器被关闭，从而关闭上游流
+        async with aclosing(generator) as chunks:
+            async for chunk in chunks:
                 # 检查连接状态
                 if websocket.client_state.name != "CONNECTED":
                     logger.info({
@@ -105,11 +187,34 @@ async def process_streaming_completion(
                         "action": action
                     })
                     break
+                
+                if entry is not None:
+                    if chunk["type"] == "token":
+                        entry.append(chunk["token"])
+                    elif chunk["type"] == "end":
+                        entry.finish(chunk["completion"])
+                    elif chunk["type"] == "error":
+                        entry.fail(chunk.get("error"))
+                    # 建议已被后续请求接管：继续生成以便其跟随，但不再下发
+                    if entry.owner_id != (request_id or ""):
+                        continue
+                
+                if request_id:
+                    chunk["request_id"] = request_id
                     
                 # 将API响应转发给WebSocket客户端
                 success = await manager.send_json(websocket, chunk)
                 if not success:
                     break
+    except asyncio.CancelledError:
+        # 被新请求取代、客户端取消或连接关闭
+        logger.info({
+            "message": "流式文本生成已取消",
+            "connection_id": connection_id,
+            "request_id": request_id,
+            "action": action
+        })
+        raise
     except Exception as e:
         # 记录错误
         logger.error({
@@ -125,8 +230,200 @@ async def process_streaming_completion(
                 "type": "error",
                 "error": str(e),
                 "action": action,
-                "status": "error"
+                "status": "error",
+                "request_id": request_id
+            })
+    finally:
+        if entry is not None and not entry.done:
+            typeahead_cache.discard(connection_id, entry)
+
+async def process_streaming_chat(
+    websocket: WebSocket,
+    connection_id: str,
+    request_data: Dict[str, Any],
+    context: Optional[str],
+    request_id: str
+):
+    """
+    处理流式AI聊天回复
+    
+    参数:
+    - websocket: WebSocket连接
+    - connection_id: 连接ID
+    - request_data: 聊天请求（message、conversation_id、conversation_history、max_tokens、temperature）
+    - context: 当前文档上下文
+    - request_id: 请求ID，会写入每条下发的消息，客户端可据此取消请求
+    """
+    # 与HTTP聊天接口相同，每次聊天消耗2个令牌
+    cost = 2.0
+    if not ws_limiter.check_rate_limit(connection_id, cost):
+        retry_after = ws_limiter.get_retry_after(connection_id, cost)
+        await manager.send_json(websocket, {
+            "type": "error",
+            "error": f"请求过于频繁，请等待{retry_after}秒后再试",
+            "action": "chat",
+            "status": "rate_limited",
+            "retry_after": retry_after,
+            "request_id": request_id
+        })
+        return
+    
+    message = request_data.get("message") or ""
+    if not message.strip():
+        await manager.send_json(websocket, {
+            "type": "error",
+            "error": "消息不能为空",
+            "action": "chat",
+            "status": "error",
+            "request_id": request_id
+        })
+        return
+    
+    try:
+        history = [ChatMessage(**msg) for msg in request_data.get("conversation_history") or []]
+        conversation = await conversation_store.get_or_create(request_data.get("conversation_id"), validate_history(history))
+        
+        # 同一对话的请求依次处理；取消时释放锁，本轮不写入对话
+        async with conversation.lock:
+            messages, prompt_info = OpenAIService.build_chat_messages(
+                message,
+                context=context,
+                history=conversation.messages(),
+                summary=conversation.summary,
+                max_tokens=request_data.get("max_tokens")
+            )
+            logger.info({
+                "message": "开始流式AI聊天回复",
+                "connection_id": connection_id,
+                "request_id": request_id,
+                "conversation_id": conversation.id,
+                "message_count": len(messages),
+                **prompt_info
+            })
+            
+            response_text = None
+            generator = OpenAIService.generate_chat_completion(
+                messages=messages,
+                max_tokens=request_data.get("max_tokens"),
+                temperature=request_data.get("temperature"),
+                stream=True,
+                user_key=connection_id,
+                standalone=not context and not conversation.turns and not conversation.summary
+            )
+            async with aclosing(generator) as chunks:
+                async for chunk in chunks:
+                    if websocket.client_state.name != "CONNECTED":
+                        break
+                    chunk["action"] = "chat"
+                    chunk["request_id"] = request_id
+                    if chunk["type"] in ("start", "end"):
+                        chunk["conversation_id"] = conversation.id
+                    if chunk["type"] == "end":
+                        response_text = chunk["response"]
+                    if not await manager.send_json(websocket, chunk):
+                        break
+            
+            # 只保存完整生成的回复
+            if response_text:
+                await conversation_store.append(conversation, [
+                    {"role": "user", "content": message},
+                    {"role": "assistant", "content": response_text}
+                ])
+    except asyncio.CancelledError:
+        logger.info({
+            "message": "流式AI聊天回复已取消",
+            "connection_id": connection_id,
+            "request_id": request_id
+        })
+        raise
+    except Exception as e:
+        logger.error({
+            "message": "处理流式AI聊天回复时出错",
+            "connection_id": connection_id,
+            "request_id": request_id,
+            "error": str(e)
+        })
+        if websocket.client_state.name == "CONNECTED":
+            await manager.send_json(websocket, {
+                "type": "error",
+                "error": str(e),
+                "action": "chat",
+                "status": "error",
+                "request_id": request_id
+            })
+
+async def handle_document_message(websocket: WebSocket, connection_id: str, request_data: Dict[str, Any]):
+    """
+    处理文档同步消息
+    
+    支持的消息:
+    - {"type": "doc_open", "document_id": ..., "text": 全文, "version": 版本号}
+    - {"type": "doc_delta", "document_id": ..., "base_version": 基础版本号, "version": 新版本号,
+       "ops": [{"op": "insert", "pos": 10, "text": "..."}, {"op": "delete", "pos": 10, "length": 3}]}
+    
+    ops 中的 pos 和 length 按UTF-16码元计算（与JavaScript字符串的下标和 length 一致），
+    emoji等BMP以外的字符计为2；位置落在代理对中间时要求客户端重新同步
+    """
+    message_type = request_data.get("type")
+    document_id = str(request_data.get("document_id", "default"))
+    
+    try:
+        if message_type == "doc_open":
+            session = document_sessions.open(
+                connection_id,
+                document_id,
+                request_data.get("text", ""),
+                int(request_data.get("version", 0))
+            )
+            await manager.send_json(websocket, {
+                "type": "doc_ack",
+                "document_id": document_id,
+                "version": session.version,
+                "status": "synced"
             })
+        else:
+            # 增量编辑成功时不回复，减少消息数量
+            document_sessions.apply_delta(
+                connection_id,
+                document_id,
+                request_data.get("ops", []),
+                int(request_data.get("base_version", -1)),
+                request_data.get("version")
+            )
+    except (DocumentSyncError, TypeError, ValueError) as e:
+        logger.warning({
+            "message": "文档同步失败，需要客户端重新同步",
+            "connection_id": connection_id,
+            "document_id": document_id,
+            "error": str(e)
+        })
+        await manager.send_json(websocket, {
+            "type": "error",
+            "error": str(e),
+            "document_id": document_id,
+            "status": "resync_required"
+        })
+
+def resolve_document_text(connection_id: str, request_data: Dict[str, Any]) -> str:
+    """
+    获取请求对应的文本：携带document_id时从文档会话读取，否则使用消息中的全文
+    
+    返回:
+    - 文本内容
+    """
+    document_id = request_data.get("document_id")
+    if document_id is None:
+        return request_data.get("text", "")
+    
+    session = document_sessions.get(connection_id, str(document_id))
+    version = request_data.get("version")
+    if version is not None and version != session.version:
+        raise DocumentSyncError(
+            f"文档版本不一致: 服务端为{session.version}，请求基于{version}",
+            str(document_id),
+            session.version
+        )
+    return session.text()
 
 @router.websocket("/ws")
 async def websocket_completion(websocket: WebSocket):
@@ -168,13 +465,43 @@ async def websocket_completion(websocket: WebSocket):
                 # 更新连接活动时间
                 manager.update_activity(websocket)
                 
+                # 文档同步消息
+                if request_data.get("type") in ("doc_open", "doc_delta"):
+                    await handle_document_message(websocket, connection_id, request_data)
+                    continue
+                
+                # 取消请求：指定request_id时取消对应任务，否则取消该连接的全部任务
+                if request_data.get("type") == "cancel":
+                    cancel_id = request_data.get("request_id")
+                    if cancel_id:
+                        cancelled = manager.cancel_task(connection_id, str(cancel_id))
+                    else:
+                        cancelled = manager.cancel_tasks(connection_id) > 0
+                    await manager.send_json(websocket, {
+                        "type": "system",
+                        "message": "请求已取消" if cancelled else "没有可取消的请求",
+                        "status": "cancelled" if cancelled else "not_found",
+                        "request_id": cancel_id
+                    })
+                    continue
+                
                 # 提取请求数据
-                text = request_data.get("text", "")
+                try:
+                    text = resolve_document_text(connection_id, request_data)
+                except DocumentSyncError as e:
+                    await manager.send_json(websocket, {
+                        "type": "error",
+                        "error": str(e),
+                        "document_id": e.document_id,
+                        "status": "resync_required"
+                    })
+                    continue
                 action = request_data.get("action", "completion")
                 context_before = request_data.get("context_before")
                 context_after = request_data.get("context_after")
                 cursor_position = request_data.get("cursor_position")
-                temperature = request_data.get("temperature", 0.7)
+                temperature = request_data.get("temperature")
+                target_language = request_data.get("target_language")
                 
                 # 记录请求
                 logger.info({
@@ -184,8 +511,35 @@ async def websocket_completion(websocket: WebSocket):
                     "text_length": len(text) if text else 0
                 })
                 
-                # 启动流式生成任务
-                asyncio.create_task(
+                # AI聊天：流式下发回复，可通过cancel消息取消
+                if action == "chat":
+                    request_id = str(request_data.get("request_id") or f"ws_{uuid.uuid4().hex[:12]}")
+                    task = asyncio.create_task(
+                        process_streaming_chat(
+                            websocket,
+                            connection_id,
+                            request_data,
+                            request_data.get("context") or text,
+                            request_id
+                        )
+                    )
+                    manager.register_task(connection_id, request_id, task, kind=action)
+                    continue
+                
+                # 新的补全请求取代仍在生成的旧补全；
+                # 如果用户只是沿着已有建议继续输入，则复用该建议，并保留其仍在生成的上游任务
+                request_id = str(request_data.get("request_id") or f"ws_{uuid.uuid4().hex[:12]}")
+                reuse = None
+                if action == "completion":
+                    reuse = typeahead_cache.lookup(
+                        connection_id,
+                        completion_prefix_tail(text, context_before, cursor_position)
+                    )
+                    keep_id = reuse[0].producer_id if reuse and not reuse[0].done else None
+                    manager.cancel_tasks(connection_id, kind="completion", exclude=keep_id)
+                
+                # 启动流式生成任务并登记，以便取消
+                task = asyncio.create_task(
                     process_streaming_completion(
                         websocket,
                         connection_id,
@@ -194,9 +548,13 @@ async def websocket_completion(websocket: WebSocket):
                         context_before, 
                         context_after,
                         cursor_position,
-                        temperature
+                        temperature,
+                        target_language,
+                        request_id,
+                        reuse
                     )
                 )
+                manager.register_task(connection_id, request_id, task, kind=action)
                 
             except json.JSONDecodeError as e:
                 # JSON解析错误
@@ -282,24 +640,35 @@ async def websocket_completion(websocket: WebSocket):
         # 确保连接被正确清理
         if websocket:
             manager.disconnect(websocket)
+        if connection_id:
+            document_sessions.close_connection(connection_id)
+            context_window_manager.release_session(connection_id)
+            context_classifier.release_session(connection_id)
+            typeahead_cache.release_session(connection_id)
+            ws_limiter.release(connection_id)
 
 # 速率限制依赖项
-async def check_api_rate_limit(request: Request):
-    """
-    检查API请求的速率限制
+def api_rate_limit_response(client_ip: str, endpoint: str, cost: float = 1.0) -> Optional[JSONResponse]:
     """
-    # 获取客户端IP作为标识符
-    client_ip = request.client.host if request.client else "unknown"
+    按客户端IP扣除API速率限制令牌
     
-    # 检查速率限制
-    if not api_limiter.check_rate_limit(client_ip):
-        retry_after = api_limiter.get_retry_after(client_ip)
+    参数:
+    - client_ip: 客户端IP
+    - endpoint: 请求路径，用于日志
+    - cost: 本次请求消耗的令牌数
+    
+    返回:
+    - 超出限制时返回429响应（带Retry-After），否则返回None
+    """
+    if not api_limiter.check_rate_limit(client_ip, cost):
+        retry_after = api_limiter.get_retry_after(client_ip, cost)
         
         # 记录速率限制事件
         logger.warning({
             "message": "API请求被速率限制",
             "client_ip": client_ip,
-            "endpoint": request.url.path,
+            "endpoint": endpoint,
+            "cost": cost,
             "retry_after": retry_after
         })
         
@@ -314,24 +683,106 @@ async def check_api_rate_limit(request: Request):
         )
     return None
 
+async def check_api_rate_limit(request: Request):
+    """
+    检查API请求的速率限制
+    """
+    # 获取客户端IP作为标识符
+    client_ip = request.client.host if request.client else "unknown"
+    return api_rate_limit_response(client_ip, request.url.path)
+
+def stream_format(http_request: Request) -> str:
+    """
+    根据Accept头选择HTTP流式响应的格式
+    
+    返回:
+    - ndjson（Accept包含application/x-ndjson时）或 sse
+    """
+    accept = http_request.headers.get("accept", "")
+    return "ndjson" if "application/x-ndjson" in accept else "sse"
+
+async def encode_stream_tokens(generator, fmt: str, request_id: str, action: str):
+    """
+    把服务层的流式结果编码为StreamToken帧
+    
+    参数:
+    - generator: OpenAIService 的流式生成器
+    - fmt: sse 或 ndjson
+    - request_id: 请求ID
+    - action: 操作类型
+    """
+    # 客户端断开时生成器被关闭，aclosing确保上游流随之关闭
+    async with aclosing(generator) as chunks:
+        async for chunk in chunks:
+            chunk["request_id"] = request_id
+            chunk.setdefault("action", action)
+            data = StreamToken(**chunk).model_dump_json(exclude_none=True)
+            if fmt == "ndjson":
+                yield data + "\n"
+            else:
+                yield f"event: {chunk['type']}\ndata: {data}\n\n"
+
+def streaming_response(http_request: Request, generator, request_id: str, action: str) -> StreamingResponse:
+    """
+    以SSE或NDJSON返回流式结果
+    
+    参数:
+    - http_request: HTTP请求，用于协商格式
+    - generator: OpenAIService 的流式生成器
+    - request_id: 请求ID
+    - action: 操作类型
+    """
+    fmt = stream_format(http_request)
+    return StreamingResponse(
+        encode_stream_tokens(generator, fmt, request_id, action),
+        media_type="application/x-ndjson" if fmt == "ndjson" else "text/event-stream",
+        # 禁止代理缓冲，使首个token尽快到达客户端
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/generate", response_model=CompletionResponse)
-async def generate_completion(request: CompletionRequest, rate_limit_check=Depends(check_api_rate_limit)):
+async def generate_completion(
+    request: CompletionRequest,
+    http_request: Request,
+    rate_limit_check=Depends(check_api_rate_limit)
+):
     """
     生成文本补全（非WebSocket方式）
+    
+    stream=true 时以SSE（默认）或NDJSON（Accept: application/x-ndjson）逐帧返回StreamToken
     """
     # 如果速率限制检查返回了响应，直接返回该响应
     if rate_limit_check:
         return rate_limit_check
     
     request_id = f"req_{int(time.time() * 1000)}"
+    # 按客户端IP公平排队，单个客户端的大量请求不会挤占其他客户端
+    client_ip = http_request.client.host if http_request.client else "unknown"
     
     # 记录请求
     logger.info({
         "message": "收到文本补全请求",
         "request_id": request_id,
+        "stream": request.stream,
         "text_length": len(request.text) if request.text else 0
     })
     
+    if request.stream:
+        return streaming_response(
+            http_request,
+            OpenAIService.generate_completion(
+                text=request.text,
+                context_before=request.context_before,
+                context_after=request.context_after,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                stream=True,
+                user_key=client_ip
+            ),
+            request_id,
+            "completion"
+        )
+    
     try:
         # 使用OpenAI API生成文本补全
         completion_generator = OpenAIService.generate_completion(
@@ -340,7 +791,8 @@ async def generate_completion(request: CompletionRequest, rate_limit_check=Depen
             context_after=request.context_after,
             max_tokens=request.max_tokens,
             temperature=request.temperature,
-            stream=False
+            stream=False,
+            user_key=client_ip
         )
         
         # 获取生成结果
@@ -384,9 +836,15 @@ async def generate_completion(request: CompletionRequest, rate_limit_check=Depen
 
 
 @router.post("/optimize")
-async def optimize_text(request: CompletionRequest, rate_limit_check=Depends(check_api_rate_limit)):
+async def optimize_text(
+    request: CompletionRequest,
+    http_request: Request,
+    rate_limit_check=Depends(check_api_rate_limit)
+):
     """
     优化文本（改写/扩写/简化/翻译）
+    
+    stream=true 时以SSE（默认）或NDJSON（Accept: application/x-ndjson）逐帧返回StreamToken
     """
     # 如果速率限制检查返回了响应，直接返回该响应
     if rate_limit_check:
@@ -396,15 +854,33 @@ async def optimize_text(request: CompletionRequest, rate_limit_check=Depends(che
     action = getattr(request, 'action', 'rewrite')
     target_language = getattr(request, 'target_language', None)
     request_id = f"req_{int(time.time() * 1000)}"
+    # 按客户端IP公平排队，长文本的优化不会挤占其他客户端
+    client_ip = http_request.client.host if http_request.client else "unknown"
    
     # 记录请求
     logger.info({
         "message": "收到文本优化请求",
         "request_id": request_id,
         "action": action,
+        "stream": request.stream,
         "text_length": len(request.text) if request.text else 0
     })
     
+    if request.stream:
+        return streaming_response(
+            http_request,
+            OpenAIService.optimize_text(
+                text=request.text,
+                action=action,
+                temperature=request.temperature,
+                stream=True,
+                target_language=target_language,
+                user_key=client_ip
+            ),
+            request_id,
+            action
+        )
+    
     try:
         # 使用OpenAI API优化文本
         optimization_generator = OpenAIService.optimize_text(
@@ -412,7 +888,8 @@ async def optimize_text(request: CompletionRequest, rate_limit_check=Depends(che
             action=action,
             temperature=request.temperature,
             stream=False,
-            target_language=target_language
+            target_language=target_language,
+            user_key=client_ip
         )
         
         # 获取优化结果
@@ -464,3 +941,85 @@ async def optimize_text(request: CompletionRequest, rate_limit_check=Depends(che
         })
         
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/optimize/batch")
+async def optimize_batch(
+    request: BatchOptimizeRequest,
+    http_request: Request
+):
+    """
+    批量优化文本（改写/扩写/简化/翻译）
+    
+    每个条目消耗一个速率限制令牌，批次超出令牌桶容量时直接拒绝，令牌不足时返回429；
+    条目以有界并发处理，结果按完成顺序以NDJSON逐行返回，
+    每行带条目ID和序号；单条失败只体现在该条结果中，最后一行为汇总
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="条目列表不能为空")
+    max_items = min(settings.BATCH_OPTIMIZE_MAX_ITEMS, api_limiter.burst)
+    if len(request.items) > max_items:
+        raise HTTPException(
+            status_code=413,
+            detail=f"单个批次最多{max_items}个条目"
+        )
+    
+    client_ip = http_request.client.host if http_request.client else "unknown"
+    rate_limit_check = api_rate_limit_response(client_ip, http_request.url.path, cost=len(request.items))
+    if rate_limit_check:
+        return rate_limit_check
+    
+    request_id = f"batch_{int(time.time() * 1000)}"
+    concurrency = min(request.concurrency or settings.BATCH_OPTIMIZE_CONCURRENCY, settings.BATCH_OPTIMIZE_CONCURRENCY)
+    
+    logger.info({
+        "message": "收到批量文本优化请求",
+        "request_id": request_id,
+        "items": len(request.items),
+        "concurrency": concurrency
+    })
+    
+    async def encode_results():
+        start_time = time.time()
+        succeeded = failed = 0
+        generator = OpenAIService.optimize_batch(
+            [item.model_dump() for item in request.items],
+            concurrency=max(1, concurrency),
+            temperature=request.temperature,
+            user_key=client_ip
+        )
+        async with aclosing(generator) as results:
+            async for result in results:
+                if result["status"] == "success":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield BatchOptimizeResult(**result, request_id=request_id).model_dump_json(exclude_none=True) + "\n"
+        
+        logger.info({
+            "message": "批量文本优化完成",
+            "request_id": request_id,
+            "succeeded": succeeded,
+            "failed": failed,
+            "duration_seconds": time.time() - start_time
+        })
+        yield BatchOptimizeResult(
+            type="summary",
+            status="done",
+            total=len(request.items),
+            succeeded=succeeded,
+            failed=failed,
+            request_id=request_id
+        ).model_dump_json(exclude_none=True) + "\n"
+    
+    return StreamingResponse(
+        encode_results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/upstream")
+async def get_upstream_status():
+    """
+    获取上游并发控制器（并发上限、在途请求数、排队数、TPM余量）和端点池的当前状态
+    """
+    return {**upstream_governor.snapshot(), "pool": upstream_pool.snapshot()}
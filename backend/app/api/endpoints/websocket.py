@@ -1,29 +1,217 @@
 from fastapi import WebSocket, WebSocketDisconnect
 import json
 import asyncio
+import heapq
 import time
 import uuid
-from typing import List, Dict, Any, Optional
+from collections import deque
+from typing import Deque, List, Dict, Any, Optional, Set, Tuple
+from app.core.config import settings
 from app.core.logger import logger
 
+class OutboundQueue:
+    """
+    单个连接的发送队列
+    同一请求连续的token消息合并为一条，队列按字符数限制内存占用；
+    丢弃过token的请求改为发送一条携带已生成全文的resync消息，客户端用它替换已显示的文本
+    """
+    
+    __slots__ = ("frames", "pending_chars", "ready", "flush_now", "dropped", "streams", "desynced")
+    
+    # 请求结束的消息类型，写出后不再需要该请求已生成的文本
+    FINAL_TYPES = ("end", "error")
+    
+    def __init__(self):
+        self.frames: Deque[Dict[str, Any]] = deque()
+        self.pending_chars = 0
+        self.ready = asyncio.Event()      # 队列中有待发送的消息
+        self.flush_now = asyncio.Event()  # 需要立即发送（有控制消息或达到批次大小）
+        self.dropped = 0
+        # 各请求已进入队列的token文本: {(request_id, action): 片段列表}
+        self.streams: Dict[Tuple[Any, Any], List[str]] = {}
+        # 丢弃过token、等待写出resync消息的请求
+        self.desynced: Set[Tuple[Any, Any]] = set()
+    
+    @staticmethod
+    def frame_size(frame: Dict[str, Any]) -> int:
+        """估算消息占用的字符数"""
+        return 32 + sum(len(value) for value in frame.values() if isinstance(value, str))
+    
+    @staticmethod
+    def stream_key(frame: Dict[str, Any]) -> Tuple[Any, Any]:
+        """token消息所属的请求"""
+        return frame.get("request_id"), frame.get("action")
+    
+    def put(self, frame: Dict[str, Any], batch_max_chars: int):
+        """
+        加入一条消息
+        
+        参数:
+        - frame: 要发送的消息
+        - batch_max_chars: 待发送token达到该字符数时立即发送
+        """
+        if frame.get("type") == "token":
+            token = frame.get("token") or ""
+            key = self.stream_key(frame)
+            self.streams.setdefault(key, []).append(token)
+            if key in self.desynced:
+                # 队列中已有该请求的resync消息，写出时携带包括本token在内的全文
+                self.ready.set()
+                return
+            last = self.frames[-1] if self.frames else None
+            if (last is not None and last.get("type") == "token"
+                    and self.stream_key(last) == key):
+                # 合并到上一条token消息
+                last["token"] += token
+                self.pending_chars += len(token)
+            else:
+                self.frames.append(dict(frame))
+                self.pending_chars += self.frame_size(frame)
+            if self.pending_chars >= batch_max_chars:
+                self.flush_now.set()
+        else:
+            self.frames.append(frame)
+            self.pending_chars += self.frame_size(frame)
+            self.flush_now.set()
+        self.ready.set()
+    
+    def has_control_frames(self) -> bool:
+        """队列中是否有非token消息"""
+        return any(frame.get("type") != "token" for frame in self.frames)
+    
+    def drop_tokens(self, max_chars: int) -> int:
+        """
+        队列超出上限时丢弃最旧的token消息（控制消息不丢弃）
+        
+        被丢弃的请求在原位置换成一条resync消息，该请求排在后面的token消息一并移除，
+        客户端收到resync后用全文替换已显示的文本，不会在缺口之后继续拼接
+        
+        返回:
+        - 丢弃的消息数
+        """
+        dropped = 0
+        if self.pending_chars <= max_chars:
+            return dropped
+        kept: Deque[Dict[str, Any]] = deque()
+        for frame in self.frames:
+            if frame.get("type") != "token":
+                kept.append(frame)
+                continue
+            key = self.stream_key(frame)
+            if key not in self.desynced and self.pending_chars <= max_chars:
+                kept.append(frame)
+                continue
+            self.pending_chars -= self.frame_size(frame)
+            dropped += 1
+            if key not in self.desynced:
+                self.desynced.add(key)
+                resync = {name: value for name, value in frame.items() if name != "token"}
+                resync["type"] = "resync"
+                kept.append(resync)
+                self.pending_chars += self.frame_size(resync)
+        self.frames = kept
+        self.dropped += dropped
+        return dropped
+    
+    def drain(self) -> List[Dict[str, Any]]:
+        """取出全部待发送的消息，resync消息在此时填入请求已生成的全文"""
+        frames = list(self.frames)
+        for frame in frames:
+            frame_type = frame.get("type")
+            if frame_type == "resync":
+                key = self.stream_key(frame)
+                if "text" not in frame:
+                    frame["text"] = "".join(self.streams.get(key, ()))
+                self.desynced.discard(key)
+            elif frame_type in self.FINAL_TYPES and self.streams:
+                for key in [key for key in self.streams if key[0] == frame.get("request_id")]:
+                    del self.streams[key]
+                    self.desynced.discard(key)
+        self.frames.clear()
+        self.pending_chars = 0
+        self.ready.clear()
+        self.flush_now.clear()
+        return frames
+    
+    def finish(self, request_id: str):
+        """请求的任务已结束（包括被取消）：排队中的resync消息立即填入全文，释放该请求已生成的文本"""
+        keys = [key for key in self.streams if key[0] == request_id]
+        if not keys:
+            return
+        for frame in self.frames:
+            key = self.stream_key(frame)
+            if frame.get("type") == "resync" and key in keys and "text" not in frame:
+                frame["text"] = "".join(self.streams[key])
+                self.pending_chars += len(frame["text"])
+        for key in keys:
+            del self.streams[key]
+            self.desynced.discard(key)
+
+class ConnectionState:
+    """单个WebSocket连接的状态"""
+    
+    __slots__ = ("connection_id", "websocket", "last_activity", "error_count", "tasks", "next_check",
+                 "outbox", "writer")
+    
+    def __init__(self, connection_id: str, websocket: WebSocket):
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.last_activity = time.time()
+        self.error_count = 0
+        # 下一次心跳检查的时间，与调度堆中的条目对应
+        self.next_check = 0.0
+        # 正在运行的生成任务: {request_id: (任务类别, 任务)}
+        self.tasks: Dict[str, Tuple[str, asyncio.Task]] = {}
+        # 发送队列及负责写出的任务
+        self.outbox = OutboundQueue()
+        self.writer: Optional[asyncio.Task] = None
+
 class ConnectionManager:
     """WebSocket连接管理器，支持连接超时和心跳机制"""
     
-    def __init__(self, heartbeat_interval: int = 30, connection_timeout: int = 300):
+    def __init__(
+        self,
+        heartbeat_interval: int = 30,
+        connection_timeout: int = 300,
+        send_timeout: float = 5.0,
+        protocol_ping: bool = False,
+        batch_interval: float = 0.03,
+        batch_max_chars: int = 2048,
+        queue_max_chars: int = 262144
+    ):
         """
         初始化WebSocket连接管理器
         
         参数:
         - heartbeat_interval: 心跳间隔（秒）
         - connection_timeout: 连接超时时间（秒）
+        - send_timeout: 单条消息写出的超时时间（秒）
+        - protocol_ping: 使用WebSocket协议层ping/pong（由uvicorn发送）代替JSON心跳消息
+        - batch_interval: token消息合并的时间窗口（秒）
+        - batch_max_chars: 待发送token达到该字符数时不再等待时间窗口
+        - queue_max_chars: 每个连接发送队列的字符数上限
         """
-        self.active_connections: Dict[str, Dict[str, Any]] = {}
+        # 按连接ID和WebSocket对象分别索引，查找均为O(1)
+        # （Starlette的WebSocket不可哈希，使用id()作为键；状态对象持有引用，id不会被复用）
+        self.active_connections: Dict[str, ConnectionState] = {}
+        self._socket_index: Dict[int, ConnectionState] = {}
         self.heartbeat_interval = heartbeat_interval
         self.connection_timeout = connection_timeout
         self.heartbeat_task = None
+        self.send_timeout = send_timeout
+        self.protocol_ping = protocol_ping
+        self.batch_interval = batch_interval
+        self.batch_max_chars = batch_max_chars
+        self.queue_max_chars = queue_max_chars
+        
+        # 心跳调度堆: (检查时间, 连接ID)，只处理到期的连接
+        self._heartbeat_heap: List[Tuple[float, str]] = []
+        self._heartbeat_wakeup = asyncio.Event()
+        self._heartbeat_sends: Set[asyncio.Task] = set()
+        # 正在关闭的连接
+        self._closing: Set[asyncio.Task] = set()
         
-        # 添加错误计数器，防止无限错误循环
-        self.error_counts: Dict[str, int] = {}
+        # 防止无限错误循环
         self.max_errors_per_connection = 10  # 每个连接最多10个错误
     
     async def connect(self, websocket: WebSocket):
@@ -34,11 +222,11 @@ class ConnectionManager:
         connection_id = str(uuid.uuid4())
         
         # 存储连接信息
-        self.active_connections[connection_id] = {
-            "websocket": websocket,
-            "last_activity": time.time(),
-            "connection_id": connection_id
-        }
+        state = ConnectionState(connection_id, websocket)
+        self.active_connections[connection_id] = state
+        self._socket_index[id(websocket)] = state
+        self._schedule_check(state, state.last_activity + self.heartbeat_interval * 0.8)
+        state.writer = asyncio.create_task(self._writer(state))
         
         # 记录连接建立
         logger.info({
@@ -53,125 +241,278 @@ class ConnectionManager:
         
         return connection_id
     
-    def disconnect(self, websocket: WebSocket):
-        """关闭WebSocket连接"""
-        # 查找并移除连接
-        connection_id = None
-        for conn_id, conn_info in list(self.active_connections.items()):
-            if conn_info["websocket"] == websocket:
-                connection_id = conn_id
-                del self.active_connections[conn_id]
-                # 清理错误计数
-                self.error_counts.pop(conn_id, None)
-                break
+    def get_state(self, websocket: WebSocket) -> Optional[ConnectionState]:
+        """获取WebSocket对应的连接状态"""
+        return self._socket_index.get(id(websocket))
+    
+    def disconnect(self, websocket: WebSocket, close_code: Optional[int] = None):
+        """
+        关闭WebSocket连接
+        
+        参数:
+        - websocket: WebSocket连接
+        - close_code: 服务端主动断开时的关闭码；为None时只清理连接状态（连接已由客户端关闭）
+        """
+        state = self._socket_index.pop(id(websocket), None)
+        if state is None:
+            return
+        self.active_connections.pop(state.connection_id, None)
+        
+        # 服务端主动断开时关闭底层连接，接收循环随之结束
+        if close_code is not None and websocket.client_state.name == "CONNECTED":
+            close_task = asyncio.create_task(self._close(websocket, close_code))
+            self._closing.add(close_task)
+            close_task.add_done_callback(self._closing.discard)
+        
+        # 停止写出任务，丢弃未发送的消息
+        if state.writer is not None and not state.writer.done():
+            state.writer.cancel()
+        
+        # 取消该连接仍在运行的生成任务
+        self.cancel_tasks(state.connection_id, state=state)
         
         # 记录连接关闭
-        if connection_id:
+        logger.info({
+            "message": "WebSocket连接已关闭",
+            "connection_id": state.connection_id,
+            "active_connections": len(self.active_connections)
+        })
+    
+    async def _close(self, websocket: WebSocket, code: int):
+        """关闭底层连接，连接已断开时忽略错误"""
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+    
+    def register_task(self, connection_id: str, request_id: str, task: asyncio.Task, kind: str = "completion"):
+        """
+        登记连接的生成任务，任务结束后自动移除
+        
+        参数:
+        - connection_id: 连接ID
+        - request_id: 请求ID，用于显式取消
+        - kind: 任务类别，新请求可以取消同类别的旧任务
+        """
+        state = self.active_connections.get(connection_id)
+        if state is None:
+            # 连接已关闭，任务没有继续运行的意义
+            task.cancel()
+            return
+        state.tasks[request_id] = (kind, task)
+        
+        def _remove(finished: asyncio.Task):
+            if state.tasks.get(request_id, (None, None))[1] is finished:
+                del state.tasks[request_id]
+                state.outbox.finish(request_id)
+        
+        task.add_done_callback(_remove)
+    
+    def cancel_task(self, connection_id: str, request_id: str) -> bool:
+        """
+        取消指定的生成任务
+        
+        返回:
+        - 找到并取消了任务返回True，否则返回False
+        """
+        state = self.active_connections.get(connection_id)
+        entry = state.tasks.get(request_id) if state else None
+        if entry is None or entry[1].done():
+            return False
+        entry[1].cancel()
+        return True
+    
+    def cancel_tasks(
+        self,
+        connection_id: str,
+        kind: Optional[str] = None,
+        exclude: Optional[str] = None,
+        state: Optional[ConnectionState] = None
+    ) -> int:
+        """
+        取消连接的生成任务
+        
+        参数:
+        - connection_id: 连接ID
+        - kind: 只取消该类别的任务，为None时取消全部
+        - exclude: 不取消的请求ID
+        - state: 连接状态（已从索引中移除的连接需要直接传入）
+        
+        返回:
+        - 被取消的任务数
+        """
+        state = state or self.active_connections.get(connection_id)
+        if state is None or not state.tasks:
+            return 0
+        
+        cancelled = 0
+        for request_id, (task_kind, task) in list(state.tasks.items()):
+            if request_id == exclude:
+                continue
+            if (kind is None or task_kind == kind) and not task.done():
+                task.cancel()
+                cancelled += 1
+        if cancelled:
             logger.info({
-                "message": "WebSocket连接已关闭",
+                "message": "已取消生成任务",
                 "connection_id": connection_id,
-                "active_connections": len(self.active_connections)
+                "kind": kind or "all",
+                "cancelled": cancelled
             })
+        return cancelled
     
     def update_activity(self, websocket: WebSocket):
-        """更新连接的最后活动时间"""
-        for conn_info in self.active_connections.values():
-            if conn_info["websocket"] == websocket:
-                conn_info["last_activity"] = time.time()
-                break
+        """更新连接的最后活动时间（收到客户端消息时调用）"""
+        state = self._socket_index.get(id(websocket))
+        if state is not None:
+            state.last_activity = time.time()
     
     async def send_json(self, websocket: WebSocket, data: Dict[str, Any]):
-        """向指定的WebSocket连接发送JSON数据"""
+        """
+        向指定的WebSocket连接发送JSON数据
+        
+        消息进入连接的发送队列，由写出任务按批次发送；返回False表示连接已不可用
+        """
+        # 检查连接是否仍然有效
+        if websocket.client_state.name != "CONNECTED":
+            # 如果连接已关闭，直接断开连接
+            self.disconnect(websocket)
+            return False
+        
+        state = self._socket_index.get(id(websocket))
+        if state is None:
+            # 连接已被断开（如发送队列积压或超时），不再绕过队列直接发送
+            return False
+        
+        return self._enqueue(state, data)
+    
+    def _enqueue(self, state: ConnectionState, data: Dict[str, Any]) -> bool:
+        """将消息加入连接的发送队列，超出上限时按丢弃策略处理"""
+        outbox = state.outbox
+        outbox.put(data, self.batch_max_chars)
+        if outbox.pending_chars <= self.queue_max_chars:
+            return True
+        
+        # 客户端读取过慢：先把token消息换成resync消息，仍超限则断开连接
+        dropped = outbox.drop_tokens(self.queue_max_chars)
+        logger.warning({
+            "message": "发送队列超出上限，token消息改为resync消息",
+            "connection_id": state.connection_id,
+            "dropped": dropped,
+            "dropped_total": outbox.dropped,
+            "pending_chars": outbox.pending_chars
+        })
+        if outbox.pending_chars > self.queue_max_chars:
+            logger.warning({
+                "message": "发送队列持续积压，主动断开连接",
+                "connection_id": state.connection_id
+            })
+            # 1013: 服务端过载，客户端稍后重连
+            self.disconnect(state.websocket, close_code=1013)
+            return False
+        return True
+    
+    async def _writer(self, state: ConnectionState):
+        """连接的写出任务：合并时间窗口内的token，按顺序写出队列中的消息"""
+        outbox = state.outbox
+        try:
+            while True:
+                await outbox.ready.wait()
+                
+                # 只有token消息时等待一个时间窗口，让后续token合并进同一条消息
+                if not outbox.flush_now.is_set():
+                    try:
+                        await asyncio.wait_for(outbox.flush_now.wait(), timeout=self.batch_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                
+                for frame in outbox.drain():
+                    if not await self._write(state, frame):
+                        return
+        except asyncio.CancelledError:
+            pass
+    
+    async def _write(self, state: ConnectionState, data: Dict[str, Any]) -> bool:
+        """写出单条消息，处理超时和错误计数"""
+        websocket = state.websocket
+        connection_id = state.connection_id
         try:
-            # 检查连接是否仍然有效
             if websocket.client_state.name != "CONNECTED":
-                # 如果连接已关闭，直接断开连接
                 self.disconnect(websocket)
                 return False
             
-            # 查找连接ID用于错误计数
-            connection_id = None
-            for conn_id, conn_info in self.active_connections.items():
-                if conn_info["websocket"] == websocket:
-                    connection_id = conn_id
-                    break
+            await asyncio.wait_for(websocket.send_json(data), timeout=self.send_timeout)
             
-            await websocket.send_json(data)
-            self.update_activity(websocket)
-            
-            # 发送成功，重置错误计数
-            if connection_id:
-                self.error_counts[connection_id] = 0
+            # 发送成功，重置错误计数（活动时间只由客户端发来的消息更新，服务端自己的心跳不算活动）
+            state.error_count = 0
             return True
         except Exception as e:
             # 增加错误计数
-            if connection_id:
-                self.error_counts[connection_id] = self.error_counts.get(connection_id, 0) + 1
-                
-                # 如果错误次数过多，断开连接并停止发送
-                if self.error_counts[connection_id] >= self.max_errors_per_connection:
-                    logger.warning({
-                        "message": f"连接错误次数过多({self.error_counts[connection_id]})，主动断开连接",
-                        "connection_id": connection_id,
-                        "error": str(e)
-                    })
-                    self.disconnect(websocket)
-                    return False
+            state.error_count += 1
+            
+            # 如果错误次数过多，断开连接并停止发送
+            if state.error_count >= self.max_errors_per_connection:
+                logger.warning({
+                    "message": f"连接错误次数过多({state.error_count})，主动断开连接",
+                    "connection_id": connection_id,
+                    "error": str(e)
+                })
+                self.disconnect(websocket, close_code=1011)
+                return False
             
             logger.error({
                 "message": "发送WebSocket消息失败",
                 "connection_id": connection_id,
-                "error_count": self.error_counts.get(connection_id, 0),
-                "error": str(e)
+                "error_count": state.error_count,
+                "error": str(e) or type(e).__name__
             })
             
             # 尝试断开连接
-            if connection_id and self.error_counts.get(connection_id, 0) >= 3:  # 3次错误后断开
-                self.disconnect(websocket)
-            return False
+            if state.error_count >= 3:  # 3次错误后断开
+                self.disconnect(websocket, close_code=1011)
+                return False
+            return True
     
     async def broadcast_json(self, data: Dict[str, Any]):
         """向所有活跃的WebSocket连接广播JSON数据"""
-        for conn_info in list(self.active_connections.values()):
-            try:
-                await conn_info["websocket"].send_json(data)
-                self.update_activity(conn_info["websocket"])
-            except Exception as e:
-                logger.error({
-                    "message": "广播WebSocket消息失败",
-                    "connection_id": conn_info["connection_id"],
-                    "error": str(e)
-                })
-                # 尝试断开连接
-                self.disconnect(conn_info["websocket"])
+        for state in list(self.active_connections.values()):
+            self._enqueue(state, dict(data))
+    
+    def _schedule_check(self, state: ConnectionState, when: float):
+        """安排连接的下一次心跳检查"""
+        # 新条目早于当前最早的条目时唤醒心跳任务重新计算等待时间
+        if not self._heartbeat_heap or when < self._heartbeat_heap[0][0]:
+            self._heartbeat_wakeup.set()
+        state.next_check = when
+        heapq.heappush(self._heartbeat_heap, (when, state.connection_id))
     
     async def send_heartbeat(self, websocket: WebSocket):
-        """发送心跳消息"""
-        try:
-            # 检查连接是否仍然有效
-            if websocket.client_state.name != "CONNECTED":
-                return False
-                
-            await websocket.send_json({"type": "heartbeat", "timestamp": time.time()})
-            self.update_activity(websocket)
-            return True
-        except Exception as e:
-            logger.debug({
-                "message": "发送心跳消息失败",
-                "error": str(e)
-            })
-            return False
+        """发送心跳消息（经发送队列写出，写出超时或失败由写出任务处理）"""
+        return await self.send_json(websocket, {"type": "heartbeat", "timestamp": time.time()})
+    
+    async def _send_heartbeats(self, states: List[ConnectionState]):
+        """并发向一批连接发送心跳，失败的连接被断开"""
+        results = await asyncio.gather(*(self.send_heartbeat(state.websocket) for state in states))
+        for state, success in zip(states, results):
+            if not success:
+                self.disconnect(state.websocket)
     
     async def _heartbeat_check(self):
-        """定期检查连接状态并发送心跳"""
+        """按调度堆检查到期的连接并发送心跳"""
+        heartbeat_due = self.heartbeat_interval * 0.8
         try:
             while True:
                 current_time = time.time()
+                due: List[ConnectionState] = []
                 
-                # 检查所有连接
-                for conn_id, conn_info in list(self.active_connections.items()):
-                    last_activity = conn_info["last_activity"]
-                    websocket = conn_info["websocket"]
+                # 只处理已到期的连接
+                while self._heartbeat_heap and self._heartbeat_heap[0][0] <= current_time:
+                    when, conn_id = heapq.heappop(self._heartbeat_heap)
+                    state = self.active_connections.get(conn_id)
+                    # 连接已关闭或条目已被重新调度
+                    if state is None or state.next_check != when:
+                        continue
+                    websocket = state.websocket
                     
                     # 检查连接状态
                     if websocket.client_state.name != "CONNECTED":
@@ -183,24 +524,46 @@ class ConnectionManager:
                         self.disconnect(websocket)
                         continue
                     
-                    # 检查是否超时
-                    if current_time - last_activity > self.connection_timeout:
+                    # 检查是否超时：两种心跳模式使用同一规则，只有客户端发来的消息计为活动，
+                    # 服务端发出的心跳和协议层pong都不计入；仍有生成任务在运行的连接不视为空闲
+                    inactive = current_time - state.last_activity
+                    if inactive > self.connection_timeout and not state.tasks:
                         logger.info({
                             "message": "WebSocket连接超时",
                             "connection_id": conn_id,
-                            "inactive_seconds": int(current_time - last_activity)
+                            "inactive_seconds": int(inactive)
                         })
-                        self.disconnect(websocket)
+                        self.disconnect(websocket, close_code=1000)
                         continue
                     
-                    # 如果接近心跳间隔，发送心跳
-                    if current_time - last_activity > self.heartbeat_interval * 0.8:
-                        success = await self.send_heartbeat(websocket)
-                        if not success:
-                            self.disconnect(websocket)
+                    if self.protocol_ping:
+                        # 存活检测由协议层ping/pong负责，不发送JSON心跳
+                        self._schedule_check(state, current_time + self.heartbeat_interval)
+                        continue
+                    
+                    # 期间有过活动的连接顺延到下一个心跳时间，否则发送心跳
+                    if inactive >= heartbeat_due:
+                        due.append(state)
+                        self._schedule_check(state, current_time + heartbeat_due)
+                    else:
+                        self._schedule_check(state, state.last_activity + heartbeat_due)
+                
+                # 并发发送心跳，不等待慢客户端
+                if due:
+                    send_task = asyncio.create_task(self._send_heartbeats(due))
+                    self._heartbeat_sends.add(send_task)
+                    send_task.add_done_callback(self._heartbeat_sends.discard)
                 
-                # 等待下一次检查
-                await asyncio.sleep(self.heartbeat_interval / 2)
+                # 等待到下一个到期时间
+                self._heartbeat_wakeup.clear()
+                if self._heartbeat_heap:
+                    delay = max(0.0, self._heartbeat_heap[0][0] - time.time())
+                    try:
+                        await asyncio.wait_for(self._heartbeat_wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._heartbeat_wakeup.wait()
                 
         except asyncio.CancelledError:
             logger.info({"message": "心跳检查任务已取消"})
@@ -211,4 +574,12 @@ class ConnectionManager:
             })
 
 # 创建连接管理器实例
-manager = ConnectionManager()
+manager = ConnectionManager(
+    heartbeat_interval=settings.WS_HEARTBEAT_INTERVAL,
+    connection_timeout=settings.WS_CONNECTION_TIMEOUT,
+    send_timeout=settings.WS_SEND_TIMEOUT,
+    protocol_ping=settings.WS_PROTOCOL_PING,
+    batch_interval=settings.WS_BATCH_INTERVAL_MS / 1000,
+    batch_max_chars=settings.WS_BATCH_MAX_CHARS,
+    queue_max_chars=settings.WS_QUEUE_MAX_CHARS
+)
@@ -21,14 +21,114 @@ class Settings(BaseSettings):
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     OPENAI_API_BASE_URL: str = os.getenv("OPENAI_API_BASE_URL", "https://api.openai.com/v1")
     OPENAI_MODEL: str = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+    # 多个OpenAI兼容端点（逗号分隔），为空时只使用 OPENAI_API_BASE_URL
+    OPENAI_API_BASE_URLS: str = os.getenv("OPENAI_API_BASE_URLS", "")
+    # 快速档位（按键补全）和质量档位（改写、对话、论文结构等）的模型，为空时使用 OPENAI_MODEL
+    OPENAI_FAST_MODEL: str = os.getenv("OPENAI_FAST_MODEL", "")
+    OPENAI_QUALITY_MODEL: str = os.getenv("OPENAI_QUALITY_MODEL", "")
+    # 按操作覆盖模型路由表（JSON），如 {"translate": {"model": "gpt-4o", "timeout": 90}}
+    MODEL_ROUTES: str = os.getenv("MODEL_ROUTES", "")
     
     # 上下文窗口配置
     CONTEXT_WINDOW_BEFORE: int = int(os.getenv("CONTEXT_WINDOW_BEFORE", "1536"))
     CONTEXT_WINDOW_AFTER: int = int(os.getenv("CONTEXT_WINDOW_AFTER", "256"))
+    # 上下文类型识别的关键词表（JSON），按类别替换或补充默认关键词，如 {"technical": ["api", "接口"]}
+    CONTEXT_KEYWORDS: str = os.getenv("CONTEXT_KEYWORDS", "")
+    # 模型的上下文长度（token数），可在 MODEL_ROUTES 中按操作用 context_limit 覆盖
+    MODEL_CONTEXT_TOKENS: int = int(os.getenv("MODEL_CONTEXT_TOKENS", "8192"))
+    # 对话附带的文档上下文和对话历史各自最多占用的token数
+    PROMPT_CONTEXT_MAX_TOKENS: int = int(os.getenv("PROMPT_CONTEXT_MAX_TOKENS", "2048"))
+    PROMPT_HISTORY_MAX_TOKENS: int = int(os.getenv("PROMPT_HISTORY_MAX_TOKENS", "2048"))
+    
+    # 对话存储配置
+    # 持久化后端: sqlite / memory（只保存在内存中，重启后丢失）
+    CHAT_STORE_BACKEND: str = os.getenv("CHAT_STORE_BACKEND", "sqlite")
+    CHAT_STORE_PATH: str = os.getenv("CHAT_STORE_PATH", "data/conversations.db")
+    CHAT_STORE_MAX_CONVERSATIONS: int = int(os.getenv("CHAT_STORE_MAX_CONVERSATIONS", "1024"))
+    # 未摘要的历史消息超过该token数时在后台压缩为摘要，以及压缩时保留原文的最近消息条数
+    CHAT_COMPACT_TOKENS: int = int(os.getenv("CHAT_COMPACT_TOKENS", "1536"))
+    CHAT_COMPACT_KEEP_MESSAGES: int = int(os.getenv("CHAT_COMPACT_KEEP_MESSAGES", "4"))
+    
+    # 翻译记忆配置：按段落保存译文，重新翻译时未修改的段落直接复用
+    # 持久化后端: sqlite / memory（只保存在内存中，重启后丢失）
+    TRANSLATION_MEMORY_BACKEND: str = os.getenv("TRANSLATION_MEMORY_BACKEND", "sqlite")
+    TRANSLATION_MEMORY_PATH: str = os.getenv("TRANSLATION_MEMORY_PATH", "data/translation_memory.db")
+    TRANSLATION_MEMORY_MAX_ENTRIES: int = int(os.getenv("TRANSLATION_MEMORY_MAX_ENTRIES", "10000"))
+    # 译文的有效期（秒），0表示不使用翻译记忆；切换模型或更新翻译提示词后旧译文不再复用
+    TRANSLATION_MEMORY_TTL: int = int(os.getenv("TRANSLATION_MEMORY_TTL", "2592000"))
+    
+    # 响应缓存配置：相同输入的文本优化、论文结构和大纲直接返回缓存结果
+    # 持久化后端: sqlite / memory（只缓存在内存中，重启后丢失）
+    RESPONSE_CACHE_BACKEND: str = os.getenv("RESPONSE_CACHE_BACKEND", "sqlite")
+    RESPONSE_CACHE_PATH: str = os.getenv("RESPONSE_CACHE_PATH", "data/response_cache.db")
+    # 内存中缓存结果的总大小上限（字节）
+    RESPONSE_CACHE_MAX_BYTES: int = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    # 各端点结果的有效期（秒，JSON），未配置或为0的端点不缓存
+    RESPONSE_CACHE_TTLS: str = os.getenv("RESPONSE_CACHE_TTLS", '{"optimize": 86400, "structure": 604800, "outline": 604800}')
+    # 生成温度高于该值的请求不使用缓存
+    RESPONSE_CACHE_MAX_TEMPERATURE: float = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.7"))
+    
+    # 近似重复请求缓存配置：大纲与已有请求足够相似时直接返回其结果，独立提问只复用完全相同的问题
+    # 相似度为统一同义词、去掉虚词后的字符二元组集合的Jaccard相似度，且两者必须使用相同的字符；有效期为0时不使用
+    SIMILARITY_CACHE_THRESHOLD: float = float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.75"))
+    SIMILARITY_CACHE_MAX_ENTRIES: int = int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", "4096"))
+    SIMILARITY_CACHE_TTL: int = int(os.getenv("SIMILARITY_CACHE_TTL", "604800"))
+    # 同义词表（JSON，{统一后的写法: [其他写法]}），替换或补充默认同义词表
+    SIMILARITY_CACHE_ALIASES: str = os.getenv("SIMILARITY_CACHE_ALIASES", "")
+    
+    # WebSocket配置
+    WS_HEARTBEAT_INTERVAL: int = int(os.getenv("WS_HEARTBEAT_INTERVAL", "30"))
+    WS_CONNECTION_TIMEOUT: int = int(os.getenv("WS_CONNECTION_TIMEOUT", "300"))
+    WS_SEND_TIMEOUT: float = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+    # 使用WebSocket协议层ping/pong（由uvicorn发送）代替JSON心跳消息
+    # ping间隔和超时是uvicorn的启动参数：直接运行 app/main.py 时按心跳间隔和发送超时自动设置，
+    # 使用uvicorn命令行或gunicorn（uvicorn worker）启动时需要加上 --ws-ping-interval <WS_HEARTBEAT_INTERVAL> --ws-ping-timeout <WS_SEND_TIMEOUT>
+    # 不活动超时（WS_CONNECTION_TIMEOUT）在两种模式下规则相同：只有客户端发来的消息计为活动，服务端心跳和pong都不计入
+    WS_PROTOCOL_PING: bool = os.getenv("WS_PROTOCOL_PING", "false").lower() == "true"
+    # 流式token合并窗口（毫秒）、单批字符数和每个连接发送队列的字符数上限
+    WS_BATCH_INTERVAL_MS: int = int(os.getenv("WS_BATCH_INTERVAL_MS", "30"))
+    WS_BATCH_MAX_CHARS: int = int(os.getenv("WS_BATCH_MAX_CHARS", "2048"))
+    WS_QUEUE_MAX_CHARS: int = int(os.getenv("WS_QUEUE_MAX_CHARS", "262144"))
+    
+    # 速率限制配置
+    # 存储后端: memory（每个worker独立）/ shared_memory（同一主机的worker共享）
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_SHM_NAME: str = os.getenv("RATE_LIMIT_SHM_NAME", "inkwell_rate_limit")
+    RATE_LIMIT_SHM_SLOTS: int = int(os.getenv("RATE_LIMIT_SHM_SLOTS", "65536"))
+    
+    # 上游并发控制配置（并发上限在最小值和最大值之间自适应调整）
+    UPSTREAM_INITIAL_CONCURRENCY: int = int(os.getenv("UPSTREAM_INITIAL_CONCURRENCY", "8"))
+    UPSTREAM_MIN_CONCURRENCY: int = int(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1"))
+    UPSTREAM_MAX_CONCURRENCY: int = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+    # 每分钟token预算，0表示不限制
+    UPSTREAM_TOKENS_PER_MINUTE: int = int(os.getenv("UPSTREAM_TOKENS_PER_MINUTE", "0"))
+    # 批量改写请求最多占用的并发比例，其余留给行内补全；行内补全的最长排队时间（秒）
+    UPSTREAM_BULK_SHARE: float = float(os.getenv("UPSTREAM_BULK_SHARE", "0.75"))
+    UPSTREAM_COMPLETION_MAX_WAIT: float = float(os.getenv("UPSTREAM_COMPLETION_MAX_WAIT", "2"))
+    # 多端点路由策略: ewma（延迟加权）/ least_outstanding（最少在途请求）
+    UPSTREAM_ROUTING_POLICY: str = os.getenv("UPSTREAM_ROUTING_POLICY", "ewma")
+    # 行内补全首个token超过p90仍未到达时向另一个端点发送对冲请求，以及对冲请求的最大比例
+    UPSTREAM_HEDGE_COMPLETIONS: bool = os.getenv("UPSTREAM_HEDGE_COMPLETIONS", "false").lower() == "true"
+    UPSTREAM_HEDGE_MAX_RATIO: float = float(os.getenv("UPSTREAM_HEDGE_MAX_RATIO", "0.1"))
+    
+    # 批量优化配置：单个批次的最大条目数（不超过API速率限制的突发容量，每个条目消耗一个令牌）和最大并发数
+    BATCH_OPTIMIZE_MAX_ITEMS: int = int(os.getenv("BATCH_OPTIMIZE_MAX_ITEMS", "500"))
+    BATCH_OPTIMIZE_CONCURRENCY: int = int(os.getenv("BATCH_OPTIMIZE_CONCURRENCY", "8"))
+    
+    # 长文本分段优化配置：超过单段token数的文本切分为多段并行处理，每段附带前后文
+    OPTIMIZE_CHUNK_TOKENS: int = int(os.getenv("OPTIMIZE_CHUNK_TOKENS", "800"))
+    OPTIMIZE_CHUNK_CONTEXT_TOKENS: int = int(os.getenv("OPTIMIZE_CHUNK_CONTEXT_TOKENS", "128"))
+    OPTIMIZE_CHUNK_CONCURRENCY: int = int(os.getenv("OPTIMIZE_CHUNK_CONCURRENCY", "4"))
     
     # 服务器配置
     HOST: str = os.getenv("HOST", "0.0.0.0")
     PORT: int = int(os.getenv("PORT", "8000"))
     
+    @property
+    def upstream_base_urls(self) -> List[str]:
+        """所有上游端点地址"""
+        urls = [url.strip() for url in self.OPENAI_API_BASE_URLS.split(",") if url.strip()]
+        return urls or [self.OPENAI_API_BASE_URL]
+
 
 settings = Settings()
\ No newline at end of file
@@ -1,71 +1,251 @@
 """
 速率限制模块
 提供API请求速率限制功能
+
+令牌桶以GCRA（通用信元速率算法）的形式保存：每个桶只记录一个“理论到达时间”（TAT），
+TAT不晚于当前时间即表示桶已装满，此时记录可以直接丢弃而不影响限流结果。
+桶的存储由可替换的后端提供：
+- MemoryBackend: 进程内字典，定期清理空闲的桶
+- SharedMemoryBackend: 同一主机上多个worker共享的定长共享内存表
 """
+import hashlib
+import os
+import struct
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Optional, Tuple
+from app.core.config import settings
 from app.core.logger import logger
 
-class RateLimiter:
+# 共享内存表的槽结构：键哈希（0表示空槽）+ 理论到达时间
+_SLOT = struct.Struct("<Qd")
+
+
+class RateLimitBackend:
     """
-    简单的速率限制器，基于令牌桶算法
+    令牌桶存储后端接口
     """
     
-    def __init__(self, rate: int = 10, per: int = 60, burst: int = 20):
+    def update(
+        self,
+        key: str,
+        cost: float,
+        interval: float,
+        tolerance: float,
+        now: float,
+        apply: bool = True
+    ) -> Tuple[bool, float]:
         """
-        初始化速率限制器
+        原子地检查并（可选地）扣除令牌
         
         参数:
-        - rate: 每个时间窗口允许的请求数
-        - per: 时间窗口大小（秒）
-        - burst: 允许的突发请求数（令牌桶容量）
-        """
-        self.rate = rate  # 每个时间窗口允许的请求数
-        self.per = per    # 时间窗口大小（秒）
-        self.burst = burst  # 允许的突发请求数
+        - key: 桶标识
+        - cost: 本次请求消耗的令牌数
+        - interval: 生成一个令牌所需的秒数
+        - tolerance: 桶容量对应的秒数（interval * burst）
+        - now: 当前时间
+        - apply: 允许时是否写入新的理论到达时间
         
-        # 用户请求记录: {user_id: {"tokens": current_tokens, "last_request": timestamp}}
-        self.user_requests: Dict[str, Dict[str, Any]] = {}
+        返回:
+        - (是否允许, 扣除前的理论到达时间)
+        """
+        raise NotImplementedError
     
-    def _get_tokens(self, user_id: str) -> float:
+    def release(self, key: str):
+        """删除桶记录（桶的所有者已不存在时调用）"""
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """
+    进程内存储后端，每个桶只占一个浮点数，定期清理已装满的桶
+    """
+    
+    def __init__(self, sweep_interval: float = 60.0, max_keys: int = 100_000):
         """
-        获取用户当前可用的令牌数
+        初始化进程内存储后端
         
         参数:
-        - user_id: 用户标识符
+        - sweep_interval: 清理空闲桶的间隔（秒）
+        - max_keys: 桶数量超过该值时立即清理
+        """
+        self.sweep_interval = sweep_interval
+        self.max_keys = max_keys
+        # 桶记录: {key: 理论到达时间}
+        self.buckets: Dict[str, float] = {}
+        self._next_sweep = time.time() + sweep_interval
+    
+    def update(self, key, cost, interval, tolerance, now, apply=True):
+        if now >= self._next_sweep or len(self.buckets) > self.max_keys:
+            self._sweep(now)
         
-        返回:
-        - 当前可用的令牌数
+        tat = max(self.buckets.get(key, now), now)
+        new_tat = tat + cost * interval
+        allowed = new_tat - now <= tolerance
+        if allowed and apply:
+            self.buckets[key] = new_tat
+        return allowed, tat
+    
+    def release(self, key: str):
+        self.buckets.pop(key, None)
+    
+    def _sweep(self, now: float):
+        """丢弃已装满（空闲足够久）的桶"""
+        self.buckets = {key: tat for key, tat in self.buckets.items() if tat > now}
+        self._next_sweep = now + self.sweep_interval
+
+
+class SharedMemoryBackend(RateLimitBackend):
+    """
+    共享内存存储后端
+    同一主机上的多个worker进程共享一张定长开放寻址表（键哈希 + 理论到达时间，每槽16字节），
+    已装满的桶所在的槽会被直接复用，因此内存占用固定；跨进程互斥使用文件锁
+    """
+    
+    def __init__(self, name: str = "inkwell_rate_limit", slots: int = 65536, probe_limit: int = 32):
         """
-        now = time.time()
+        初始化共享内存存储后端
         
-        # 如果是新用户，初始化记录
-        if user_id not in self.user_requests:
-            self.user_requests[user_id] = {
-                "tokens": self.burst,  # 初始令牌为最大容量
-                "last_request": now
-            }
-            return self.burst
+        参数:
+        - name: 共享内存段名称，所有worker使用同一个名称
+        - slots: 表的槽数
+        - probe_limit: 每次查找最多探测的槽数
+        """
+        import fcntl
+        from multiprocessing import resource_tracker, shared_memory
         
-        # 获取用户记录
-        user_record = self.user_requests[user_id]
-        last_request = user_record["last_request"]
-        current_tokens = user_record["tokens"]
+        self.slots = slots
+        self.probe_limit = min(probe_limit, slots)
+        self._flock = fcntl.flock
+        self._lock_exclusive = fcntl.LOCK_EX
+        self._unlock = fcntl.LOCK_UN
         
-        # 计算时间差
-        time_passed = now - last_request
+        size = slots * _SLOT.size
+        try:
+            # 新建的共享内存段内容为零，即全部为空槽
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # 段的生命周期由所有worker共同持有，不能在某个进程退出时被resource_tracker删除
+        resource_tracker.unregister(self._shm._name, "shared_memory")
         
-        # 计算新增令牌数（按比例）
-        new_tokens = time_passed * (self.rate / self.per)
+        self._buf = self._shm.buf
+        self._lock_file = open(os.path.join("/tmp", f"{name}.lock"), "a+")
+    
+    def _hash(self, key: str) -> int:
+        """计算桶标识的64位哈希（0表示空槽）"""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+    
+    def _probe(self, key_hash: int, now: float) -> Tuple[Optional[int], Optional[int]]:
+        """
+        在探测范围内查找桶
         
-        # 更新令牌数，不超过最大容量
-        current_tokens = min(current_tokens + new_tokens, self.burst)
+        返回:
+        - (桶所在的槽, 可写入新桶的槽)
+        """
+        start = key_hash % self.slots
+        free = None
+        oldest = None
+        oldest_tat = 0.0
+        for i in range(self.probe_limit):
+            index = (start + i) % self.slots
+            slot_key, tat = _SLOT.unpack_from(self._buf, index * _SLOT.size)
+            if slot_key == key_hash:
+                return index, None
+            if free is None and (slot_key == 0 or tat <= now):
+                free = index
+            if oldest is None or tat < oldest_tat:
+                oldest, oldest_tat = index, tat
+        # 探测范围内没有空槽时覆盖最快装满的桶
+        return None, free if free is not None else oldest
+    
+    def update(self, key, cost, interval, tolerance, now, apply=True):
+        key_hash = self._hash(key)
+        self._flock(self._lock_file, self._lock_exclusive)
+        try:
+            slot, free = self._probe(key_hash, now)
+            tat = now
+            if slot is not None:
+                tat = max(_SLOT.unpack_from(self._buf, slot * _SLOT.size)[1], now)
+            new_tat = tat + cost * interval
+            allowed = new_tat - now <= tolerance
+            if allowed and apply:
+                _SLOT.pack_into(self._buf, (slot if slot is not None else free) * _SLOT.size, key_hash, new_tat)
+            return allowed, tat
+        finally:
+            self._flock(self._lock_file, self._unlock)
+    
+    def release(self, key: str):
+        key_hash = self._hash(key)
+        self._flock(self._lock_file, self._lock_exclusive)
+        try:
+            slot, _ = self._probe(key_hash, time.time())
+            if slot is not None:
+                _SLOT.pack_into(self._buf, slot * _SLOT.size, key_hash, 0.0)
+        finally:
+            self._flock(self._lock_file, self._unlock)
+
+
+def create_backend() -> RateLimitBackend:
+    """
+    根据配置创建存储后端，共享内存不可用时退回进程内存储
+    
+    返回:
+    - 存储后端实例
+    """
+    if settings.RATE_LIMIT_BACKEND == "shared_memory":
+        try:
+            return SharedMemoryBackend(
+                name=settings.RATE_LIMIT_SHM_NAME,
+                slots=settings.RATE_LIMIT_SHM_SLOTS
+            )
+        except (ImportError, OSError, ValueError) as e:
+            logger.error({
+                "message": "共享内存速率限制后端不可用，使用进程内存储",
+                "error": str(e)
+            })
+    return MemoryBackend()
+
+
+class RateLimiter:
+    """
+    简单的速率限制器，基于令牌桶算法
+    """
+    
+    def __init__(
+        self,
+        rate: int = 10,
+        per: int = 60,
+        burst: int = 20,
+        name: str = "default",
+        backend: Optional[RateLimitBackend] = None
+    ):
+        """
+        初始化速率限制器
         
-        # 更新用户记录
-        self.user_requests[user_id]["tokens"] = current_tokens
-        self.user_requests[user_id]["last_request"] = now
+        参数:
+        - rate: 每个时间窗口允许的请求数
+        - per: 时间窗口大小（秒）
+        - burst: 允许的突发请求数（令牌桶容量）
+        - name: 限制器名称，多个限制器共享后端时用于区分桶
+        - backend: 令牌桶存储后端
+        """
+        self.rate = rate  # 每个时间窗口允许的请求数
+        self.per = per    # 时间窗口大小（秒）
+        self.burst = burst  # 允许的突发请求数
+        self.name = name
+        self.backend = backend or MemoryBackend()
         
-        return current_tokens
+        # 生成一个令牌所需的秒数，以及装满整个桶所需的秒数
+        self.interval = per / rate
+        self.tolerance = self.interval * burst
+    
+    def _key(self, user_id: str) -> str:
+        return f"{self.name}:{user_id}"
+    
+    def _tokens(self, tat: float, now: float) -> float:
+        """由理论到达时间换算当前可用的令牌数"""
+        return (self.tolerance - (tat - now)) / self.interval
     
     def check_rate_limit(self, user_id: str, cost: float = 1.0) -> bool:
         """
@@ -78,23 +258,17 @@ class RateLimiter:
         返回:
         - 如果允许请求，返回True；否则返回False
         """
-        # 获取当前可用令牌数
-        current_tokens = self._get_tokens(user_id)
-        
-        # 检查是否有足够的令牌
-        if current_tokens >= cost:
-            # 扣除令牌
-            self.user_requests[user_id]["tokens"] -= cost
-            return True
-        else:
+        now = time.time()
+        allowed, tat = self.backend.update(self._key(user_id), cost, self.interval, self.tolerance, now)
+        if not allowed:
             # 记录速率限制事件
             logger.warning({
                 "message": "用户请求被速率限制",
                 "user_id": user_id,
-                "available_tokens": current_tokens,
+                "available_tokens": self._tokens(tat, now),
                 "required_tokens": cost
             })
-            return False
+        return allowed
     
     def get_retry_after(self, user_id: str, cost: float = 1.0) -> Optional[int]:
         """
@@ -107,28 +281,37 @@ class RateLimiter:
         返回:
         - 需要等待的秒数，如果不需要等待则返回None
         """
-        # 如果用户不在记录中，不需要等待
-        if user_id not in self.user_requests:
-            return None
-        
-        # 获取当前可用令牌数
-        current_tokens = self._get_tokens(user_id)
+        now = time.time()
+        allowed, tat = self.backend.update(
+            self._key(user_id), cost, self.interval, self.tolerance, now, apply=False
+        )
         
         # 如果有足够的令牌，不需要等待
-        if current_tokens >= cost:
+        if allowed:
             return None
         
-        # 计算需要等待的时间
-        tokens_needed = cost - current_tokens
-        seconds_needed = (tokens_needed / self.rate) * self.per
+        # 计算需要等待的时间：理论到达时间推进到可以容纳本次消耗为止
+        seconds_needed = tat + cost * self.interval - self.tolerance - now
         
         # 向上取整
         return int(seconds_needed) + 1
+    
+    def release(self, user_id: str):
+        """
+        释放用户的令牌桶
+        
+        参数:
+        - user_id: 用户标识符（如已断开的WebSocket连接ID）
+        """
+        self.backend.release(self._key(user_id))
+
+# 创建全局速率限制器共享的存储后端
+rate_limit_backend = create_backend()
 
 # 创建全局速率限制器实例
 # 默认设置：每分钟10个请求，最大突发20个请求
-api_limiter = RateLimiter(rate=10, per=60, burst=20)
+api_limiter = RateLimiter(rate=10, per=60, burst=20, name="api", backend=rate_limit_backend)
 
 # 为WebSocket连接创建单独的速率限制器
 # 更宽松的限制：每分钟30个请求，最大突发50个请求
-ws_limiter = RateLimiter(rate=30, per=60, burst=50)
\ No newline at end of file
+ws_limiter = RateLimiter(rate=30, per=60, burst=50, name="ws", backend=rate_limit_backend)
@@ -1,9 +1,12 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+import os
 import uvicorn
 
 from app.api.api_v1 import api_router
 from app.core.config import settings
+from app.core.logger import logger
+from app.services.openai_service import conversation_store, translation_memory, response_cache
 
 app = FastAPI(
     title="Inkwell API",
@@ -23,9 +26,37 @@ app.add_middleware(
 # 包含API路由
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
+# 直接运行本文件启动时设置，标记uvicorn的ping参数已按配置设置（reload启动的子进程继承该环境变量）
+WS_PING_APPLIED_ENV = "INKWELL_WS_PING_APPLIED"
+
+@app.on_event("startup")
+async def startup():
+    # ping间隔和超时是uvicorn的启动参数，只有直接运行本文件时才会自动设置
+    if settings.WS_PROTOCOL_PING and os.getenv(WS_PING_APPLIED_ENV) != "true":
+        logger.warning({
+            "message": "已启用WS_PROTOCOL_PING但未由本文件启动，请确认uvicorn/gunicorn设置了ping参数，否则使用uvicorn的默认值",
+            "uvicorn_options": f"--ws-ping-interval {settings.WS_HEARTBEAT_INTERVAL} --ws-ping-timeout {settings.WS_SEND_TIMEOUT}"
+        })
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 取消后台的对话压缩任务并关闭对话存储、翻译记忆和响应缓存
+    await conversation_store.close()
+    translation_memory.close()
+    response_cache.close()
+
 @app.get("/")
 async def root():
     return {"message": "欢迎使用墨井智能写作助手API"}
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host=settings.HOST, port=settings.PORT, reload=True)
+    os.environ[WS_PING_APPLIED_ENV] = "true"
+    uvicorn.run(
+        "app.main:app",
+        host=settings.HOST,
+        port=settings.PORT,
+        reload=True,
+        # 启用协议层心跳时由uvicorn按心跳间隔发送ping，超时未收到pong则关闭连接
+        ws_ping_interval=settings.WS_HEARTBEAT_INTERVAL if settings.WS_PROTOCOL_PING else 20.0,
+        ws_ping_timeout=settings.WS_SEND_TIMEOUT if settings.WS_PROTOCOL_PING else 20.0
+    )
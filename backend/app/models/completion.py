@@ -7,9 +7,9 @@ class CompletionRequest(BaseModel):
     context_before: Optional[str] = Field(None, description="当前位置之前的上下文文本")
     context_after: Optional[str] = Field(None, description="当前位置之后的上下文文本")
     cursor_position: Optional[int] = Field(None, description="光标位置，用于上下文窗口管理")
-    max_tokens: int = Field(50, description="生成的最大token数量")
-    temperature: float = Field(0.7, description="生成文本的创造性程度，值越高创造性越强")
-    stream: bool = Field(False, description="是否使用流式响应")
+    max_tokens: Optional[int] = Field(None, description="生成的最大token数量，不提供时按模型路由表")
+    temperature: Optional[float] = Field(None, description="生成文本的创造性程度，值越高创造性越强，不提供时按模型路由表")
+    stream: bool = Field(False, description="是否使用流式响应，HTTP接口以SSE或NDJSON返回StreamToken帧")
     action: str = Field("completion", description="操作类型，可选值为 completion(补全), rewrite(改写), expand(扩写), simplify(简化), translate(翻译)")
     target_language: Optional[str] = Field(None, description="目标语言代码，仅用于翻译操作，如 'zh', 'en', 'ja' 等")
 
@@ -25,9 +25,40 @@ class StreamToken(BaseModel):
     type: Literal["start", "token", "end", "error", "system"] = Field(..., description="令牌类型")
     token: Optional[str] = Field(None, description="令牌内容")
     completion: Optional[str] = Field(None, description="完整的补全文本，仅在type=end时提供")
-    action: Optional[str] = Field("completion", description="操作类型，可选值为 completion(补全), rewrite(改写), expand(扩写), simplify(简化)")
+    truncated: Optional[bool] = Field(None, description="输出是否因达到最大token数被截断，仅在type=end时提供")
+    response: Optional[str] = Field(None, description="完整的聊天回复，仅在action=chat且type=end时提供")
+    conversation_id: Optional[str] = Field(None, description="服务端对话ID，仅在action=chat且type=start/end时提供")
+    action: Optional[str] = Field("completion", description="操作类型，可选值为 completion(补全), rewrite(改写), expand(扩写), simplify(简化), chat(聊天)")
     status: str = Field(..., description="处理状态")
     error: Optional[str] = Field(None, description="错误信息，仅在type=error时提供")
     request_id: Optional[str] = Field(None, description="请求ID，用于日志追踪")
     message: Optional[str] = Field(None, description="系统消息，仅在type=system时提供")
     retry_after: Optional[int] = Field(None, description="需要等待的秒数，仅在速率限制时提供")
+
+class BatchOptimizeItem(BaseModel):
+    """批量优化中的单个条目"""
+    id: Optional[str] = Field(None, description="条目ID，结果中原样返回，不提供时使用条目序号")
+    action: str = Field("rewrite", description="操作类型，可选值为 rewrite(改写), expand(扩写), simplify(简化), translate(翻译)")
+    text: str = Field(..., description="要优化的文本")
+    target_language: Optional[str] = Field(None, description="目标语言代码，仅用于翻译操作")
+
+class BatchOptimizeRequest(BaseModel):
+    """批量优化请求模型"""
+    items: List[BatchOptimizeItem] = Field(..., description="要优化的条目列表")
+    concurrency: Optional[int] = Field(None, description="同时处理的条目数，不提供或超过服务端上限时使用服务端上限")
+    temperature: Optional[float] = Field(None, description="生成温度，不提供时按模型路由表")
+
+class BatchOptimizeResult(BaseModel):
+    """批量优化的单条结果（NDJSON中的一行，按完成顺序返回）"""
+    type: Literal["result", "summary"] = Field("result", description="行类型：单条结果或最后的汇总")
+    id: Optional[str] = Field(None, description="条目ID")
+    index: Optional[int] = Field(None, description="条目在请求中的序号")
+    action: Optional[str] = Field(None, description="操作类型")
+    status: str = Field(..., description="处理状态：success/error，汇总行为done")
+    completion: Optional[str] = Field(None, description="优化后的文本")
+    error: Optional[str] = Field(None, description="错误信息，仅在status=error时提供")
+    duration_ms: Optional[int] = Field(None, description="处理耗时（毫秒）")
+    total: Optional[int] = Field(None, description="条目总数，仅汇总行提供")
+    succeeded: Optional[int] = Field(None, description="成功条目数，仅汇总行提供")
+    failed: Optional[int] = Field(None, description="失败条目数，仅汇总行提供")
+    request_id: Optional[str] = Field(None, description="请求ID，用于日志追踪")
@@ -0,0 +1,195 @@
+"""
+补全复用缓存
+记录每个会话最近的（包括仍在生成中的）补全建议，
+当用户输入的字符与建议开头一致时直接推进建议，返回剩余部分而不再请求上游
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, List, Optional, Tuple
+
+# 用于校验上文一致性的尾部字符数
+PREFIX_ANCHOR_CHARS = 128
+# 可被跟随输入的建议最大长度
+MAX_SUGGESTION_CHARS = 512
+
+
+def completion_prefix_tail(
+    text: str,
+    context_before: Optional[str] = None,
+    cursor_position: Optional[int] = None,
+    length: int = PREFIX_ANCHOR_CHARS + MAX_SUGGESTION_CHARS
+) -> str:
+    """
+    获取补全请求光标前的文本（只取尾部），与 OpenAIService.generate_completion 的上下文取法一致
+    
+    参数:
+    - text: 当前文本
+    - context_before: 客户端提供的上文
+    - cursor_position: 光标位置
+    - length: 需要的尾部字符数
+    
+    返回:
+    - 光标前的尾部文本
+    """
+    if cursor_position is not None and text:
+        cursor_position = max(0, min(cursor_position, len(text)))
+        return text[max(0, cursor_position - length):cursor_position]
+    prefix = context_before or text or ""
+    return prefix[-length:]
+
+
+class CompletionEntry:
+    """一条补全建议，生成过程中可以被其他请求跟随"""
+    
+    __slots__ = ("prefix_tail", "producer_id", "owner_id", "raw_text", "final_text",
+                 "done", "failed", "error", "created", "_changed")
+    
+    def __init__(self, prefix_tail: str, producer_id: str):
+        self.prefix_tail = prefix_tail[-PREFIX_ANCHOR_CHARS:]
+        self.producer_id = producer_id  # 负责请求上游的请求ID
+        self.owner_id = producer_id     # 当前负责向客户端下发消息的请求ID
+        self.raw_text = ""
+        self.final_text: Optional[str] = None
+        self.done = False
+        self.failed = False
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self._changed = asyncio.Event()
+    
+    @property
+    def text(self) -> str:
+        """用户看到的建议文本：生成结束后为后处理结果，否则为已收到的原始文本"""
+        return self.final_text if self.final_text is not None else self.raw_text
+    
+    def append(self, token: str):
+        """追加上游返回的token"""
+        self.raw_text += token
+        self._changed.set()
+    
+    def finish(self, completion: str):
+        """标记生成完成"""
+        self.final_text = completion
+        self.done = True
+        self._changed.set()
+    
+    def fail(self, error: Optional[str] = None):
+        """标记生成失败或被取消"""
+        self.failed = True
+        self.error = error
+        self._changed.set()
+    
+    async def follow(self, offset: int) -> AsyncGenerator[str, None]:
+        """
+        从指定偏移开始跟随原始文本，生成结束或失败时停止
+        
+        参数:
+        - offset: 已被用户输入的字符数
+        """
+        while True:
+            if len(self.raw_text) > offset:
+                chunk = self.raw_text[offset:]
+                offset = len(self.raw_text)
+                yield chunk
+            if self.done or self.failed:
+                return
+            self._changed.clear()
+            await self._changed.wait()
+    
+    def match(self, prefix_tail: str) -> Optional[int]:
+        """
+        判断新的光标前文本是否是在本建议基础上继续输入的结果
+        
+        参数:
+        - prefix_tail: 新请求光标前的尾部文本
+        
+        返回:
+        - 用户已输入的建议字符数；不匹配或建议已被完全输入时返回None
+        """
+        if self.failed:
+            return None
+        suggestion = self.text
+        anchor = self.prefix_tail
+        if not anchor:
+            return None
+        if not suggestion:
+            # 尚未收到任何token的相同请求也可以直接跟随
+            return 0 if not self.done and prefix_tail.endswith(anchor) else None
+        
+        window = prefix_tail[-(len(anchor) + len(suggestion)):]
+        index = window.rfind(anchor)
+        if index < 0:
+            return None
+        typed = window[index + len(anchor):]
+        if len(typed) >= len(suggestion) or not suggestion.startswith(typed):
+            return None
+        return len(typed)
+
+
+class TypeAheadCache:
+    """按会话保存最近补全建议的前缀匹配缓存，带TTL和容量淘汰"""
+    
+    def __init__(self, ttl: float = 30.0, max_entries_per_session: int = 8, max_sessions: int = 2048):
+        """
+        初始化补全复用缓存
+        
+        参数:
+        - ttl: 建议的有效期（秒）
+        - max_entries_per_session: 每个会话保留的建议数
+        - max_sessions: 最多保留的会话数
+        """
+        self.ttl = ttl
+        self.max_entries_per_session = max_entries_per_session
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, List[CompletionEntry]]" = OrderedDict()
+    
+    def lookup(self, session_key: str, prefix_tail: str) -> Optional[Tuple[CompletionEntry, int]]:
+        """
+        查找可以继续推进的建议
+        
+        返回:
+        - (建议, 已输入字符数)，没有可复用的建议时返回None
+        """
+        entries = self.sessions.get(session_key)
+        if not entries:
+            return None
+        
+        now = time.time()
+        entries[:] = [entry for entry in entries if now - entry.created <= self.ttl and not entry.failed]
+        # 优先匹配最新的建议
+        for entry in reversed(entries):
+            typed = entry.match(prefix_tail)
+            if typed is not None:
+                self.sessions.move_to_end(session_key)
+                return entry, typed
+        return None
+    
+    def start(self, session_key: str, prefix_tail: str, request_id: str) -> CompletionEntry:
+        """登记一条新开始生成的建议"""
+        entry = CompletionEntry(prefix_tail, request_id)
+        entries = self.sessions.setdefault(session_key, [])
+        entries.append(entry)
+        if len(entries) > self.max_entries_per_session:
+            del entries[:len(entries) - self.max_entries_per_session]
+        
+        self.sessions.move_to_end(session_key)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return entry
+    
+    def discard(self, session_key: str, entry: CompletionEntry):
+        """移除失败或被取消的建议"""
+        entry.fail(entry.error)
+        entries = self.sessions.get(session_key)
+        if entries and entry in entries:
+            entries.remove(entry)
+    
+    def release_session(self, session_key: str):
+        """释放会话的全部建议"""
+        for entry in self.sessions.pop(session_key, []):
+            if not entry.done:
+                entry.fail()
+
+
+# 创建全局补全复用缓存实例
+typeahead_cache = TypeAheadCache()
@@ -0,0 +1,122 @@
+"""
+上下文预算服务
+按模型的上下文长度为一次请求分配输入token：扣除生成预留和提示词模板的静态部分后，
+调用方按优先级依次放入当前消息、文档上下文和对话历史，超出预算的部分在句子边界处截断
+"""
+from typing import Any, Dict, List, Optional
+
+from app.services.context_window import ContextWindowManager
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ContextBudget:
+    """一次请求的输入token预算，调用方按优先级依次取用"""
+
+    def __init__(self, manager: ContextWindowManager, available: int):
+        """
+        初始化预算
+
+        参数:
+        - manager: 上下文窗口管理器，用于计数和截断
+        - available: 可用于动态内容的token数
+        """
+        self.manager = manager
+        self.available = max(0, available)
+        self.remaining = self.available
+        self.trimmed: List[str] = []
+
+    def take(self, text: Optional[str], name: str, max_tokens: Optional[int] = None, keep: str = "head") -> Optional[str]:
+        """
+        放入一段文本，超出剩余预算（或该段的上限）时在句子边界处截断
+
+        参数:
+        - text: 文本
+        - name: 文本名称，被截断时记录在 trimmed 中
+        - max_tokens: 该段文本最多占用的token数
+        - keep: 截断时保留开头（head）还是结尾（tail）
+
+        返回:
+        - 放入的文本；原文本为空时原样返回
+        """
+        if not text:
+            return text
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        kept, tokens = self.manager.trim_to_tokens(text, limit, keep)
+        if len(kept) < len(text):
+            self.trimmed.append(name)
+        self.remaining -= tokens
+        return kept
+
+    def take_history(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        从最新的一条开始放入对话历史，放不下的更早的消息整条丢弃
+
+        参数:
+        - messages: 按时间顺序排列的历史消息
+        - max_tokens: 历史消息最多占用的token数
+
+        返回:
+        - 保留的历史消息（按时间顺序，以用户消息开头）
+        """
+        limit = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        kept: List[Dict[str, str]] = []
+        used = 0
+        for message in reversed(messages):
+            tokens = self.manager.count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if used + tokens > limit:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        # 保持角色交替：丢弃开头的助手消息
+        while kept and kept[0]["role"] != "user":
+            used -= self.manager.count_tokens(kept[0]["content"]) + MESSAGE_OVERHEAD_TOKENS
+            kept.pop(0)
+        if len(kept) < len(messages):
+            self.trimmed.append("history")
+        self.remaining -= used
+        return kept
+
+    @property
+    def used(self) -> int:
+        """已放入的token数"""
+        return self.available - self.remaining
+
+
+class ContextBudgetAllocator:
+    """按模型上下文长度为请求分配输入预算，所有端点共用"""
+
+    def __init__(self, manager: ContextWindowManager, safety_margin: int = 64):
+        """
+        初始化预算分配器
+
+        参数:
+        - manager: 上下文窗口管理器
+        - safety_margin: 预留的余量，抵消不同模型分词器之间的计数差异
+        """
+        self.manager = manager
+        self.safety_margin = safety_margin
+
+    def allocate(self, route: Any, static_tokens: int = 0, messages: int = 2) -> ContextBudget:
+        """
+        为一次请求分配输入预算
+
+        参数:
+        - route: 模型路由解析结果（使用其中的 context_limit 和 max_tokens）
+        - static_tokens: 提示词模板静态部分的token数
+        - messages: 固定消息的条数（系统消息 + 当前用户消息），用于扣除格式开销
+
+        返回:
+        - 输入预算
+        """
+        available = (
+            route.context_limit
+            - route.max_tokens
+            - static_tokens
+            - messages * MESSAGE_OVERHEAD_TOKENS
+            - self.safety_margin
+        )
+        return ContextBudget(self.manager, available)
@@ -0,0 +1,206 @@
+"""
+上下文类型识别服务
+用预编译的Aho–Corasick自动机一次扫描文本，同时匹配所有类别的关键词，按各类别命中的不同关键词数判断上下文类型：
+- 关键词不包含换行，文本按行分段扫描，同一会话中未改变的行复用上一次的命中结果，每次请求通常只扫描正在编辑的行
+- 关键词表可通过配置覆盖或扩展，扫描耗时与关键词数量无关
+"""
+import json
+from collections import OrderedDict, deque
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from app.core.logger import logger
+
+# 默认关键词表，类别的顺序即得分相同时的优先顺序
+DEFAULT_CONTEXT_KEYWORDS: Dict[str, List[str]] = {
+    "academic": [
+        "研究", "分析", "理论", "方法", "结论", "假设", "实验", "数据",
+        "调查", "论文", "学术", "科学", "探讨", "摘要", "文献", "模型",
+        "概念", "框架", "评估", "验证", "测试", "样本", "统计", "显著性"
+    ],
+    "technical": [
+        "技术", "代码", "算法", "系统", "api", "数据库", "服务器", "网络",
+        "编程", "开发", "软件", "硬件", "架构", "设计", "实现", "部署",
+        "配置", "优化", "性能", "安全", "协议", "接口", "框架", "库"
+    ],
+    "narrative": [
+        "他", "她", "故事", "情节", "角色", "人物", "场景", "对话",
+        "描述", "叙述", "小说", "章节", "主人公", "剧情", "背景", "环境"
+    ]
+}
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机"""
+
+    def __init__(self, patterns: Iterable[str]):
+        """
+        编译自动机
+
+        参数:
+        - patterns: 模式串，序号即在迭代中的位置
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]
+
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                node = next_node
+            self._output[node] += (index,)
+
+        # 按广度优先计算失败链接，并把失败链接上的输出合并到当前节点
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_node] = self._goto[fail].get(char, 0)
+                self._output[next_node] += self._output[self._fail[next_node]]
+                queue.append(next_node)
+
+    def matches(self, text: str) -> FrozenSet[int]:
+        """
+        扫描文本
+
+        参数:
+        - text: 文本
+
+        返回:
+        - 出现过的模式串序号（包括相互重叠的匹配）
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return frozenset(found)
+
+
+class ContextClassifier:
+    """上下文类型识别器"""
+
+    def __init__(self, keywords: Dict[str, List[str]], max_sessions: int = 1024):
+        """
+        初始化识别器并编译关键词
+
+        参数:
+        - keywords: {类别: 关键词列表}，类别的顺序即得分相同时的优先顺序
+        - max_sessions: 最多缓存多少个会话的分段命中结果
+        """
+        self.categories = list(keywords)
+        self.max_sessions = max_sessions
+
+        # 同一关键词可以属于多个类别
+        pattern_categories: Dict[str, List[int]] = {}
+        for category_index, category in enumerate(self.categories):
+            for keyword in keywords[category]:
+                keyword = keyword.lower()
+                if keyword and "\n" not in keyword:
+                    categories = pattern_categories.setdefault(keyword, [])
+                    if category_index not in categories:
+                        categories.append(category_index)
+        self._pattern_categories = list(pattern_categories.values())
+        self._automaton = AhoCorasick(pattern_categories)
+
+        # 会话分段缓存: {session_key: {分段文本: 命中的关键词序号}}
+        self._segment_cache: "OrderedDict[str, Dict[str, FrozenSet[int]]]" = OrderedDict()
+
+    @classmethod
+    def from_settings(cls, settings: Any) -> "ContextClassifier":
+        """
+        根据配置创建识别器，CONTEXT_KEYWORDS（JSON）中的类别替换或补充默认关键词表
+
+        参数:
+        - settings: 全局配置
+        """
+        keywords = dict(DEFAULT_CONTEXT_KEYWORDS)
+        if settings.CONTEXT_KEYWORDS:
+            try:
+                for category, category_keywords in json.loads(settings.CONTEXT_KEYWORDS).items():
+                    if not isinstance(category_keywords, list):
+                        raise TypeError(f"{category} 的关键词必须是列表")
+                    keywords[category] = [str(keyword) for keyword in category_keywords]
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error({
+                    "message": "CONTEXT_KEYWORDS 配置无效，使用默认关键词表",
+                    "error": str(e)
+                })
+                keywords = dict(DEFAULT_CONTEXT_KEYWORDS)
+        return cls(keywords)
+
+    def _matches(self, text: str, session_key: Optional[str]) -> FrozenSet[int]:
+        """按行扫描文本，复用会话缓存中未改变的行"""
+        if session_key is None:
+            return self._automaton.matches(text.lower())
+
+        previous = self._segment_cache.pop(session_key, {})
+        current: Dict[str, FrozenSet[int]] = {}
+        found = set()
+        for segment in text.split("\n"):
+            hits = current.get(segment)
+            if hits is None:
+                hits = previous.get(segment)
+                if hits is None:
+                    hits = self._automaton.matches(segment.lower())
+                current[segment] = hits
+            found.update(hits)
+
+        # 只保留本次文本中的分段，缓存大小随上下文窗口而非文档增长
+        self._segment_cache[session_key] = current
+        while len(self._segment_cache) > self.max_sessions:
+            self._segment_cache.popitem(last=False)
+        return frozenset(found)
+
+    def scores(self, text: str, session_key: Optional[str] = None) -> Dict[str, int]:
+        """
+        计算各类别命中的不同关键词数
+
+        参数:
+        - text: 文本
+        - session_key: 会话标识，提供时复用该会话上一次请求中未改变的行
+
+        返回:
+        - {类别: 得分}
+        """
+        counts = [0] * len(self.categories)
+        for pattern in self._matches(text, session_key) if text else ():
+            for category_index in self._pattern_categories[pattern]:
+                counts[category_index] += 1
+        return dict(zip(self.categories, counts))
+
+    def classify(self, text: str, session_key: Optional[str] = None) -> str:
+        """
+        判断上下文类型
+
+        参数:
+        - text: 文本
+        - session_key: 会话标识
+
+        返回:
+        - 得分最高的类别（得分相同时取靠前的类别）；没有命中任何关键词时返回 general
+        """
+        if not text:
+            return "general"
+        best_category, best_score = "general", 0
+        for category, score in self.scores(text, session_key).items():
+            if score > best_score:
+                best_category, best_score = category, score
+        return best_category
+
+    def release_session(self, session_key: str):
+        """释放会话的分段缓存"""
+        self._segment_cache.pop(session_key, None)
@@ -2,14 +2,29 @@
 上下文窗口管理服务
 用于管理文本补全时的上下文窗口，使用tiktoken进行准确的token计算
 """
+import re
 import tiktoken
-from typing import Dict, Tuple, Optional
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Optional
 from app.core.config import settings
 
+# 分段位置：换行符之后紧跟非空白字符处。tiktoken的预分词不会跨越这样的位置，
+# 因此各段分别编码再拼接，与整体编码的结果一致
+_SEGMENT_BOUNDARY = re.compile(r"(?<=\n)(?=\S)")
+
+# 句子结束位置：中文句末标点、换行，或后面跟着空白的英文句末标点
+_SENTENCE_END = re.compile(r"[。！？；!?;\n]+|[.](?=\s)")
+
 class ContextWindowManager:
     """上下文窗口管理器"""
     
-    def __init__(self, before_tokens: int = 1536, after_tokens: int = 256, model: str = None):
+    def __init__(
+        self,
+        before_tokens: int = 1536,
+        after_tokens: int = 256,
+        model: str = None,
+        max_sessions: int = 1024
+    ):
         """
         初始化上下文窗口管理器
         
@@ -17,10 +32,18 @@ class ContextWindowManager:
         - before_tokens: 上文窗口大小（token数）
         - after_tokens: 下文窗口大小（token数）
         - model: 使用的OpenAI模型名称，用于选择合适的编码器
+        - max_sessions: 最多缓存多少个会话的分段token
         """
         self.before_tokens = before_tokens
         self.after_tokens = after_tokens
         self.model = model or settings.OPENAI_MODEL
+        self.max_sessions = max_sessions
+        
+        # 观测到的平均每token字符数，用于估算需要切取的字符范围
+        self.chars_per_token = 2.0
+        
+        # 会话分段缓存: {session_key: {分段文本: tokens}}
+        self._segment_cache: "OrderedDict[str, Dict[str, List[int]]]" = OrderedDict()
         
         # 初始化tiktoken编码器
         try:
@@ -29,45 +52,107 @@ class ContextWindowManager:
             # 如果模型不支持，使用cl100k_base编码器（适用于大多数新模型）
             self.encoding = tiktoken.get_encoding("cl100k_base")
     
-    def get_context_window(self, text: str, cursor_position: int) -> Tuple[str, str]:
+    def get_context_window(self, text: str, cursor_position: int, session_key: Optional[str] = None) -> Tuple[str, str]:
         """
         获取当前光标位置的上下文窗口
         
+        只对光标附近按字符数截取的片段进行编码，片段不足窗口大小时才向外扩大
+        
         参数:
         - text: 完整文本
         - cursor_position: 光标位置（字符索引）
+        - session_key: 会话标识，提供时复用该会话上一次请求中未改变分段的tokens
         
         返回:
         - (上文, 下文)
         """
-        # 获取上文
-        before_text = text[:cursor_position]
-        before_tokens_count = self.count_tokens(before_text)
-        
-        # 如果超出上文窗口大小，需要截取
-        if before_tokens_count > self.before_tokens:
-            # 将文本编码为tokens
-            tokens = self.encoding.encode(before_text)
-            # 保留最后部分的tokens
-            tokens = tokens[-self.before_tokens:]
-            # 将tokens解码回文本
-            before_text = self.encoding.decode(tokens)
-        
-        # 获取下文
-        after_text = text[cursor_position:]
-        after_tokens_count = self.count_tokens(after_text)
-        
-        # 如果超出下文窗口大小，需要截取
-        if after_tokens_count > self.after_tokens:
-            # 将文本编码为tokens
-            tokens = self.encoding.encode(after_text)
-            # 保留前面部分的tokens
-            tokens = tokens[:self.after_tokens]
-            # 将tokens解码回文本
-            after_text = self.encoding.decode(tokens)
-        
+        cursor_position = max(0, min(cursor_position, len(text)))
+        before_text = self._window_before(text, cursor_position, session_key)
+        after_text = self._window_after(text, cursor_position)
         return before_text, after_text
     
+    def _estimate_chars(self, budget: int) -> int:
+        """根据平均每token字符数估算覆盖指定token数所需的字符数（留出余量）"""
+        return int(budget * self.chars_per_token * 1.25) + 16
+    
+    def _observe(self, chars: int, tokens: int):
+        """更新平均每token字符数（指数加权平均）"""
+        if chars > 0 and tokens > 0:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * (chars / tokens)
+    
+    def _window_before(self, text: str, cursor_position: int, session_key: Optional[str]) -> str:
+        """获取光标之前最多 before_tokens 个token的文本"""
+        chars = self._estimate_chars(self.before_tokens)
+        while True:
+            start = max(0, cursor_position - chars)
+            before_text = text[start:cursor_position]
+            tokens = self._encode_segments(before_text, session_key)
+            # 片段起点可能切断了一个token，因此需要多于预算的token才能确定窗口
+            if len(tokens) > self.before_tokens or start == 0:
+                break
+            chars *= 2
+        
+        self._observe(len(before_text), len(tokens))
+        
+        # 如果超出上文窗口大小，保留最后部分的tokens并解码回文本
+        if len(tokens) > self.before_tokens:
+            before_text = self.encoding.decode(tokens[-self.before_tokens:])
+        return before_text
+    
+    def _window_after(self, text: str, cursor_position: int) -> str:
+        """获取光标之后最多 after_tokens 个token的文本"""
+        chars = self._estimate_chars(self.after_tokens)
+        while True:
+            end = min(len(text), cursor_position + chars)
+            after_text = text[cursor_position:end]
+            tokens = self.encoding.encode(after_text, disallowed_special=())
+            if len(tokens) > self.after_tokens or end == len(text):
+                break
+            chars *= 2
+        
+        self._observe(len(after_text), len(tokens))
+        
+        # 如果超出下文窗口大小，保留前面部分的tokens并解码回文本
+        if len(tokens) > self.after_tokens:
+            after_text = self.encoding.decode(tokens[:self.after_tokens])
+        return after_text
+    
+    def _encode_segments(self, text: str, session_key: Optional[str]) -> List[int]:
+        """
+        按段落编码文本，复用会话缓存中未改变的分段
+        
+        参数:
+        - text: 要编码的文本
+        - session_key: 会话标识，为None时不使用缓存
+        
+        返回:
+        - token列表
+        """
+        if session_key is None:
+            return self.encoding.encode(text, disallowed_special=())
+        
+        previous = self._segment_cache.pop(session_key, {})
+        current: Dict[str, List[int]] = {}
+        tokens: List[int] = []
+        for segment in _SEGMENT_BOUNDARY.split(text):
+            segment_tokens = current.get(segment)
+            if segment_tokens is None:
+                segment_tokens = previous.get(segment)
+                if segment_tokens is None:
+                    segment_tokens = self.encoding.encode(segment, disallowed_special=())
+                current[segment] = segment_tokens
+            tokens.extend(segment_tokens)
+        
+        # 只保留本次窗口内的分段，缓存大小随窗口而非文档增长
+        self._segment_cache[session_key] = current
+        while len(self._segment_cache) > self.max_sessions:
+            self._segment_cache.popitem(last=False)
+        return tokens
+    
+    def release_session(self, session_key: str):
+        """释放会话的分段缓存"""
+        self._segment_cache.pop(session_key, None)
+    
     def count_tokens(self, text: str) -> int:
         """
         准确计算文本的token数量
@@ -81,6 +166,79 @@ class ContextWindowManager:
         if not text:
             return 0
             
-        # 使用tiktoken计算token数量
-        return len(self.encoding.encode(text))
+        # 使用tiktoken计算token数量；用户文本中的特殊token（如<|endoftext|>）按普通文本计数
+        return len(self.encoding.encode(text, disallowed_special=()))
+    
+    def trim_to_tokens(self, text: str, max_tokens: int, keep: str = "head") -> Tuple[str, int]:
+        """
+        将文本截断到不超过指定的token数，尽量在句子边界处截断
+        
+        参数:
+        - text: 文本
+        - max_tokens: 最大token数
+        - keep: 保留开头（head）还是结尾（tail）
+        
+        返回:
+        - (截断后的文本, token数)
+        """
+        if not text or max_tokens <= 0:
+            return "", 0
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text, len(tokens)
+        
+        if keep == "tail":
+            kept = self.encoding.decode(tokens[-max_tokens:]).lstrip("\ufffd")
+            # 丢弃开头不完整的句子，但至少保留一半内容
+            match = _SENTENCE_END.search(kept)
+            if match and match.end() <= len(kept) // 2:
+                kept = kept[match.end():].lstrip()
+        else:
+            kept = self.encoding.decode(tokens[:max_tokens]).rstrip("\ufffd")
+            # 丢弃结尾不完整的句子，但至少保留一半内容
+            ends = [match.end() for match in _SENTENCE_END.finditer(kept)]
+            if ends and ends[-1] >= len(kept) // 2:
+                kept = kept[:ends[-1]].rstrip()
+        return kept, len(self.encoding.encode(kept, disallowed_special=()))
     
+    def split_to_tokens(self, text: str, max_tokens: int) -> List[Tuple[int, int, int]]:
+        """
+        按句子边界把文本切分为不超过指定token数的片段，单个句子超出时按token切分
+        
+        参数:
+        - text: 文本
+        - max_tokens: 每个片段的最大token数
+        
+        返回:
+        - [(起始位置, 结束位置, token数)]，各片段首尾相接覆盖全文
+        """
+        max_tokens = max(1, max_tokens)
+        ends = [match.end() for match in _SENTENCE_END.finditer(text)]
+        if not ends or ends[-1] != len(text):
+            ends.append(len(text))
+        
+        spans: List[Tuple[int, int, int]] = []
+        span_start = 0
+        span_tokens = 0
+        start = 0
+        for end in ends:
+            tokens = len(self.encoding.encode(text[start:end], disallowed_special=()))
+            if span_tokens and span_tokens + tokens > max_tokens:
+                spans.append((span_start, start, span_tokens))
+                span_start = start
+                span_tokens = 0
+            if tokens > max_tokens:
+                # 单个句子超出：按token切分，余下部分与后面的句子合并
+                encoded = self.encoding.encode(text[start:end], disallowed_special=())
+                _, offsets = self.encoding.decode_with_offsets(encoded)
+                for index in range(max_tokens, len(encoded), max_tokens):
+                    cut = start + offsets[index]
+                    if cut > span_start:
+                        spans.append((span_start, cut, max_tokens))
+                        span_start = cut
+                tokens = len(encoded) - (len(encoded) - 1) // max_tokens * max_tokens
+            span_tokens += tokens
+            start = end
+        if span_start < len(text):
+            spans.append((span_start, len(text), span_tokens))
+        return spans
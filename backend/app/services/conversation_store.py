@@ -0,0 +1,447 @@
+"""
+对话存储服务
+按对话ID在服务端保存聊天记录，客户端每次只需发送新消息：
+- 内存中缓存最近使用的对话（LRU），持久化由可替换的后端提供（SQLite 或仅内存）
+- 未摘要的历史消息超过token预算后，在后台把较早的消息连同已有摘要压缩为新的滚动摘要，
+  提示词中只包含摘要和最近几轮对话，长度不随对话轮数增长
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.core.logger import logger
+
+
+class ConversationBackend:
+    """对话持久化后端接口，方法均为同步调用，由存储在线程池中执行"""
+
+    def load(self, conversation_id: str) -> Optional[Tuple[str, int, List[Dict[str, Any]]]]:
+        """
+        读取对话
+
+        参数:
+        - conversation_id: 对话ID
+
+        返回:
+        - (摘要, 摘要覆盖到的消息序号, 序号更大的消息列表)；对话不存在时返回None
+        """
+        return None
+
+    def history(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """读取对话的全部消息（包括已被摘要的消息）"""
+        return []
+
+    def append(self, conversation_id: str, messages: List[Dict[str, Any]]) -> Optional[int]:
+        """
+        追加消息，由后端分配序号
+
+        参数:
+        - conversation_id: 对话ID
+        - messages: 消息列表（role、content）
+
+        返回:
+        - 第一条消息的序号，其余消息依次递增；不持久化的后端返回None，由调用方分配
+        """
+        return None
+
+    def save_summary(self, conversation_id: str, summary: str, summary_seq: int):
+        """保存滚动摘要"""
+
+    def delete(self, conversation_id: str):
+        """删除对话"""
+
+    def close(self):
+        """关闭后端"""
+
+
+class SQLiteConversationBackend(ConversationBackend):
+    """SQLite持久化后端：消息只追加，序号在事务中分配，多个进程写入同一对话时不会互相覆盖"""
+
+    def __init__(self, path: str):
+        """
+        初始化SQLite后端
+
+        参数:
+        - path: 数据库文件路径
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_messages ("
+            "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (conversation_id, seq))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_summaries ("
+            "conversation_id TEXT PRIMARY KEY, summary TEXT NOT NULL, "
+            "summary_seq INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def load(self, conversation_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary, summary_seq FROM chat_summaries WHERE conversation_id = ?",
+                (conversation_id,)
+            ).fetchone()
+            summary, summary_seq = row if row else ("", 0)
+            rows = self._db.execute(
+                "SELECT seq, role, content FROM chat_messages WHERE conversation_id = ? AND seq > ? ORDER BY seq",
+                (conversation_id, summary_seq)
+            ).fetchall()
+            if row is None and not rows:
+                exists = self._db.execute(
+                    "SELECT 1 FROM chat_messages WHERE conversation_id = ? LIMIT 1",
+                    (conversation_id,)
+                ).fetchone()
+                if exists is None:
+                    return None
+        return summary, summary_seq, [{"seq": seq, "role": role, "content": content} for seq, role, content in rows]
+
+    def history(self, conversation_id):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, content, created_at FROM chat_messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,)
+            ).fetchall()
+        return [{"role": role, "content": content, "created_at": created_at} for role, content, created_at in rows]
+
+    def append(self, conversation_id, messages):
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE 先取得写锁，读取最大序号和写入之间不会有其他进程插入
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                first_seq = self._db.execute(
+                    "SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_messages WHERE conversation_id = ?",
+                    (conversation_id,)
+                ).fetchone()[0]
+                self._db.executemany(
+                    "INSERT INTO chat_messages (conversation_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (conversation_id, first_seq + offset, message["role"], message["content"], now)
+                        for offset, message in enumerate(messages)
+                    ]
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return first_seq
+
+    def save_summary(self, conversation_id, summary, summary_seq):
+        with self._lock:
+            # 只保存覆盖范围更大的摘要，不用较旧的摘要覆盖其他进程的结果
+            self._db.execute(
+                "INSERT INTO chat_summaries (conversation_id, summary, summary_seq, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (conversation_id) DO UPDATE SET summary = excluded.summary, "
+                "summary_seq = excluded.summary_seq, updated_at = excluded.updated_at "
+                "WHERE excluded.summary_seq > chat_summaries.summary_seq",
+                (conversation_id, summary, summary_seq, time.time())
+            )
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._db.execute("DELETE FROM chat_messages WHERE conversation_id = ?", (conversation_id,))
+            self._db.execute("DELETE FROM chat_summaries WHERE conversation_id = ?", (conversation_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_backend(kind: str, path: str) -> ConversationBackend:
+    """
+    根据配置创建持久化后端，SQLite不可用时只保存在内存中
+
+    参数:
+    - kind: 后端类型，sqlite 或 memory
+    - path: SQLite数据库文件路径
+
+    返回:
+    - 持久化后端实例
+    """
+    if kind == "sqlite":
+        try:
+            return SQLiteConversationBackend(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.error({
+                "message": "SQLite对话存储不可用，对话只保存在内存中",
+                "error": str(e)
+            })
+    return ConversationBackend()
+
+
+class Conversation:
+    """一个对话：滚动摘要 + 尚未被摘要的消息"""
+
+    __slots__ = ("id", "summary", "summary_seq", "turns", "next_seq", "compacting", "lock")
+
+    def __init__(self, conversation_id: str, summary: str = "", summary_seq: int = 0):
+        self.id = conversation_id
+        self.summary = summary
+        self.summary_seq = summary_seq
+        # 未被摘要的消息: [{"seq", "role", "content", "tokens"}]
+        self.turns: List[Dict[str, Any]] = []
+        self.next_seq = summary_seq + 1
+        self.compacting = False
+        # 同一对话的请求依次处理，保证消息顺序与对话轮次一致
+        self.lock = asyncio.Lock()
+
+    def messages(self) -> List[Dict[str, str]]:
+        """未被摘要的历史消息（OpenAI消息格式）"""
+        return [{"role": turn["role"], "content": turn["content"]} for turn in self.turns]
+
+    def pending_tokens(self) -> int:
+        """未被摘要的历史消息的token数"""
+        return sum(turn["tokens"] for turn in self.turns)
+
+
+class ConversationStore:
+    """对话存储：内存LRU缓存 + 持久化后端 + 后台滚动摘要"""
+
+    def __init__(
+        self,
+        backend: ConversationBackend,
+        count_tokens: Callable[[str], int],
+        summarize: Optional[Callable[[str, List[Dict[str, str]]], Awaitable[str]]] = None,
+        compact_tokens: int = 1536,
+        keep_messages: int = 4,
+        max_conversations: int = 1024
+    ):
+        """
+        初始化对话存储
+
+        参数:
+        - backend: 持久化后端
+        - count_tokens: token计数函数
+        - summarize: 摘要函数 (已有摘要, 待压缩的消息) -> 新摘要；为空时不压缩
+        - compact_tokens: 未摘要的消息超过该token数时触发压缩
+        - keep_messages: 压缩时保留原文的最近消息条数
+        - max_conversations: 内存中最多缓存的对话数
+        """
+        self.backend = backend
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.compact_tokens = compact_tokens
+        self.keep_messages = keep_messages
+        self.max_conversations = max_conversations
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _cache(self, conversation: Conversation):
+        self._conversations[conversation.id] = conversation
+        self._conversations.move_to_end(conversation.id)
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+
+    async def get(self, conversation_id: str) -> Optional[Conversation]:
+        """
+        获取对话，内存中没有时从持久化后端加载
+
+        参数:
+        - conversation_id: 对话ID
+
+        返回:
+        - 对话；不存在时返回None
+        """
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            self._conversations.move_to_end(conversation_id)
+            return conversation
+
+        loaded = await asyncio.to_thread(self.backend.load, conversation_id)
+        if loaded is None:
+            return None
+        # 加载期间可能已有并发请求创建了同一对话
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            return conversation
+
+        conversation = Conversation(conversation_id)
+        self._apply(conversation, loaded)
+        self._cache(conversation)
+        self._maybe_compact(conversation)
+        return conversation
+
+    def _apply(self, conversation: Conversation, loaded: Tuple[str, int, List[Dict[str, Any]]]):
+        """用持久化后端中的摘要和消息替换对话的内存状态"""
+        summary, summary_seq, rows = loaded
+        for row in rows:
+            row["tokens"] = self.count_tokens(row["content"])
+        conversation.summary = summary
+        conversation.summary_seq = summary_seq
+        conversation.turns = rows
+        conversation.next_seq = rows[-1]["seq"] + 1 if rows else summary_seq + 1
+
+    async def create(
+        self,
+        conversation_id: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None
+    ) -> Conversation:
+        """
+        创建对话
+
+        参数:
+        - conversation_id: 对话ID，为空时自动生成
+        - history: 客户端提供的已有历史消息
+
+        返回:
+        - 新对话
+        """
+        conversation = Conversation(conversation_id or uuid.uuid4().hex)
+        self._cache(conversation)
+        if history:
+            await self.append(conversation, history)
+        return conversation
+
+    async def get_or_create(
+        self,
+        conversation_id: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None
+    ) -> Conversation:
+        """
+        获取对话；未提供ID或对话已不存在（过期、服务端重启）时创建
+
+        参数:
+        - conversation_id: 对话ID
+        - history: 创建对话时使用的初始历史
+
+        返回:
+        - 对话
+        """
+        conversation = await self.get(conversation_id) if conversation_id else None
+        if conversation is None:
+            conversation = await self.create(conversation_id, history)
+        return conversation
+
+    async def append(self, conversation: Conversation, messages: List[Dict[str, str]]):
+        """
+        追加消息并持久化，超出预算时在后台压缩
+
+        参数:
+        - conversation: 对话
+        - messages: 消息列表（OpenAI消息格式）
+        """
+        rows = [{"role": message["role"], "content": message["content"]} for message in messages]
+        first_seq = await asyncio.to_thread(self.backend.append, conversation.id, rows)
+        if first_seq is None:
+            first_seq = conversation.next_seq
+        loaded = None
+        if first_seq != conversation.next_seq:
+            # 其他进程在此期间向同一对话写入了消息，重新加载以包含这些消息
+            loaded = await asyncio.to_thread(self.backend.load, conversation.id)
+        if loaded is not None:
+            self._apply(conversation, loaded)
+        else:
+            for seq, row in enumerate(rows, start=first_seq):
+                row["seq"] = seq
+                row["tokens"] = self.count_tokens(row["content"])
+            conversation.turns.extend(rows)
+            conversation.next_seq = first_seq + len(rows)
+        self._cache(conversation)
+        self._maybe_compact(conversation)
+
+    async def history(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """
+        获取对话的全部消息
+
+        参数:
+        - conversation_id: 对话ID
+
+        返回:
+        - 消息列表；后端不持久化时返回内存中尚未被摘要的消息
+        """
+        rows = await asyncio.to_thread(self.backend.history, conversation_id)
+        if rows:
+            return rows
+        conversation = self._conversations.get(conversation_id)
+        return [{"role": turn["role"], "content": turn["content"]} for turn in conversation.turns] if conversation else []
+
+    async def delete(self, conversation_id: str):
+        """
+        删除对话
+
+        参数:
+        - conversation_id: 对话ID
+        """
+        task = self._tasks.pop(conversation_id, None)
+        if task is not None:
+            task.cancel()
+        self._conversations.pop(conversation_id, None)
+        await asyncio.to_thread(self.backend.delete, conversation_id)
+
+    def _maybe_compact(self, conversation: Conversation):
+        """未摘要的消息超过预算时启动后台压缩（同一对话同时只有一个压缩任务）"""
+        if (
+            self.summarize is None
+            or conversation.compacting
+            or len(conversation.turns) <= self.keep_messages
+            or conversation.pending_tokens() <= self.compact_tokens
+        ):
+            return
+        conversation.compacting = True
+        self._tasks[conversation.id] = asyncio.create_task(self._compact(conversation))
+
+    async def _compact(self, conversation: Conversation):
+        """把较早的消息连同已有摘要压缩为新摘要，保留最近几条消息的原文"""
+        start_time = time.time()
+        count = len(conversation.turns) - self.keep_messages
+        # 保留的部分需要以用户消息开头
+        while count > 0 and conversation.turns[count]["role"] != "user":
+            count -= 1
+        older = conversation.turns[:count]
+        try:
+            if not older:
+                return
+            summary = await self.summarize(
+                conversation.summary,
+                [{"role": turn["role"], "content": turn["content"]} for turn in older]
+            )
+            if not summary:
+                return
+            summary_seq = older[-1]["seq"]
+            await asyncio.to_thread(self.backend.save_summary, conversation.id, summary, summary_seq)
+
+            # 压缩期间追加或重新加载的消息按序号保留
+            if summary_seq > conversation.summary_seq:
+                conversation.summary = summary
+                conversation.summary_seq = summary_seq
+                conversation.turns = [turn for turn in conversation.turns if turn["seq"] > summary_seq]
+            logger.info({
+                "message": "对话历史已压缩",
+                "conversation_id": conversation.id,
+                "compacted_messages": count,
+                "remaining_messages": len(conversation.turns),
+                "summary_length": len(summary),
+                "duration_seconds": time.time() - start_time
+            })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 压缩失败不影响对话，下次追加消息时重试
+            logger.error({
+                "message": "对话历史压缩失败",
+                "conversation_id": conversation.id,
+                "error_type": type(e).__name__,
+                "error": str(e)
+            })
+        finally:
+            conversation.compacting = False
+            self._tasks.pop(conversation.id, None)
+
+    async def close(self):
+        """取消后台压缩任务并关闭持久化后端"""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self.backend.close()
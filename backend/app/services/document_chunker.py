@@ -0,0 +1,172 @@
+"""
+长文本分段服务
+在段落边界（段落过长时在句子边界）把长文本切分为不超过token预算的片段，
+每个片段附带少量前后文供模型衔接，片段之间的空白原样保留，处理结果按顺序拼接即可还原文档结构
+"""
+import re
+from typing import Any, Iterator, List, Optional, Tuple
+
+from app.services.context_window import ContextWindowManager
+
+# 段落分隔：中间只有空白的两个换行
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+# 截取前后文时每个token最多对应的字符数
+_CONTEXT_CHARS_PER_TOKEN = 8
+
+
+class TextChunk:
+    """长文本中的一个片段"""
+
+    __slots__ = ("index", "text", "tokens", "before", "after", "separator", "segments", "cached")
+
+    def __init__(
+        self,
+        index: int,
+        text: str,
+        tokens: int,
+        before: str,
+        after: str,
+        separator: str,
+        segments: Optional[List[str]] = None,
+        cached: Optional[str] = None
+    ):
+        """
+        初始化片段
+
+        参数:
+        - index: 片段序号
+        - text: 片段文本（不含首尾空白）
+        - tokens: 片段的token数
+        - before: 片段之前的原文（供衔接参考）
+        - after: 片段之后的原文（供衔接参考）
+        - separator: 片段与下一个片段之间的原始空白
+        - segments: 片段包含的段落原文
+        - cached: 片段的已有结果（如翻译记忆中的译文），有结果时不需要调用上游
+        """
+        self.index = index
+        self.text = text
+        self.tokens = tokens
+        self.before = before
+        self.after = after
+        self.separator = separator
+        self.segments = segments or [text]
+        self.cached = cached
+
+
+class DocumentChunker:
+    """按token预算切分长文本"""
+
+    def __init__(self, manager: ContextWindowManager, chunk_tokens: int = 800, context_tokens: int = 128):
+        """
+        初始化分段器
+
+        参数:
+        - manager: 上下文窗口管理器，用于计数和切分
+        - chunk_tokens: 每个片段的最大token数
+        - context_tokens: 每个片段附带的前文和后文的token数
+        """
+        self.manager = manager
+        self.chunk_tokens = chunk_tokens
+        self.context_tokens = context_tokens
+
+    def segments(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        把文本切分为段落，超出单段token数的段落再按句子切分
+
+        参数:
+        - text: 文本
+
+        返回:
+        - [(起始位置, 结束位置, token数)]，不含首尾空白，按文档顺序排列
+        """
+        units: List[Tuple[int, int, int]] = []
+        for start, end in self._paragraphs(text):
+            tokens = self.manager.count_tokens(text[start:end])
+            if tokens > self.chunk_tokens:
+                units.extend(
+                    (start + span_start, start + span_end, span_tokens)
+                    for span_start, span_end, span_tokens in self.manager.split_to_tokens(text[start:end], self.chunk_tokens)
+                )
+            else:
+                units.append((start, end, tokens))
+
+        segments = []
+        for start, end, tokens in units:
+            segment = text[start:end]
+            start, end = start + len(segment) - len(segment.lstrip()), start + len(segment.rstrip())
+            if end > start:
+                segments.append((start, end, tokens))
+        return segments
+
+    def split(
+        self,
+        text: str,
+        segments: Optional[List[Tuple[int, int, int]]] = None,
+        cached: Optional[List[Optional[str]]] = None
+    ) -> List[TextChunk]:
+        """
+        切分文本：相邻的段落合并到同一个片段，直到填满单段token数
+
+        参数:
+        - text: 文本
+        - segments: segments() 的结果，为空时重新切分
+        - cached: 与段落一一对应的已有结果，有结果的段落单独成为一个片段，不与其他段落合并
+
+        返回:
+        - 按文档顺序排列的片段；文本不超过单段token数时只有一个片段
+        """
+        if segments is None:
+            segments = self.segments(text)
+        cached = cached or [None] * len(segments)
+
+        # 每组: [起始位置, 结束位置, token数, 段落列表, 已有结果]
+        groups: List[List[Any]] = []
+        for (start, end, tokens), result in zip(segments, cached):
+            if (
+                result is None
+                and groups
+                and groups[-1][4] is None
+                and groups[-1][2] + tokens <= self.chunk_tokens
+            ):
+                groups[-1][1] = end
+                groups[-1][2] += tokens
+                groups[-1][3].append(text[start:end])
+            else:
+                groups.append([start, end, tokens, [text[start:end]], result])
+
+        chunks = []
+        for index, (start, end, tokens, group_segments, result) in enumerate(groups):
+            next_start = groups[index + 1][0] if index + 1 < len(groups) else end
+            chunks.append(TextChunk(
+                index=index,
+                text=text[start:end],
+                tokens=tokens,
+                before=self._context(text, start, "tail") if index else "",
+                after=self._context(text, next_start, "head") if index + 1 < len(groups) else "",
+                separator=text[end:next_start],
+                segments=group_segments,
+                cached=result
+            ))
+        return chunks
+
+    def _paragraphs(self, text: str) -> Iterator[Tuple[int, int]]:
+        """段落的 (起始位置, 结束位置)，段落之间的空白归入前一个段落"""
+        start = 0
+        for match in _PARAGRAPH_BREAK.finditer(text):
+            yield start, match.end()
+            start = match.end()
+        if start < len(text):
+            yield start, len(text)
+
+    def _context(self, text: str, position: int, keep: str) -> str:
+        """截取位置之前（tail）或之后（head）不超过 context_tokens 的原文"""
+        if self.context_tokens <= 0:
+            return ""
+        chars = self.context_tokens * _CONTEXT_CHARS_PER_TOKEN
+        if keep == "tail":
+            segment = text[max(0, position - chars):position]
+        else:
+            segment = text[position:position + chars]
+        context, _ = self.manager.trim_to_tokens(segment.strip(), self.context_tokens, keep)
+        return context
@@ -0,0 +1,300 @@
+"""
+文档会话服务
+为WebSocket连接维护服务端文档副本（片段表），客户端只需发送增量编辑操作
+"""
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.logger import logger
+
+
+class DocumentSyncError(ValueError):
+    """文档同步错误（版本不一致、操作越界等），客户端需要重新发送全文"""
+
+    def __init__(self, message: str, document_id: Optional[str] = None, expected_version: Optional[int] = None):
+        super().__init__(message)
+        self.document_id = document_id
+        self.expected_version = expected_version
+
+
+def utf16_length(text: str) -> int:
+    """文本的UTF-16码元数（与JavaScript字符串的 length 一致，BMP以外的字符计为2）"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class PieceTable:
+    """
+    片段表
+    文本由若干 (源字符串, 起始偏移, 字符数, UTF-16码元数) 片段按顺序拼接而成，
+    插入和删除只修改片段列表，不复制整篇文档。
+    编辑位置按UTF-16码元计算（与浏览器中的字符串下标一致），读取位置按字符计算
+    """
+
+    __slots__ = ("_pieces", "_length", "_units", "_cache", "max_pieces")
+
+    def __init__(self, text: str = "", max_pieces: int = 512):
+        """
+        初始化片段表
+
+        参数:
+        - text: 初始文本
+        - max_pieces: 片段数量上限，超过后自动合并为单一片段
+        """
+        self._pieces: List[Tuple[str, int, int, int]] = [(text, 0, len(text), utf16_length(text))] if text else []
+        self._length = len(text)
+        self._units = utf16_length(text)
+        self._cache: Optional[str] = text
+        self.max_pieces = max_pieces
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def utf16_length(self) -> int:
+        """文本的UTF-16码元数"""
+        return self._units
+
+    def _locate(self, pos: int) -> Tuple[int, int]:
+        """
+        查找UTF-16位置所在的片段
+
+        返回:
+        - (片段索引, 片段内UTF-16偏移)；位置位于末尾时返回 (片段数, 0)
+        """
+        offset = 0
+        for index, (_, _, _, units) in enumerate(self._pieces):
+            if pos < offset + units:
+                return index, pos - offset
+            offset += units
+        return len(self._pieces), 0
+
+    def _split(self, pos: int) -> int:
+        """在指定UTF-16位置切分片段，返回切分点之后第一个片段的索引"""
+        index, inner_units = self._locate(pos)
+        if inner_units == 0:
+            return index
+        source, start, length, units = self._pieces[index]
+        if units == length:
+            # 片段中没有BMP以外的字符，码元偏移即字符偏移
+            inner = inner_units
+        else:
+            try:
+                inner = len(source[start:start + length].encode("utf-16-le")[:inner_units * 2].decode("utf-16-le"))
+            except UnicodeDecodeError:
+                raise IndexError(f"位置位于代理对中间: {pos}")
+        self._pieces[index:index + 1] = [
+            (source, start, inner, inner_units),
+            (source, start + inner, length - inner, units - inner_units)
+        ]
+        return index + 1
+
+    def insert(self, pos: int, text: str):
+        """在指定UTF-16位置插入文本"""
+        if pos < 0 or pos > self._units:
+            raise IndexError(f"插入位置越界: {pos}")
+        if not text:
+            return
+        index = self._split(pos)
+        units = utf16_length(text)
+        self._pieces.insert(index, (text, 0, len(text), units))
+        self._length += len(text)
+        self._units += units
+        self._cache = None
+        self._maybe_compact()
+
+    def delete(self, pos: int, length: int):
+        """删除从指定UTF-16位置开始的若干码元"""
+        if length < 0 or pos < 0 or pos + length > self._units:
+            raise IndexError(f"删除范围越界: {pos}+{length}")
+        if length == 0:
+            return
+        start_index = self._split(pos)
+        end_index = self._split(pos + length)
+        self._length -= sum(piece[2] for piece in self._pieces[start_index:end_index])
+        self._units -= length
+        del self._pieces[start_index:end_index]
+        self._cache = None
+        self._maybe_compact()
+
+    def slice(self, start: int, end: int) -> str:
+        """
+        获取 [start, end) 范围内的文本，只拼接涉及的片段
+
+        参数:
+        - start: 起始字符位置
+        - end: 结束字符位置（不包含）
+
+        返回:
+        - 对应范围的文本
+        """
+        start = max(0, start)
+        end = min(self._length, end)
+        if start >= end:
+            return ""
+        if self._cache is not None:
+            return self._cache[start:end]
+
+        parts = []
+        offset = 0
+        for source, piece_start, length, _ in self._pieces:
+            piece_end = offset + length
+            if piece_end > start:
+                lo = max(start, offset) - offset
+                hi = min(end, piece_end) - offset
+                parts.append(source[piece_start + lo:piece_start + hi])
+            if piece_end >= end:
+                break
+            offset = piece_end
+        return "".join(parts)
+
+    def text(self) -> str:
+        """获取完整文本（结果会被缓存，直到下一次编辑）"""
+        if self._cache is None:
+            self._cache = "".join(source[start:start + length] for source, start, length, _ in self._pieces)
+        return self._cache
+
+    def _maybe_compact(self):
+        """片段过多时合并为单一片段，避免定位开销随编辑次数增长"""
+        if len(self._pieces) > self.max_pieces:
+            text = self.text()
+            self._pieces = [(text, 0, len(text), self._units)] if text else []
+
+
+class DocumentSession:
+    """单个文档的服务端会话"""
+
+    __slots__ = ("document_id", "version", "table", "last_access")
+
+    def __init__(self, document_id: str, text: str = "", version: int = 0):
+        self.document_id = document_id
+        self.version = version
+        self.table = PieceTable(text)
+        self.last_access = time.time()
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def text(self) -> str:
+        """获取完整文档文本"""
+        return self.table.text()
+
+    def slice(self, start: int, end: int) -> str:
+        """获取文档的部分文本"""
+        return self.table.slice(start, end)
+
+    def apply_ops(self, ops: List[Dict[str, Any]], base_version: int, version: Optional[int] = None):
+        """
+        应用一组编辑操作
+
+        参数:
+        - ops: 操作列表，如 {"op": "insert", "pos": 10, "text": "..."} 或 {"op": "delete", "pos": 10, "length": 3}，
+          pos 和 length 为UTF-16码元数（即浏览器中JavaScript字符串的下标和长度）
+        - base_version: 客户端生成这些操作时所基于的版本号
+        - version: 应用后的新版本号（不提供时为 base_version + 1）
+        """
+        if base_version != self.version:
+            raise DocumentSyncError(
+                f"文档版本不一致: 服务端为{self.version}，客户端基于{base_version}",
+                self.document_id,
+                self.version
+            )
+
+        # 先校验全部操作类型，避免未知操作导致部分应用
+        for op in ops:
+            if op.get("op") not in ("insert", "delete"):
+                raise DocumentSyncError(f"未知的编辑操作: {op.get('op')}", self.document_id, self.version)
+
+        try:
+            for op in ops:
+                pos = int(op.get("pos", 0))
+                if op["op"] == "insert":
+                    self.table.insert(pos, str(op.get("text", "")))
+                else:
+                    self.table.delete(pos, int(op.get("length", 0)))
+        except (IndexError, TypeError, ValueError) as e:
+            # 文档状态已不可信，要求客户端重新同步
+            self.version = -1
+            raise DocumentSyncError(f"编辑操作无效: {str(e)}", self.document_id, self.version)
+
+        self.version = version if version is not None else base_version + 1
+        self.last_access = time.time()
+
+
+class DocumentSessionStore:
+    """按 (连接ID, 文档ID) 管理文档会话"""
+
+    def __init__(self, max_documents_per_connection: int = 8, max_document_length: int = 1_000_000):
+        """
+        初始化文档会话存储
+
+        参数:
+        - max_documents_per_connection: 每个连接最多同时打开的文档数
+        - max_document_length: 单个文档的最大字符数
+        """
+        self.max_documents_per_connection = max_documents_per_connection
+        self.max_document_length = max_document_length
+        self.sessions: Dict[str, Dict[str, DocumentSession]] = {}
+
+    def open(self, connection_id: str, document_id: str, text: str, version: int = 0) -> DocumentSession:
+        """
+        打开（或重置）文档会话，客户端首次连接或需要重新同步时发送全文
+
+        返回:
+        - 文档会话
+        """
+        if len(text) > self.max_document_length:
+            raise DocumentSyncError(f"文档过长: {len(text)}字符", document_id)
+
+        documents = self.sessions.setdefault(connection_id, {})
+        if document_id not in documents and len(documents) >= self.max_documents_per_connection:
+            # 淘汰最久未使用的文档
+            oldest_id = min(documents, key=lambda doc_id: documents[doc_id].last_access)
+            del documents[oldest_id]
+
+        session = DocumentSession(document_id, text, version)
+        documents[document_id] = session
+
+        logger.info({
+            "message": "文档会话已打开",
+            "connection_id": connection_id,
+            "document_id": document_id,
+            "version": version,
+            "text_length": len(text)
+        })
+        return session
+
+    def get(self, connection_id: str, document_id: str) -> DocumentSession:
+        """获取文档会话，不存在时抛出 DocumentSyncError"""
+        session = self.sessions.get(connection_id, {}).get(document_id)
+        if session is None:
+            raise DocumentSyncError(f"文档会话不存在: {document_id}", document_id)
+        session.last_access = time.time()
+        return session
+
+    def apply_delta(
+        self,
+        connection_id: str,
+        document_id: str,
+        ops: List[Dict[str, Any]],
+        base_version: int,
+        version: Optional[int] = None
+    ) -> DocumentSession:
+        """对文档会话应用增量编辑"""
+        session = self.get(connection_id, document_id)
+        session.apply_ops(ops, base_version, version)
+        if len(session) > self.max_document_length:
+            self.close(connection_id, document_id)
+            raise DocumentSyncError(f"文档过长: {len(session)}字符", document_id)
+        return session
+
+    def close(self, connection_id: str, document_id: str):
+        """关闭单个文档会话"""
+        self.sessions.get(connection_id, {}).pop(document_id, None)
+
+    def close_connection(self, connection_id: str):
+        """关闭连接的全部文档会话"""
+        self.sessions.pop(connection_id, None)
+
+
+# 创建全局文档会话存储实例
+document_sessions = DocumentSessionStore()
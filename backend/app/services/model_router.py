@@ -0,0 +1,199 @@
+"""
+模型路由服务
+按操作类型（补全按上下文类型细分）选择模型和生成参数：
+按键路径上的补全使用小而快的模型，只在质量值得等待的操作上使用大模型，
+上游负载过高时可回退到快速档位的模型
+"""
+import json
+from typing import Any, Callable, Dict, Optional
+
+from app.core.logger import logger
+
+
+class ModelProfile:
+    """一个操作的上游调用参数"""
+
+    __slots__ = ("model", "max_tokens", "temperature", "timeout", "fallback_model", "context_limit")
+
+    def __init__(
+        self,
+        model: str,
+        max_tokens: int,
+        temperature: Optional[float] = None,
+        timeout: float = 60.0,
+        fallback_model: Optional[str] = None,
+        context_limit: Optional[int] = None
+    ):
+        """
+        初始化调用参数
+
+        参数:
+        - model: 模型名称
+        - max_tokens: 最大生成token数
+        - temperature: 默认生成温度（请求中提供温度时以请求为准）
+        - timeout: 单次上游请求的超时时间（秒）
+        - fallback_model: 上游负载过高时改用的快速模型
+        - context_limit: 模型的上下文长度（token数），为空时使用全局默认值
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.fallback_model = fallback_model
+        self.context_limit = context_limit
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ResolvedRoute:
+    """一次请求实际使用的模型和参数"""
+
+    __slots__ = ("model", "max_tokens", "temperature", "timeout", "degraded", "context_limit")
+
+    def __init__(
+        self,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        timeout: float,
+        degraded: bool,
+        context_limit: int
+    ):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.degraded = degraded
+        self.context_limit = context_limit
+
+
+def default_routes(fast_model: str, quality_model: str) -> Dict[str, ModelProfile]:
+    """
+    默认路由表
+
+    参数:
+    - fast_model: 快速档位模型
+    - quality_model: 质量档位模型
+
+    返回:
+    - {路由键: 调用参数}，补全的路由键为 completion:<上下文类型>
+    """
+    fallback = fast_model if quality_model != fast_model else None
+    # 补全的max_tokens是上限，未指定时按后处理的最大长度推算
+    return {
+        "completion": ModelProfile(fast_model, 128, 0.6, timeout=10.0),
+        "completion:academic": ModelProfile(fast_model, 128, 0.5, timeout=10.0),
+        "completion:technical": ModelProfile(fast_model, 128, 0.4, timeout=10.0),
+        "completion:narrative": ModelProfile(fast_model, 160, 0.8, timeout=10.0),
+        "completion:general": ModelProfile(fast_model, 128, 0.6, timeout=10.0),
+        "rewrite": ModelProfile(quality_model, 300, 0.7, timeout=30.0, fallback_model=fallback),
+        "simplify": ModelProfile(fast_model, 300, 0.5, timeout=30.0),
+        "expand": ModelProfile(quality_model, 500, 0.7, timeout=60.0, fallback_model=fallback),
+        "translate": ModelProfile(quality_model, 300, 0.3, timeout=60.0, fallback_model=fallback),
+        "chat": ModelProfile(quality_model, 500, 0.7, timeout=60.0, fallback_model=fallback),
+        "summarize": ModelProfile(fast_model, 400, 0.3, timeout=60.0),
+        "structure": ModelProfile(quality_model, 2000, 0.7, timeout=90.0, fallback_model=fallback),
+        "outline": ModelProfile(quality_model, 1500, 0.6, timeout=90.0, fallback_model=fallback)
+    }
+
+
+class ModelRouter:
+    """按操作类型选择模型和生成参数的路由表"""
+
+    def __init__(
+        self,
+        routes: Dict[str, ModelProfile],
+        under_load: Optional[Callable[[], bool]] = None,
+        default_context_limit: int = 8192
+    ):
+        """
+        初始化模型路由
+
+        参数:
+        - routes: 路由表
+        - under_load: 判断上游是否处于高负载的回调，高负载时使用 fallback_model
+        - default_context_limit: 未单独配置时模型的上下文长度（token数）
+        """
+        self.routes = routes
+        self.under_load = under_load
+        self.default_context_limit = default_context_limit
+
+    @classmethod
+    def from_settings(cls, settings: Any, under_load: Optional[Callable[[], bool]] = None) -> "ModelRouter":
+        """
+        根据配置创建模型路由，MODEL_ROUTES（JSON）中的字段覆盖默认路由表
+
+        参数:
+        - settings: 全局配置
+        - under_load: 判断上游是否处于高负载的回调
+        """
+        routes = default_routes(
+            settings.OPENAI_FAST_MODEL or settings.OPENAI_MODEL,
+            settings.OPENAI_QUALITY_MODEL or settings.OPENAI_MODEL
+        )
+        if settings.MODEL_ROUTES:
+            try:
+                overrides = json.loads(settings.MODEL_ROUTES)
+                for key, fields in overrides.items():
+                    base = routes.get(key) or routes.get(key.split(":")[0]) or routes["completion"]
+                    routes[key] = ModelProfile(**{**base.to_dict(), **fields})
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error({
+                    "message": "MODEL_ROUTES 配置无效，使用默认路由表",
+                    "error": str(e)
+                })
+        return cls(routes, under_load, settings.MODEL_CONTEXT_TOKENS)
+
+    def profile(self, action: str, context_type: Optional[str] = None) -> ModelProfile:
+        """
+        获取操作的调用参数
+
+        参数:
+        - action: 操作类型（completion/rewrite/expand/simplify/translate/chat/summarize/structure/outline）
+        - context_type: 补全的上下文类型
+
+        返回:
+        - 调用参数；未配置的补全上下文类型使用 completion，未配置的操作使用 chat
+        """
+        if context_type:
+            profile = self.routes.get(f"{action}:{context_type}")
+            if profile is not None:
+                return profile
+        return self.routes.get(action) or self.routes["chat"]
+
+    def resolve(
+        self,
+        action: str,
+        context_type: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None
+    ) -> ResolvedRoute:
+        """
+        解析一次请求实际使用的模型和参数
+
+        参数:
+        - action: 操作类型
+        - context_type: 补全的上下文类型
+        - max_tokens: 请求指定的最大生成token数（为空时使用路由表）
+        - temperature: 请求指定的温度（为空时使用路由表）
+
+        返回:
+        - 实际使用的调用参数
+        """
+        profile = self.profile(action, context_type)
+        model = profile.model
+        degraded = False
+        if profile.fallback_model and self.under_load is not None and self.under_load():
+            model = profile.fallback_model
+            degraded = True
+        return ResolvedRoute(
+            model=model,
+            max_tokens=max_tokens or profile.max_tokens,
+            temperature=temperature if temperature is not None else (
+                profile.temperature if profile.temperature is not None else 0.7
+            ),
+            timeout=profile.timeout,
+            degraded=degraded,
+            context_limit=profile.context_limit or self.default_context_limit
+        )
@@ -5,7 +5,8 @@ OpenAI API集成服务
 import os
 import asyncio
 import time
-from typing import List, Dict, Any, Optional, AsyncGenerator
+from contextlib import aclosing
+from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple
 import openai
 from openai import AsyncOpenAI
 from tenacity import (
@@ -19,12 +20,68 @@ from tenacity import (
 from app.core.config import settings
 from app.core.logger import logger
 from app.services.context_window import ContextWindowManager
+from app.services.context_classifier import ContextClassifier
+from app.services.request_coalescer import request_coalescer
+from app.services.upstream_governor import UpstreamGovernor, GovernedStream
+from app.services.upstream_pool import UpstreamPool, UpstreamEndpoint
+from app.services.model_router import ModelRouter
+from app.services.prompt_builder import PromptLibrary, CHAT_SUMMARY_TEMPLATE
+from app.services.context_budget import ContextBudgetAllocator
+from app.services.document_chunker import DocumentChunker, TextChunk
+from app.services.response_cache import ResponseCache, cache_key
+from app.services.similarity_cache import SimilarityCache
+from app.services.translation_memory import (
+    TranslationMemory,
+    align_segments,
+    create_backend as create_translation_memory_backend
+)
+from app.services.conversation_store import ConversationStore, create_backend as create_conversation_backend
+from app.services.upstream_scheduler import (
+    UpstreamScheduler,
+    UpstreamRequestDropped,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NORMAL,
+    PRIORITY_BULK
+)
+
+# 补全后处理保留的最大长度（字符）
+COMPLETION_MAX_LENGTH = {
+    "academic": 100,
+    "technical": 90,
+    "narrative": 120,
+    "general": 90
+}
+
+# 补全的停止序列：段落结束时停止（停止序列本身不会被返回）
+COMPLETION_STOP_SEQUENCES = {
+    "academic": ["\n\n"],
+    "technical": ["\n\n"],
+    "narrative": ["\n\n"],
+    "general": ["\n\n"]
+}
 
-# 初始化OpenAI客户端
-client = AsyncOpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    base_url=settings.OPENAI_API_BASE_URL if settings.OPENAI_API_BASE_URL else None,
-    timeout=60.0  # 设置超时时间为60秒
+# 一句话即可的类型，补全在第一个句号处结束。
+# 句号不作为停止序列：上游对自然结束和任一停止序列都返回 finish_reason="stop"，无法判断句号是否被截掉
+COMPLETION_SINGLE_SENTENCE_TYPES = ("technical", "general")
+
+# 支持的文本优化操作
+OPTIMIZE_ACTIONS = ("rewrite", "expand", "simplify", "translate")
+
+# 初始化上游端点池：每个OpenAI兼容端点一个客户端
+upstream_pool = UpstreamPool(
+    [
+        UpstreamEndpoint(
+            base_url or "default",
+            AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=base_url or None,
+                timeout=60.0  # 设置超时时间为60秒
+            )
+        )
+        for base_url in settings.upstream_base_urls
+    ],
+    policy=settings.UPSTREAM_ROUTING_POLICY,
+    hedge_ratio=settings.UPSTREAM_HEDGE_MAX_RATIO
 )
 
 # 初始化上下文窗口管理器
@@ -34,9 +91,85 @@ context_window_manager = ContextWindowManager(
     model=settings.OPENAI_MODEL
 )
 
+# 初始化上下文类型识别器（关键词表可通过 CONTEXT_KEYWORDS 配置）
+context_classifier = ContextClassifier.from_settings(settings)
+
+# 初始化提示词模板库（静态部分的token数在启动时预先计算）
+prompt_library = PromptLibrary(count_tokens=context_window_manager.count_tokens)
+
+# 初始化上下文预算分配器（所有端点共用）
+context_budget_allocator = ContextBudgetAllocator(context_window_manager)
+
+# 初始化长文本分段器
+document_chunker = DocumentChunker(
+    context_window_manager,
+    chunk_tokens=settings.OPTIMIZE_CHUNK_TOKENS,
+    context_tokens=settings.OPTIMIZE_CHUNK_CONTEXT_TOKENS
+)
+
+# 初始化翻译记忆（按段落复用译文）
+translation_memory = TranslationMemory(
+    create_translation_memory_backend(settings.TRANSLATION_MEMORY_BACKEND, settings.TRANSLATION_MEMORY_PATH),
+    max_entries=settings.TRANSLATION_MEMORY_MAX_ENTRIES,
+    ttl=settings.TRANSLATION_MEMORY_TTL
+)
+
+# 初始化响应缓存（相同输入的文本优化、论文结构和大纲直接返回）
+response_cache = ResponseCache.from_settings(settings)
+
+# 初始化近似重复请求缓存（大纲和独立提问）
+similarity_cache = SimilarityCache.from_settings(settings)
+
+# 分段处理时每段的最大生成token数相对原文token数的倍数
+CHUNK_OUTPUT_RATIO = {"expand": 2.5, "translate": 2.0}
+
+# 初始化上游并发控制器（所有上游调用共享）
+upstream_governor = UpstreamGovernor(
+    initial_limit=settings.UPSTREAM_INITIAL_CONCURRENCY,
+    min_limit=settings.UPSTREAM_MIN_CONCURRENCY,
+    max_limit=settings.UPSTREAM_MAX_CONCURRENCY,
+    tokens_per_minute=settings.UPSTREAM_TOKENS_PER_MINUTE,
+    bulk_share=settings.UPSTREAM_BULK_SHARE,
+    scheduler=UpstreamScheduler(stale_after={PRIORITY_INTERACTIVE: settings.UPSTREAM_COMPLETION_MAX_WAIT})
+)
+
+# 初始化模型路由表（上游高负载时质量档位的操作回退到快速模型）
+model_router = ModelRouter.from_settings(settings, under_load=upstream_governor.saturated)
+
 class OpenAIService:
     """OpenAI API服务类"""
     
+    @staticmethod
+    async def _call_openai_api(
+        model: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        stream: bool,
+        priority: int = PRIORITY_NORMAL,
+        user_key: str = "anonymous",
+        timeout: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        supersede_key: Optional[str] = None
+    ):
+        """
+        调用OpenAI API的内部方法，相同的并发请求共享一次上游调用，
+        实际调用经过上游并发控制器按延迟等级和用户排队
+        """
+        return await request_coalescer.execute(
+            {
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stop": stop
+            },
+            lambda: OpenAIService._request_openai_api(
+                model, messages, max_tokens, temperature, stream, priority, user_key, timeout, stop, supersede_key
+            ),
+            stream
+        )
+    
     # 定义重试装饰器
     @staticmethod
     @retry(
@@ -50,17 +183,102 @@ class OpenAIService:
         )),
         reraise=True
     )
-    async def _call_openai_api(model: str, messages: List[Dict[str, str]], max_tokens: int, temperature: float, stream: bool):
+    async def _request_openai_api(
+        model: str,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        stream: bool,
+        priority: int = PRIORITY_NORMAL,
+        user_key: str = "anonymous",
+        timeout: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        supersede_key: Optional[str] = None
+    ):
         """
-        调用OpenAI API的内部方法，包含重试逻辑
+        实际请求OpenAI API，包含重试逻辑
+        每次尝试（包括重试）都需要先从上游并发控制器获取槽位，429时所有请求一起暂停，避免重试风暴
         """
-        return await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            stream=stream
+        prompt_chars = sum(len(message.get("content") or "") for message in messages)
+        estimated_tokens = int(prompt_chars / context_window_manager.chars_per_token) + max_tokens
+        lease = await upstream_governor.acquire(
+            priority,
+            estimated_tokens,
+            kind=(model, stream, max_tokens),
+            user_key=user_key,
+            supersede_key=supersede_key
         )
+        options = {}
+        if timeout is not None:
+            options["timeout"] = timeout
+        if stop:
+            options["stop"] = stop
+        try:
+            response = await upstream_pool.create(
+                # 行内补全可以对冲到第二个端点，降低单个慢网关造成的尾延迟
+                hedge=settings.UPSTREAM_HEDGE_COMPLETIONS and priority == PRIORITY_INTERACTIVE,
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=stream,
+                **options
+            )
+        except openai.RateLimitError as e:
+            if upstream_pool.healthy_count() > 0:
+                # 还有其他可用端点，只需降低并发，不必暂停全部派发
+                lease.failed()
+            else:
+                lease.throttled(OpenAIService._retry_after(e))
+            lease.release()
+            raise
+        except (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError):
+            lease.failed()
+            lease.release()
+            raise
+        except BaseException:
+            lease.release()
+            raise
+        
+        if stream:
+            lease.succeeded()
+            return GovernedStream(response, lease)
+        
+        usage = getattr(response, "usage", None)
+        lease.succeeded(getattr(usage, "total_tokens", None))
+        lease.release()
+        return response
+    
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """
+        从429响应头中读取建议的等待时间（秒）
+        """
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return None
+    
+    @staticmethod
+    async def _close_stream(response):
+        """
+        关闭上游流式响应，释放连接并让服务商停止生成
+        """
+        try:
+            await response.close()
+        except Exception as e:
+            logger.debug({
+                "message": "关闭上游流式响应失败",
+                "error": str(e)
+            })
     
     @staticmethod
     async def generate_completion(
@@ -68,9 +286,11 @@ class OpenAIService:
         context_before: Optional[str] = None,
         context_after: Optional[str] = None,
         cursor_position: Optional[int] = None,
-        max_tokens: int = 100,
-        temperature: float = 0.6,
-        stream: bool = True
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        stream: bool = True,
+        session_key: Optional[str] = None,
+        user_key: Optional[str] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         生成文本补全
@@ -80,9 +300,11 @@ class OpenAIService:
         - context_before: 当前位置之前的上下文（如果提供）
         - context_after: 当前位置之后的上下文（如果提供）
         - cursor_position: 光标位置（如果提供，将使用上下文窗口管理器）
-        - max_tokens: 生成的最大token数量
-        - temperature: 生成文本的创造性程度
+        - max_tokens: 生成的最大token数量（为空时按模型路由表）
+        - temperature: 生成文本的创造性程度（为空时按模型路由表）
         - stream: 是否使用流式响应
+        - session_key: 会话标识，用于复用上下文窗口的分段token缓存，排队中的旧补全请求会被同一会话的新请求取代
+        - user_key: 用户标识，只用于上游请求的公平排队（为空时使用会话标识）
         
         返回:
         - 生成的文本补全
@@ -95,7 +317,7 @@ class OpenAIService:
         
         # 如果提供了光标位置，使用上下文窗口管理器获取上下文
         if cursor_position is not None and text:
-            before_text, after_text = context_window_manager.get_context_window(text, cursor_position)
+            before_text, after_text = context_window_manager.get_context_window(text, cursor_position, session_key)
             context_before = before_text
             context_after = after_text
         
@@ -105,30 +327,51 @@ class OpenAIService:
         elif text:
             context_text = text
         
+        # 未提供光标位置时同样只保留上下文窗口大小的内容（在句子边界处截断）
+        if cursor_position is None:
+            context_text, _ = context_window_manager.trim_to_tokens(
+                context_text, context_window_manager.before_tokens, keep="tail"
+            )
+            if context_after:
+                context_after, _ = context_window_manager.trim_to_tokens(
+                    context_after, context_window_manager.after_tokens, keep="head"
+                )
+        
         # 分析上下文类型并生成优化的提示词
-        context_type = OpenAIService.analyze_context_type(context_text)
+        context_type = OpenAIService.analyze_context_type(context_text, session_key)
         
-        # 根据上下文类型生成不同的系统提示词
-        system_prompt = OpenAIService.generate_enhanced_completion_prompt(context_type, context_text, context_after)
+        # 按上下文类型选择模型和生成参数；未指定max_tokens时由后处理的最大长度推算，路由表中的值作为上限
+        if max_tokens is None:
+            max_tokens = min(
+                OpenAIService.completion_token_budget(context_type),
+                model_router.profile("completion", context_type).max_tokens
+            )
+        route = model_router.resolve("completion", context_type, max_tokens, temperature)
+        stop = COMPLETION_STOP_SEQUENCES.get(context_type, COMPLETION_STOP_SEQUENCES["general"])
         
-        # 构建用户输入
-        user_content = OpenAIService.build_user_prompt(context_text, context_after)
+        # 按上下文类型选择预编译的提示词模板：静态指令在前，上下文只出现一次并放在最后
+        template = prompt_library.get("completion", context_type)
         
-        # 准备消息
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content}
-        ]
+        # 按模型上下文长度分配输入预算：上文优先（保留靠近光标的结尾），其次是光标后的内容
+        budget = context_budget_allocator.allocate(route, template.static_tokens)
+        context_text = budget.take(context_text, "context_before", keep="tail")
+        context_after = budget.take(context_after, "context_after", keep="head")
+        messages = template.render(context_text=context_text, context_after=context_after)
         
         # 记录请求开始
         logger.info({
             "message": "开始生成文本补全",
             "request_id": request_id,
-            "model": settings.OPENAI_MODEL,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
+            "model": route.model,
+            "degraded": route.degraded,
+            "max_tokens": route.max_tokens,
+            "temperature": route.temperature,
             "stream": stream,
             "context_type": context_type,
+            "prompt_template": template.key,
+            "prompt_version": template.version,
+            "prompt_tokens": template.static_tokens + budget.used,
+            "trimmed": budget.trimmed,
             "text_length": len(context_text) if context_text else 0,
             "cursor_position": cursor_position
         })
@@ -136,11 +379,17 @@ class OpenAIService:
         try:
             # 调用OpenAI API（带重试机制）
             response = await OpenAIService._call_openai_api(
-                model=settings.OPENAI_MODEL,
+                model=route.model,
                 messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=stream
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                stream=stream,
+                priority=PRIORITY_INTERACTIVE,
+                user_key=user_key or session_key or "anonymous",
+                timeout=route.timeout,
+                stop=stop,
+                # 只有同一编辑会话的新请求才取代排队中的旧请求
+                supersede_key=session_key
             )
             
             if stream:
@@ -148,16 +397,28 @@ class OpenAIService:
                 # 返回流式响应
                 yield {"type": "start", "status": "processing", "request_id": request_id}
                 
-                async for chunk in response:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        completion_text += content
-                        
-                        # 检查是否已经生成了足够的内容（调整为更合理的长度）
-                        if OpenAIService.is_completion_sufficient(completion_text, context_type):
-                            break
+                try:
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            
+                            if context_type in COMPLETION_SINGLE_SENTENCE_TYPES and "。" in content:
+                                # 句子已结束：发送到句号为止的部分后结束，finally中关闭上游流
+                                content = content[:content.index("。") + 1]
+                                completion_text += content
+                                yield {"type": "token", "token": content, "status": "processing", "request_id": request_id}
+                                break
                             
-                        yield {"type": "token", "token": content, "status": "processing", "request_id": request_id}
+                            completion_text += content
+                            
+                            # 已经足够时立即结束，finally中关闭上游流，服务商不再继续生成
+                            if OpenAIService.is_completion_sufficient(completion_text, context_type):
+                                break
+                            
+                            yield {"type": "token", "token": content, "status": "processing", "request_id": request_id}
+                finally:
+                    # 提前结束或任务被取消时关闭上游流，停止继续生成
+                    await OpenAIService._close_stream(response)
                 
                 # 后处理：清理和优化生成的文本
                 completion_text = OpenAIService.post_process_completion(completion_text, context_type)
@@ -176,7 +437,8 @@ class OpenAIService:
                 yield {"type": "end", "completion": completion_text, "status": "success", "request_id": request_id}
             else:
                 # 返回完整响应
-                completion_text = response.choices[0].message.content
+                completion_text = response.choices[0].message.content or ""
+                completion_text = OpenAIService.end_at_first_sentence(completion_text, context_type)
                 completion_text = OpenAIService.post_process_completion(completion_text, context_type)
                 
                 # 记录成功完成
@@ -191,6 +453,22 @@ class OpenAIService:
                 })
                 
                 yield {"type": "end", "completion": completion_text, "status": "success", "request_id": request_id}
+        
+        except UpstreamRequestDropped as e:
+            # 排队过久或已被同一会话的新补全请求取代，建议已经没有意义
+            logger.info({
+                "message": "文本补全请求在排队期间被丢弃",
+                "request_id": request_id,
+                "reason": e.reason,
+                "duration_seconds": time.time() - start_time
+            })
+            
+            yield {
+                "type": "error",
+                "error": "补全请求已过期",
+                "status": "error",
+                "request_id": request_id
+            }
                 
         except RetryError as e:
             # 重试失败
@@ -234,104 +512,35 @@ class OpenAIService:
             }
     
     @staticmethod
-    def generate_enhanced_completion_prompt(context_type: str, context_text: str, context_after: str = None) -> str:
+    def completion_token_budget(context_type: str) -> int:
         """
-        生成增强的补全提示词，确保生成适当长度的内容
+        根据后处理的最大长度推算补全的max_tokens，避免生成注定被截掉的内容
         
         参数:
         - context_type: 上下文类型
-        - context_text: 上下文文本
-        - context_after: 后续上下文
         
         返回:
-        - 优化的系统提示词
+        - max_tokens
         """
-        base_rules = [
-            "1. 根据上下文自然地续写内容，保持逻辑连贯",
-            "2. 保持与上下文的风格和语调一致",
-            "3. 生成完整的句子或段落，确保内容有意义",
-            "4. 避免重复已有内容，提供新的有价值信息"
-        ]
-        
-        if context_type == "academic":
-            return f"""你是一个专业的学术写作助手。请根据上下文提供准确、完整的学术文本补全。
-    
-            要求：
-            {chr(10).join(base_rules)}
-            5. 使用严谨的学术语言和表述
-            6. 确保论述的逻辑性和准确性
-            7. 补全关键概念、论述要点或founded
-            8. 生成30-80字的完整内容
-    
-            请直接输出补全内容，确保内容完整且有学术价值。"""
-        
-        elif context_type == "technical":
-            return f"""你是一个技术写作助手。请根据上下文提供准确、详细的技术文档补全。
-    
-            要求：
-            {chr(10).join(base_rules)}
-            5. 使用准确的技术术语和概念
-            6. 保持技术描述的精确性和实用性
-            7. 补全关键技术要点、实现细节或解决方案
-            8. 生成25-70字的完整技术内容
-    
-            请直接输出补全内容，确保技术信息准确且实用。"""
-        
-        elif context_type == "narrative":
-            return f"""你是一个创意写作助手。请根据上下文提供生动、引人入胜的故事续写。
-    
-            要求：
-            {chr(10).join(base_rules)}
-            5. 保持故事的连贯性和可读性
-            6. 使用生动的描述和恰当的情感表达
-            7. 推进情节发展或丰富人物刻画
-            8. 生成40-100字的完整故事内容
-    
-            请直接输出补全内容，确保故事自然流畅且引人入胜。"""
-        
-        else:  # general
-            return f"""你是一个智能写作助手。请根据上下文提供自然、完整的文本补全。
-    
-            要求：
-            {chr(10).join(base_rules)}
-            5. 使用自然、易懂的语言表达
-            6. 确保内容有意义且对读者有价值
-            7. 补全关键信息、观点或描述
-            8. 生成25-70字的完整内容
-    
-            请直接输出补全内容，确保语言自然且内容完整。"""
+        max_length = COMPLETION_MAX_LENGTH.get(context_type, 90)
+        # 按观测到的平均每token字符数换算，留出20%余量
+        return int(max_length / context_window_manager.chars_per_token * 1.2) + 8
     
     @staticmethod
-    def build_user_prompt(context_text: str, context_after: str = None) -> str:
+    def end_at_first_sentence(completion_text: str, context_type: str) -> str:
         """
-        构建用户输入，区分主要上下文和后续文本
+        一句话即可的类型截取到第一个句号（包含句号），其他类型和没有句号的文本原样返回
         
         参数:
-        - context_text: 主要上下文
-        - context_after: 光标后的文本
+        - completion_text: 生成的文本
+        - context_type: 上下文类型
         
         返回:
-        - 格式化的用户提示
+        - 处理后的文本
         """
-        if context_after:
-            return f"""这是当前的上下文：
----
-{context_text}
----
-
-这是光标后的内容，请在续写时考虑到：
----
-{context_after}
----
-
-请从 `{context_text}` 的结尾处开始续写。"""
-        else:
-            return f"""请根据以下上下文进行续写：
----
-{context_text}
----
-
-请从 `{context_text}` 的结尾处开始续写。"""
+        if context_type in COMPLETION_SINGLE_SENTENCE_TYPES and "。" in completion_text:
+            return completion_text[:completion_text.index("。") + 1]
+        return completion_text
     
     @staticmethod
     def is_completion_sufficient(completion_text: str, context_type: str) -> bool:
@@ -345,6 +554,10 @@ class OpenAIService:
         返回:
         - 是否已经足够
         """
+        # 达到后处理的最大长度后，继续生成的内容也会被截掉
+        if len(completion_text) >= COMPLETION_MAX_LENGTH.get(context_type, 90):
+            return True
+        
         # 基于字符数和句子完整性的检查
         if context_type == "academic":
             return len(completion_text) >= 40 and completion_text.count('。') >= 1
@@ -390,12 +603,7 @@ class OpenAIService:
                     text = '。'.join(sentences[:-1]) + '。'
         
         # 调整最大长度限制
-        max_length = {
-            "academic": 100,
-            "technical": 90,
-            "narrative": 120,
-            "general": 90
-        }.get(context_type, 90)
+        max_length = COMPLETION_MAX_LENGTH.get(context_type, 90)
         
         if len(text) > max_length:
             # 截取到最后一个标点符号
@@ -414,86 +622,73 @@ class OpenAIService:
         return text
     
     @staticmethod
-    def analyze_context_type(text: str) -> str:
+    def analyze_context_type(text: str, session_key: Optional[str] = None) -> str:
         """
-        分析文本类型（增强版）
+        分析文本类型（一次扫描匹配全部类别的关键词）
         
         参数:
         - text: 要分析的文本
+        - session_key: 会话标识，提供时只扫描与该会话上一次请求相比发生变化的行
         
         返回:
         - 文本类型
         """
-        if not text:
-            return "general"
-        
-        text_lower = text.lower()
-        
-        # 学术关键词
-        academic_keywords = [
-            "研究", "分析", "理论", "方法", "结论", "假设", "实验", "数据", 
-            "调查", "论文", "学术", "科学", "探讨", "摘要", "文献", "模型",
-            "概念", "框架", "评估", "验证", "测试", "样本", "统计", "显著性"
-        ]
-        
-        # 技术关键词
-        technical_keywords = [
-            "技术", "代码", "算法", "系统", "api", "数据库", "服务器", "网络",
-            "编程", "开发", "软件", "硬件", "架构", "设计", "实现", "部署",
-            "配置", "优化", "性能", "安全", "协议", "接口", "框架", "库"
-        ]
-        
-        # 叙事关键词
-        narrative_keywords = [
-            "他", "她", "故事", "情节", "角色", "人物", "场景", "对话",
-            "描述", "叙述", "小说", "章节", "主人公", "剧情", "背景", "环境"
-        ]
-        
-        # 计算匹配度
-        academic_score = sum(1 for keyword in academic_keywords if keyword in text_lower)
-        technical_score = sum(1 for keyword in technical_keywords if keyword in text_lower)
-        narrative_score = sum(1 for keyword in narrative_keywords if keyword in text_lower)
-        
-        # 根据得分确定类型
-        max_score = max(academic_score, technical_score, narrative_score)
-        
-        if max_score == 0:
-            return "general"
-        elif academic_score == max_score:
-            return "academic"
-        elif technical_score == max_score:
-            return "technical"
-        else:
-            return "narrative"
+        return context_classifier.classify(text, session_key)
     
     @staticmethod
     async def generate_chat_completion(
         messages: List[Dict[str, str]],
-        max_tokens: int = 500,
-        temperature: float = 0.7,
-        stream: bool = False
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        stream: bool = False,
+        user_key: str = "anonymous",
+        standalone: bool = False
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         生成AI聊天对话回复
         
         参数:
         - messages: 对话消息列表
-        - max_tokens: 最大生成token数
-        - temperature: 生成温度
+        - max_tokens: 最大生成token数（为空时按模型路由表）
+        - temperature: 生成温度（为空时按模型路由表）
         - stream: 是否使用流式响应
+        - user_key: 用户标识，用于上游请求的公平排队
+        - standalone: 是否为独立提问（没有文档上下文和对话历史），独立提问与已有提问规范化后完全相同时直接返回其回复
         
         返回:
         - 生成的聊天回复
         """
         start_time = time.time()
         request_id = f"chat_{int(start_time * 1000)}"
+        route = model_router.resolve("chat", max_tokens=max_tokens, temperature=temperature)
+        
+        # 常见问题：只复用规范化后完全相同的独立提问，措辞相近的问题可能问的是相反的内容（如优点和缺点）
+        scope = None
+        if standalone and similarity_cache.cacheable(route.temperature):
+            scope = cache_key("chat", route.model, {"max_tokens": route.max_tokens}, messages[0]["content"])
+            cached = similarity_cache.lookup(scope, messages[-1]["content"], exact=True)
+            if cached is not None:
+                response_text, similarity = cached
+                logger.info({
+                    "message": "AI聊天命中常见问题缓存",
+                    "request_id": request_id,
+                    "model": route.model,
+                    "similarity": round(similarity, 3),
+                    "response_length": len(response_text)
+                })
+                if stream:
+                    yield {"type": "start", "status": "processing", "request_id": request_id}
+                    yield {"type": "token", "token": response_text, "status": "processing", "request_id": request_id}
+                yield {"type": "end", "response": response_text, "status": "success", "request_id": request_id}
+                return
         
         logger.info({
             "message": "开始生成AI聊天回复",
             "request_id": request_id,
-            "model": settings.OPENAI_MODEL,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
+            "model": route.model,
+            "degraded": route.degraded,
+            "max_tokens": route.max_tokens,
+            "temperature": route.temperature,
             "stream": stream,
             "messages_count": len(messages)
         })
@@ -501,11 +696,14 @@ class OpenAIService:
         try:
             # 调用OpenAI API（带重试机制）
             response = await OpenAIService._call_openai_api(
-                model=settings.OPENAI_MODEL,
+                model=route.model,
                 messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                stream=stream
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                stream=stream,
+                priority=PRIORITY_NORMAL,
+                user_key=user_key,
+                timeout=route.timeout
             )
             
             if stream:
@@ -513,11 +711,14 @@ class OpenAIService:
                 # 返回流式响应
                 yield {"type": "start", "status": "processing", "request_id": request_id}
                 
-                async for chunk in response:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        response_text += content
-                        yield {"type": "token", "token": content, "status": "processing", "request_id": request_id}
+                try:
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            response_text += content
+                            yield {"type": "token", "token": content, "status": "processing", "request_id": request_id}
+                finally:
+                    await OpenAIService._close_stream(response)
                 
                 # 记录成功完成
                 duration = time.time() - start_time
@@ -529,6 +730,9 @@ class OpenAIService:
                     "status": "success"
                 })
                 
+                if scope is not None and response_text:
+                    similarity_cache.add(scope, messages[-1]["content"], response_text)
+                
                 yield {"type": "end", "response": response_text, "status": "success", "request_id": request_id}
             else:
                 # 返回完整响应
@@ -544,6 +748,9 @@ class OpenAIService:
                     "status": "success"
                 })
                 
+                if scope is not None and response_text:
+                    similarity_cache.add(scope, messages[-1]["content"], response_text)
+                
                 yield {"type": "end", "response": response_text, "status": "success", "request_id": request_id}
                 
         except RetryError as e:
@@ -587,13 +794,96 @@ class OpenAIService:
                 "request_id": request_id
             }
     
+    @staticmethod
+    def build_chat_messages(
+        message: str,
+        context: Optional[str] = None,
+        history: Optional[List[Dict[str, str]]] = None,
+        summary: Optional[str] = None,
+        max_tokens: Optional[int] = None
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        按上下文预算组装对话消息
+        
+        参数:
+        - message: 当前用户消息
+        - context: 当前文档上下文
+        - history: 角色交替、以用户消息开头的历史消息
+        - summary: 更早对话的滚动摘要
+        - max_tokens: 请求指定的最大生成token数
+        
+        返回:
+        - (消息列表, 用于日志的提示词信息)
+        """
+        # 使用预编译的对话模板：系统消息固定不变，文档上下文随当前用户消息发送
+        template = prompt_library.get("chat")
+        context = context if context and context.strip() else None
+        
+        # 按模型上下文长度分配输入预算，依次放入当前消息、文档上下文、摘要和对话历史
+        route = model_router.resolve("chat", max_tokens=max_tokens)
+        budget = context_budget_allocator.allocate(route, template.static_tokens, messages=3 if summary else 2)
+        message = budget.take(message, "message", keep="head")
+        context = budget.take(context, "context", settings.PROMPT_CONTEXT_MAX_TOKENS, keep="head")
+        summary = budget.take(summary, "summary", keep="tail")
+        
+        messages = [template.system_message()]
+        if summary:
+            messages.append({"role": "system", "content": CHAT_SUMMARY_TEMPLATE.format(summary=summary)})
+        # 从最新的消息开始放入剩余预算，放不下的更早的消息被丢弃
+        if history:
+            messages.extend(budget.take_history(history, settings.PROMPT_HISTORY_MAX_TOKENS))
+        messages.append(template.user_message(message=message, context=context))
+        
+        return messages, {
+            "prompt_template": template.key,
+            "prompt_version": template.version,
+            "prompt_tokens": template.static_tokens + budget.used,
+            "trimmed": budget.trimmed
+        }
+    
+    @staticmethod
+    async def summarize_conversation(summary: str, messages: List[Dict[str, str]]) -> str:
+        """
+        把较早的对话消息连同已有摘要压缩为新的滚动摘要
+        
+        参数:
+        - summary: 已有摘要（可以为空）
+        - messages: 待压缩的消息
+        
+        返回:
+        - 新摘要
+        """
+        template = prompt_library.get("summarize")
+        route = model_router.resolve("summarize")
+        
+        # 摘要和对话记录超出预算时保留最近的内容
+        budget = context_budget_allocator.allocate(route, template.static_tokens)
+        transcript = "\n".join(
+            f"{'用户' if message['role'] == 'user' else '助手'}：{message['content']}" for message in messages
+        )
+        summary = budget.take(summary, "summary", keep="tail")
+        transcript = budget.take(transcript, "transcript", keep="tail")
+        
+        response = await OpenAIService._call_openai_api(
+            model=route.model,
+            messages=template.render(summary=summary, transcript=transcript),
+            max_tokens=route.max_tokens,
+            temperature=route.temperature,
+            stream=False,
+            priority=PRIORITY_BULK,
+            user_key="conversation_summary",
+            timeout=route.timeout
+        )
+        return (response.choices[0].message.content or "").strip()
+    
     @staticmethod
     async def optimize_text(
         text: str,
         action: str = "rewrite",
-        temperature: float = 0.7,
+        temperature: Optional[float] = None,
         stream: bool = True,
-        target_language: Optional[str] = None
+        target_language: Optional[str] = None,
+        user_key: str = "anonymous"
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         优化文本（改写、扩写、简化、翻译）
@@ -601,8 +891,10 @@ class OpenAIService:
         参数:
         - text: 要优化的文本
         - action: 操作类型（rewrite/expand/simplify/translate）
-        - temperature: 生成温度
+        - temperature: 生成温度（为空时按模型路由表）
         - stream: 是否使用流式响应
+        - target_language: 翻译的目标语言
+        - user_key: 用户标识，用于上游请求的公平排队
         
         返回:
         - 优化后的文本
@@ -610,94 +902,139 @@ class OpenAIService:
         start_time = time.time()
         request_id = f"opt_{int(start_time * 1000)}"
         
-        # 构建系统提示词
-        system_prompts = {
-            "rewrite": """你是一个专业的文本改写助手。请将用户提供的文本进行改写，要求：
-1. 保持原文的核心意思和信息不变
-2. 使用不同的表达方式和句式结构
-3. 改善文本的流畅性和可读性
-4. 保持原文的语调和风格
-5. 直接输出改写后的内容，不要添加说明或解释""",
-            
-            "expand": """你是一个专业的文本扩写助手。请将用户提供的文本进行扩展，要求：
-1. 在保持原意基础上增加更多细节和内容
-2. 丰富描述、增加例子或进一步阐释观点
-3. 使文本更加完整和深入
-4. 保持逻辑清晰和结构合理
-5. 扩展后的内容应该比原文长1.5-2倍
-6. 直接输出扩写后的内容，不要添加说明或解释""",
-            
-            "simplify": """你是一个专业的文本简化助手。请将用户提供的文本进行简化，要求：
-1. 保留核心信息和关键观点
-2. 使用更简单、直白的语言表达
-3. 删除冗余信息和复杂的修饰
-4. 保持内容的准确性和完整性
-5. 让文本更易理解和阅读
-6. 直接输出简化后的内容，不要添加说明或解释""",
-            
-            "translate": """你是一个专业的翻译助手。请将用户提供的文本进行智能翻译，严格按照以下要求：
-1. 如果指定了目标语言，请翻译成该语言
-2. 如果是中文且未指定目标语言，翻译成自然流畅的英文
-3. 如果是英文且未指定目标语言，翻译成自然地道的中文
-4. 如果是其他语言且未指定目标语言，翻译成中文
-5. 保持原文的语调、风格和专业程度
-6. 确保翻译准确、自然、符合目标语言习惯
-7. 直接输出翻译结果，不要添加任何说明、解释、引号或前缀
-8. 不要说"好的，请提供"、"Okay, please provide"等无关内容
-9. 只返回纯粹的翻译内容"""
-        }
+        # 选择预编译的提示词模板，翻译指定了目标语言时使用对应语言的模板
+        template = prompt_library.get(action, target_language if action == "translate" else None)
         
-        system_prompt = system_prompts.get(action, system_prompts["rewrite"])
-        
-        # 如果是翻译操作且指定了目标语言，动态生成提示词
-        if action == "translate" and target_language:
-            language_names = {
-                'zh': '中文',
-                'en': '英文',
-                'ja': '日文',
-                'ko': '韩文',
-                'fr': '法文',
-                'de': '德文',
-                'es': '西班牙文',
-                'ru': '俄文',
-                'ar': '阿拉伯文'
-            }
-            target_lang_name = language_names.get(target_language, target_language)
-            
-            system_prompt = f"""你是一个专业的翻译助手。请将用户提供的文本翻译成{target_lang_name}，严格按照以下要求：
-1. 翻译结果必须是{target_lang_name}
-2. 保持原文的语调、风格和专业程度
-3. 确保翻译准确、自然、符合{target_lang_name}的语言习惯
-4. 直接输出翻译结果，不要添加任何说明、解释、引号或前缀
-5. 不要说"好的，请提供"、"Okay, please provide"等无关内容
-6. 只返回纯粹的翻译内容
-7. 如果原文已经是{target_lang_name}，请优化表达使其更加地道"""
-        
-        # 构建消息
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ]
+        # 按操作类型选择模型和生成参数
+        route = model_router.resolve(action, temperature=temperature)
+        
+        # 相同输入直接返回缓存的结果
+        key = None
+        if response_cache.cacheable("optimize", route.temperature):
+            key = cache_key(
+                "optimize",
+                route.model,
+                {"action": action, "target_language": target_language, "temperature": route.temperature, "prompt_version": template.version},
+                text
+            )
+            completion_text = await response_cache.get(key)
+            if completion_text is not None:
+                logger.info({
+                    "message": f"{action}文本命中响应缓存",
+                    "request_id": request_id,
+                    "action": action,
+                    "model": route.model,
+                    "completion_length": len(completion_text)
+                })
+                if stream:
+                    yield {"type": "start", "status": "processing", "request_id": request_id, "action": action}
+                    yield {"type": "token", "token": completion_text, "status": "processing", "request_id": request_id, "action": action}
+                yield {"type": "end", "completion": completion_text, "status": "success", "request_id": request_id, "action": action}
+                return
+        
+        events = OpenAIService._generate_optimized_text(
+            text, action, template, route, stream, target_language, user_key, request_id, start_time
+        )
+        async with aclosing(events):
+            async for event in events:
+                # 有片段被截断的结果不缓存，下次请求重新生成
+                if key is not None and event["type"] == "end" and event["completion"] and not event.get("truncated"):
+                    await response_cache.put(key, "optimize", event["completion"])
+                yield event
+    
+    @staticmethod
+    async def _generate_optimized_text(
+        text: str,
+        action: str,
+        template: Any,
+        route: Any,
+        stream: bool,
+        target_language: Optional[str],
+        user_key: str,
+        request_id: str,
+        start_time: float
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        调用上游优化文本（optimize_text 未命中响应缓存时使用）
+        
+        参数:
+        - text: 要优化的文本
+        - action: 操作类型
+        - template: 提示词模板
+        - route: 模型路由解析结果
+        - stream: 是否使用流式响应
+        - target_language: 翻译的目标语言
+        - user_key: 用户标识，用于上游请求的公平排队
+        - request_id: 请求ID
+        - start_time: 请求开始时间
+        
+        返回:
+        - 与 optimize_text 相同的事件
+        """
+        # 翻译按段落查询翻译记忆，只有新增或修改的段落调用上游，结果按文档顺序合并
+        if action == "translate":
+            memory_language = target_language or "auto"
+            segments = document_chunker.segments(text)
+            cached = await translation_memory.lookup(
+                [text[start:end] for start, end, _ in segments],
+                memory_language,
+                route.model,
+                template.version
+            )
+            async for event in OpenAIService._optimize_chunked(
+                document_chunker.split(text, segments, cached),
+                action,
+                template,
+                route,
+                stream,
+                user_key,
+                request_id,
+                memory_language=memory_language
+            ):
+                yield event
+            return
+        
+        # 长文本切分为多个片段并行处理，按文档顺序拼接返回
+        if context_window_manager.count_tokens(text) > settings.OPTIMIZE_CHUNK_TOKENS:
+            async for event in OpenAIService._optimize_chunked(
+                document_chunker.split(text), action, template, route, stream, user_key, request_id
+            ):
+                yield event
+            return
+        
+        # 超出模型上下文长度的文本在句子边界处截断
+        budget = context_budget_allocator.allocate(route, template.static_tokens)
+        text = budget.take(text, "text", keep="head")
+        messages = template.render(text=text)
         
         # 记录请求开始
         logger.info({
             "message": f"开始{action}文本",
             "request_id": request_id,
             "action": action,
-            "model": settings.OPENAI_MODEL,
-            "temperature": temperature,
+            "model": route.model,
+            "degraded": route.degraded,
+            "max_tokens": route.max_tokens,
+            "temperature": route.temperature,
             "stream": stream,
+            "prompt_template": template.key,
+            "prompt_version": template.version,
+            "prompt_tokens": template.static_tokens + budget.used,
+            "trimmed": budget.trimmed,
             "text_length": len(text)
         })
         
         try:
             # 调用OpenAI API
             response = await OpenAIService._call_openai_api(
-                model=settings.OPENAI_MODEL,
+                model=route.model,
                 messages=messages,
-                max_tokens=500 if action == "expand" else 300,
-                temperature=temperature,
-                stream=stream
+                max_tokens=route.max_tokens,
+                temperature=route.temperature,
+                stream=stream,
+                priority=PRIORITY_BULK,
+                user_key=user_key,
+                timeout=route.timeout
             )
             
             if stream:
@@ -705,11 +1042,14 @@ class OpenAIService:
                 # 返回流式响应
                 yield {"type": "start", "status": "processing", "request_id": request_id, "action": action}
                 
-                async for chunk in response:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        completion_text += content
-                        yield {"type": "token", "token": content, "status": "processing", "request_id": request_id, "action": action}
+                try:
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            completion_text += content
+                            yield {"type": "token", "token": content, "status": "processing", "request_id": request_id, "action": action}
+                finally:
+                    await OpenAIService._close_stream(response)
                 
                 # 记录成功完成
                 duration = time.time() - start_time
@@ -784,4 +1124,273 @@ class OpenAIService:
                 "request_id": request_id,
                 "action": action
             }
+    
+    
+    @staticmethod
+    async def _optimize_chunked(
+        chunks: List[TextChunk],
+        action: str,
+        template: Any,
+        route: Any,
+        stream: bool,
+        user_key: str,
+        request_id: str,
+        memory_language: Optional[str] = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        分段优化长文本：各片段并发调用上游，结果按文档顺序拼接
+        
+        当前片段的输出边生成边返回，后面已开始生成的片段先缓存，轮到时立即返回已生成的部分，
+        因此总耗时取决于单个片段的长度而不是文档长度
+        
+        参数:
+        - chunks: 按文档顺序排列的片段
+        - action: 操作类型
+        - template: 提示词模板
+        - route: 模型路由解析结果
+        - stream: 是否使用流式响应
+        - user_key: 用户标识，用于上游请求的公平排队
+        - request_id: 请求ID
+        - memory_language: 翻译的目标语言，提供时片段的译文保存到翻译记忆
+        
+        返回:
+        - 与 optimize_text 相同的事件；有片段的输出因达到max_tokens被截断时，结束事件带 truncated=True
+        """
+        start_time = time.time()
+        ratio = CHUNK_OUTPUT_RATIO.get(action, 1.5)
+        semaphore = asyncio.Semaphore(max(1, settings.OPTIMIZE_CHUNK_CONCURRENCY))
+        queues: List[asyncio.Queue] = [asyncio.Queue() for _ in chunks]
+        # 输出被截断的片段序号，截断的结果不保存到翻译记忆和响应缓存
+        truncated: List[int] = []
+        
+        logger.info({
+            "message": f"开始分段{action}文本",
+            "request_id": request_id,
+            "action": action,
+            "model": route.model,
+            "degraded": route.degraded,
+            "temperature": route.temperature,
+            "stream": stream,
+            "prompt_template": template.key,
+            "prompt_version": template.version,
+            "chunks": len(chunks),
+            "cached_chunks": sum(chunk.cached is not None for chunk in chunks),
+            "chunk_tokens": [chunk.tokens for chunk in chunks],
+            "concurrency": settings.OPTIMIZE_CHUNK_CONCURRENCY
+        })
+        
+        async def run_chunk(chunk: TextChunk, queue: asyncio.Queue):
+            # 生成的内容逐段放入该片段的队列，结束时放入 None，出错时放入异常
+            if chunk.cached is not None:
+                queue.put_nowait(chunk.cached)
+                queue.put_nowait(None)
+                return
+            # 只有一个片段时不附带前后文
+            context = {
+                "before": chunk.before or "（文档开头）",
+                "after": chunk.after or "（文档结尾）"
+            } if len(chunks) > 1 else {}
+            output = ""
+            finish_reason = None
+            try:
+                async with semaphore:
+                    response = await OpenAIService._call_openai_api(
+                        model=route.model,
+                        messages=template.render(text=chunk.text, **context),
+                        max_tokens=max(route.max_tokens, int(chunk.tokens * ratio)),
+                        temperature=route.temperature,
+                        stream=True,
+                        priority=PRIORITY_BULK,
+                        user_key=user_key,
+                        timeout=route.timeout
+                    )
+                    try:
+                        async for part in response:
+                            if part.choices and part.choices[0].finish_reason:
+                                finish_reason = part.choices[0].finish_reason
+                            if part.choices and part.choices[0].delta.content:
+                                output += part.choices[0].delta.content
+                                queue.put_nowait(part.choices[0].delta.content)
+                    finally:
+                        await OpenAIService._close_stream(response)
+                if finish_reason == "length":
+                    truncated.append(chunk.index)
+                elif memory_language is not None:
+                    await translation_memory.store(
+                        align_segments(chunk.segments, output), memory_language, route.model, template.version
+                    )
+                queue.put_nowait(None)
+            except Exception as e:
+                queue.put_nowait(e)
+        
+        tasks = [asyncio.create_task(run_chunk(chunk, queue)) for chunk, queue in zip(chunks, queues)]
+        completion_text = ""
+        try:
+            if stream:
+                yield {"type": "start", "status": "processing", "request_id": request_id, "action": action}
+            
+            separator = ""
+            for chunk, queue in zip(chunks, queues):
+                written = False
+                pending = ""
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    # 去掉片段输出首尾的空白，片段之间使用原文的空白连接
+                    combined = pending + item
+                    if not written:
+                        combined = combined.lstrip()
+                    content = combined.rstrip()
+                    pending = combined[len(content):]
+                    if not content:
+                        continue
+                    if not written:
+                        content = separator + content
+                        written = True
+                    completion_text += content
+                    if stream:
+                        yield {"type": "token", "token": content, "status": "processing", "request_id": request_id, "action": action}
+                if written:
+                    separator = chunk.separator
+            
+            logger.info({
+                "message": f"分段{action}文本成功",
+                "request_id": request_id,
+                "action": action,
+                "chunks": len(chunks),
+                "truncated_chunks": sorted(truncated),
+                "duration_seconds": time.time() - start_time,
+                "completion_length": len(completion_text),
+                "status": "success"
+            })
+            
+            end = {"type": "end", "completion": completion_text, "status": "success", "request_id": request_id, "action": action}
+            if truncated:
+                end["truncated"] = True
+            yield end
+        
+        except RetryError as e:
+            original_error = e.last_attempt.exception()
+            error_type = type(original_error).__name__
+            
+            logger.error({
+                "message": f"分段{action}文本失败，重试耗尽",
+                "request_id": request_id,
+                "action": action,
+                "error_type": error_type,
+                "error": str(original_error),
+                "completion_length": len(completion_text),
+                "duration_seconds": time.time() - start_time
+            })
+            
+            yield {
+                "type": "error",
+                "error": f"服务暂时不可用，请稍后再试 ({error_type})",
+                "status": "error",
+                "request_id": request_id,
+                "action": action
+            }
+        
+        except Exception as e:
+            logger.error({
+                "message": f"分段{action}文本失败",
+                "request_id": request_id,
+                "action": action,
+                "error_type": type(e).__name__,
+                "error": str(e),
+                "completion_length": len(completion_text),
+                "duration_seconds": time.time() - start_time
+            })
             
+            yield {
+                "type": "error",
+                "error": f"{action}文本时出错: {str(e)}",
+                "status": "error",
+                "request_id": request_id,
+                "action": action
+            }
+        
+        finally:
+            # 出错或客户端断开时取消尚未完成的片段
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    @staticmethod
+    async def optimize_batch(
+        items: List[Dict[str, Any]],
+        concurrency: int = 8,
+        temperature: Optional[float] = None,
+        user_key: str = "anonymous"
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        批量优化文本：以有界并发逐条调用 optimize_text，按完成顺序返回结果，单条失败不影响其他条目
+        
+        参数:
+        - items: 条目列表，每条包含 id、action、text、target_language
+        - concurrency: 同时处理的条目数
+        - temperature: 生成温度（为空时按模型路由表）
+        - user_key: 用户标识，用于上游请求的公平排队
+        
+        返回:
+        - 每个条目的结果（id、index、action、status、completion 或 error、duration_ms）
+        """
+        results: asyncio.Queue = asyncio.Queue()
+        pending = iter(range(len(items)))
+        
+        async def run_item(index: int) -> Dict[str, Any]:
+            item = items[index]
+            started = time.time()
+            action = item.get("action") or "rewrite"
+            result = {"id": item.get("id") or str(index), "index": index, "action": action}
+            if action not in OPTIMIZE_ACTIONS:
+                result.update(status="error", error=f"不支持的操作类型: {action}")
+            else:
+                try:
+                    async for chunk in OpenAIService.optimize_text(
+                        text=item.get("text") or "",
+                        action=action,
+                        temperature=temperature,
+                        stream=False,
+                        target_language=item.get("target_language"),
+                        user_key=user_key
+                    ):
+                        if chunk["type"] == "end":
+                            result.update(status="success", completion=chunk["completion"])
+                        elif chunk["type"] == "error":
+                            result.update(status="error", error=chunk["error"])
+                except Exception as e:
+                    result.update(status="error", error=str(e))
+                result.setdefault("status", "error")
+                if result["status"] == "error":
+                    result.setdefault("error", "优化文本失败")
+            result["duration_ms"] = int((time.time() - started) * 1000)
+            return result
+        
+        async def worker():
+            # 各worker共享同一个序号迭代器，每次领取下一个未处理的条目
+            for index in pending:
+                await results.put(await run_item(index))
+        
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, min(concurrency, len(items))))]
+        try:
+            for _ in range(len(items)):
+                yield await results.get()
+        finally:
+            # 客户端断开或提前结束时取消剩余条目
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+# 初始化对话存储（较早的对话在后台压缩为摘要）
+conversation_store = ConversationStore(
+    create_conversation_backend(settings.CHAT_STORE_BACKEND, settings.CHAT_STORE_PATH),
+    count_tokens=context_window_manager.count_tokens,
+    summarize=OpenAIService.summarize_conversation,
+    compact_tokens=settings.CHAT_COMPACT_TOKENS,
+    keep_messages=settings.CHAT_COMPACT_KEEP_MESSAGES,
+    max_conversations=settings.CHAT_STORE_MAX_CONVERSATIONS
+)
@@ -0,0 +1,400 @@
+"""
+提示词组装服务
+按操作类型和上下文类型预编译带版本号的提示词模板：
+- 静态指令全部放在系统消息中，同一模板的系统消息逐字节一致，便于服务商的提示词前缀缓存命中
+- 动态内容（文档上下文、待处理文本、用户消息）只出现一次，并放在消息的末尾
+- 模板中静态部分的token数在编译时预先计算，供上下文预算使用
+"""
+import string
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+# 模板版本：修改任一模板的静态内容时递增，日志中据此区分不同版本提示词的效果
+PROMPT_VERSION = "3"
+
+# 翻译目标语言的显示名称
+LANGUAGE_NAMES = {
+    "zh": "中文",
+    "en": "英文",
+    "ja": "日文",
+    "ko": "韩文",
+    "fr": "法文",
+    "de": "德文",
+    "es": "西班牙文",
+    "ru": "俄文",
+    "ar": "阿拉伯文"
+}
+
+_COMPLETION_RULES = """1. 根据上下文自然地续写内容，保持逻辑连贯
+2. 保持与上下文的风格和语调一致
+3. 生成完整的句子或段落，确保内容有意义
+4. 避免重复已有内容，提供新的有价值信息"""
+
+_COMPLETION_SYSTEM = {
+    "academic": f"""你是一个专业的学术写作助手。请根据上下文提供准确、完整的学术文本补全。
+
+要求：
+{_COMPLETION_RULES}
+5. 使用严谨的学术语言和表述
+6. 确保论述的逻辑性和准确性
+7. 补全关键概念、论述要点或论据
+8. 生成30-80字的完整内容
+
+请直接输出补全内容，确保内容完整且有学术价值。""",
+
+    "technical": f"""你是一个技术写作助手。请根据上下文提供准确、详细的技术文档补全。
+
+要求：
+{_COMPLETION_RULES}
+5. 使用准确的技术术语和概念
+6. 保持技术描述的精确性和实用性
+7. 补全关键技术要点、实现细节或解决方案
+8. 生成25-70字的完整技术内容
+
+请直接输出补全内容，确保技术信息准确且实用。""",
+
+    "narrative": f"""你是一个创意写作助手。请根据上下文提供生动、引人入胜的故事续写。
+
+要求：
+{_COMPLETION_RULES}
+5. 保持故事的连贯性和可读性
+6. 使用生动的描述和恰当的情感表达
+7. 推进情节发展或丰富人物刻画
+8. 生成40-100字的完整故事内容
+
+请直接输出补全内容，确保故事自然流畅且引人入胜。""",
+
+    "general": f"""你是一个智能写作助手。请根据上下文提供自然、完整的文本补全。
+
+要求：
+{_COMPLETION_RULES}
+5. 使用自然、易懂的语言表达
+6. 确保内容有意义且对读者有价值
+7. 补全关键信息、观点或描述
+8. 生成25-70字的完整内容
+
+请直接输出补全内容，确保语言自然且内容完整。"""
+}
+
+# 补全的用户消息：光标后的内容在前，上文在最后，模型紧接消息末尾续写
+_COMPLETION_USER = "{after_section}请紧接以下上下文的结尾续写：\n---\n{context_text}"
+_COMPLETION_AFTER_SECTION = "这是光标后的内容，续写需要与之衔接，不要重复：\n---\n{context_after}\n---\n\n"
+
+_OPTIMIZE_SYSTEM = {
+    "rewrite": """你是一个专业的文本改写助手。请将用户提供的文本进行改写，要求：
+1. 保持原文的核心意思和信息不变
+2. 使用不同的表达方式和句式结构
+3. 改善文本的流畅性和可读性
+4. 保持原文的语调和风格
+5. 直接输出改写后的内容，不要添加说明或解释""",
+
+    "expand": """你是一个专业的文本扩写助手。请将用户提供的文本进行扩展，要求：
+1. 在保持原意基础上增加更多细节和内容
+2. 丰富描述、增加例子或进一步阐释观点
+3. 使文本更加完整和深入
+4. 保持逻辑清晰和结构合理
+5. 扩展后的内容应该比原文长1.5-2倍
+6. 直接输出扩写后的内容，不要添加说明或解释""",
+
+    "simplify": """你是一个专业的文本简化助手。请将用户提供的文本进行简化，要求：
+1. 保留核心信息和关键观点
+2. 使用更简单、直白的语言表达
+3. 删除冗余信息和复杂的修饰
+4. 保持内容的准确性和完整性
+5. 让文本更易理解和阅读
+6. 直接输出简化后的内容，不要添加说明或解释""",
+
+    "translate": """你是一个专业的翻译助手。请将用户提供的文本进行智能翻译，严格按照以下要求：
+1. 如果是中文，翻译成自然流畅的英文
+2. 如果是英文，翻译成自然地道的中文
+3. 如果是其他语言，翻译成中文
+4. 保持原文的语调、风格和专业程度
+5. 确保翻译准确、自然、符合目标语言习惯
+6. 直接输出翻译结果，不要添加任何说明、解释、引号或前缀
+7. 不要说"好的，请提供"、"Okay, please provide"等无关内容
+8. 只返回纯粹的翻译内容"""
+}
+
+# 优化的用户消息：长文本分段处理时附带前后文供衔接，待处理的文本在最后
+_OPTIMIZE_USER = "{context_section}{text}"
+_OPTIMIZE_SECTIONS = {
+    "context_section": (
+        "前文（仅供衔接参考，不要处理或输出）：\n---\n{before}\n---\n\n"
+        "后文（仅供衔接参考，不要处理或输出）：\n---\n{after}\n---\n\n"
+        "请只处理以下文本：\n"
+    )
+}
+
+_TRANSLATE_TO_SYSTEM = """你是一个专业的翻译助手。请将用户提供的文本翻译成{language}，严格按照以下要求：
+1. 翻译结果必须是{language}
+2. 保持原文的语调、风格和专业程度
+3. 确保翻译准确、自然、符合{language}的语言习惯
+4. 直接输出翻译结果，不要添加任何说明、解释、引号或前缀
+5. 不要说"好的，请提供"、"Okay, please provide"等无关内容
+6. 只返回纯粹的翻译内容
+7. 如果原文已经是{language}，请优化表达使其更加地道"""
+
+_CHAT_SYSTEM = """你是墨井智能写作助手的AI聊天助手。你的职责是：
+
+1. **写作指导**: 提供专业的写作建议、技巧和改进方案
+2. **内容创作**: 帮助用户续写、完善、修改文本内容
+3. **结构优化**: 协助改善文章结构、逻辑和表达
+4. **风格调整**: 根据需求调整写作风格和语调
+5. **问题解答**: 回答关于写作、语言和表达的问题
+
+回复要求：
+- 保持专业、友好、有帮助的语调
+- 提供具体、可操作的建议
+- 回复简洁明了，重点突出
+- 根据上下文提供相关的写作帮助
+- 如果用户提供了文档内容，结合内容给出针对性建议"""
+
+# 对话的文档上下文随当前用户消息发送，系统消息和历史消息构成的前缀保持不变
+_CHAT_USER = "{context_section}{message}"
+_CHAT_CONTEXT_SECTION = "用户当前文档内容片段：\n\n{context}\n\n请基于这个上下文回答用户的问题。\n\n"
+
+# 对话的滚动摘要作为第二条系统消息，只在压缩后变化
+CHAT_SUMMARY_TEMPLATE = "以下是此前对话的摘要，回答时可以参考：\n\n{summary}"
+
+_SUMMARIZE_SYSTEM = """你是一个对话摘要助手。请将写作助手与用户的对话压缩为简洁的摘要，要求：
+1. 保留用户的写作目标、文档主题和已经确定的要求
+2. 保留助手给出的关键建议和结论
+3. 合并已有摘要和新的对话内容，删除寒暄和重复信息
+4. 使用第三人称叙述，不超过300字
+5. 直接输出摘要，不要添加说明或解释"""
+
+_SUMMARIZE_USER = "{summary_section}新的对话内容：\n{transcript}"
+_SUMMARIZE_SUMMARY_SECTION = "已有摘要：\n{summary}\n\n"
+
+_STRUCTURE_SYSTEM = """你是一个专业的学术写作助手，擅长生成符合学术规范的论文结构。请严格按照JSON格式返回结果。
+
+要求：
+1. 生成适合该学科和论文类型的完整结构
+2. 包含标题、摘要和详细的章节安排
+3. 每个章节要有描述和子章节
+4. 提供引用格式指南
+5. 结构要符合学术写作规范
+
+请按以下JSON格式返回：
+{
+  "title": "论文标题",
+  "abstract": "摘要内容",
+  "sections": [
+    {
+      "title": "章节标题",
+      "description": "章节描述",
+      "subsections": [
+        {"title": "子章节标题", "description": "子章节描述"}
+      ]
+    }
+  ],
+  "citationGuide": "引用格式指南"
+}"""
+
+_STRUCTURE_USER = """请为以下学术论文生成详细的结构：
+
+标题：{title}
+论文类型：{paper_type}
+学科领域：{discipline}
+引用格式：{citation_style}
+研究问题：{research_question}
+关键词：{keywords}"""
+
+_OUTLINE_SYSTEM = """你是一个专业的写作助手，擅长生成结构化的文章大纲。请严格按照JSON格式返回结果，确保内容专业、逻辑清晰。
+
+要求：
+1. 生成5-8个主要章节，每个章节包含2-4个子章节
+2. 章节标题要具体、有逻辑性，并能充分展开主题
+3. 适合所给领域的写作风格和结构
+4. 确保内容层次分明，逻辑连贯
+5. 包含引言、正文展开和结论部分
+
+请按以下JSON格式返回，topic 与用户给出的主题一致：
+{
+  "topic": "主题",
+  "outline": [
+    {"title": "引言", "level": 1, "description": "简要描述"},
+    {"title": "主题背景", "level": 2, "description": "详细说明"},
+    {"title": "核心论述", "level": 1, "description": "简要描述"},
+    {"title": "具体观点一", "level": 2, "description": "详细说明"},
+    {"title": "具体观点二", "level": 2, "description": "详细说明"},
+    {"title": "结论与展望", "level": 1, "description": "简要描述"}
+  ]
+}"""
+
+_OUTLINE_USER = """请为以下主题生成一个详细的{doc_type}大纲：
+
+主题：{topic}
+类型：{doc_type}
+领域：{discipline}"""
+
+
+def _field_names(template: str) -> List[str]:
+    """模板中引用的字段名"""
+    return [name for _, name, _, _ in string.Formatter().parse(template) if name]
+
+
+class PromptTemplate:
+    """预编译的提示词模板"""
+
+    __slots__ = ("key", "version", "system", "user", "sections", "static_tokens")
+
+    def __init__(
+        self,
+        key: str,
+        system: str,
+        user: str,
+        sections: Optional[Dict[str, str]] = None,
+        version: str = PROMPT_VERSION,
+        count_tokens: Optional[Callable[[str], int]] = None
+    ):
+        """
+        编译提示词模板
+
+        参数:
+        - key: 模板键，如 completion:academic
+        - system: 系统消息（不含任何动态内容）
+        - user: 用户消息模板，动态字段用 {字段名} 表示
+        - sections: 可选段落 {占位符: 段落模板}，段落引用的字段都有值时才出现在用户消息中
+        - version: 模板版本
+        - count_tokens: token计数函数，用于预先计算静态部分的token数
+        """
+        self.key = key
+        self.version = version
+        self.system = system
+        self.user = user
+        self.sections = sections or {}
+        self.static_tokens = 0
+        if count_tokens is not None:
+            # 用户消息中的固定文字（含全部可选段落）按字段为空时计算
+            empty = {name: "" for name in _field_names(user)}
+            for placeholder, section in self.sections.items():
+                empty.update({name: "" for name in _field_names(section)})
+                empty[placeholder] = section.format(**{name: "" for name in _field_names(section)})
+            self.static_tokens = count_tokens(system) + count_tokens(user.format(**empty))
+
+    def system_message(self) -> Dict[str, str]:
+        """系统消息"""
+        return {"role": "system", "content": self.system}
+
+    def user_message(self, **fields: Optional[str]) -> Dict[str, str]:
+        """
+        渲染用户消息
+
+        参数:
+        - fields: 模板字段，值为空的字段按空字符串处理
+
+        返回:
+        - 用户消息
+        """
+        values = {name: fields.get(name) or "" for name in _field_names(self.user)}
+        for placeholder, section in self.sections.items():
+            names = _field_names(section)
+            if all(fields.get(name) for name in names):
+                values[placeholder] = section.format(**{name: fields[name] for name in names})
+            else:
+                values[placeholder] = ""
+        return {"role": "user", "content": self.user.format(**values)}
+
+    def render(self, **fields: Optional[str]) -> List[Dict[str, str]]:
+        """
+        渲染完整的消息列表（系统消息 + 用户消息）
+
+        参数:
+        - fields: 模板字段
+
+        返回:
+        - 消息列表
+        """
+        return [self.system_message(), self.user_message(**fields)]
+
+
+class PromptLibrary:
+    """按操作类型和上下文类型索引的提示词模板库"""
+
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None, max_dynamic_templates: int = 32):
+        """
+        初始化模板库并编译内置模板
+
+        参数:
+        - count_tokens: token计数函数
+        - max_dynamic_templates: 按需编译的模板（未内置的翻译目标语言）最多缓存多少个
+        """
+        self._count_tokens = count_tokens
+        self.max_dynamic_templates = max_dynamic_templates
+        self.templates: Dict[str, PromptTemplate] = {}
+        self._dynamic: "OrderedDict[str, PromptTemplate]" = OrderedDict()
+
+        for context_type, system in _COMPLETION_SYSTEM.items():
+            self.register(
+                f"completion:{context_type}",
+                system,
+                _COMPLETION_USER,
+                {"after_section": _COMPLETION_AFTER_SECTION}
+            )
+        for action, system in _OPTIMIZE_SYSTEM.items():
+            self.register(action, system, _OPTIMIZE_USER, _OPTIMIZE_SECTIONS)
+        for code, language in LANGUAGE_NAMES.items():
+            self.register(f"translate:{code}", _TRANSLATE_TO_SYSTEM.format(language=language), _OPTIMIZE_USER, _OPTIMIZE_SECTIONS)
+        self.register("chat", _CHAT_SYSTEM, _CHAT_USER, {"context_section": _CHAT_CONTEXT_SECTION})
+        self.register("summarize", _SUMMARIZE_SYSTEM, _SUMMARIZE_USER, {"summary_section": _SUMMARIZE_SUMMARY_SECTION})
+        self.register("structure", _STRUCTURE_SYSTEM, _STRUCTURE_USER)
+        self.register("outline", _OUTLINE_SYSTEM, _OUTLINE_USER)
+
+    def register(self, key: str, system: str, user: str, sections: Optional[Dict[str, str]] = None) -> PromptTemplate:
+        """
+        编译并注册模板
+
+        参数:
+        - key: 模板键
+        - system: 系统消息
+        - user: 用户消息模板
+        - sections: 可选段落
+
+        返回:
+        - 编译后的模板
+        """
+        template = PromptTemplate(key, system, user, sections, count_tokens=self._count_tokens)
+        self.templates[key] = template
+        return template
+
+    def get(self, action: str, variant: Optional[str] = None) -> PromptTemplate:
+        """
+        获取模板
+
+        参数:
+        - action: 操作类型（completion/rewrite/expand/simplify/translate/chat/summarize/structure/outline）
+        - variant: 补全的上下文类型，或翻译的目标语言代码
+
+        返回:
+        - 模板；未知的补全上下文类型使用 general，未知的操作使用 rewrite
+        """
+        if variant:
+            template = self.templates.get(f"{action}:{variant}")
+            if template is not None:
+                return template
+            if action == "translate":
+                return self._translate_template(variant)
+        if action == "completion":
+            return self.templates["completion:general"]
+        return self.templates.get(action) or self.templates["rewrite"]
+
+    def _translate_template(self, target_language: str) -> PromptTemplate:
+        """未内置的目标语言：按需编译并缓存（LRU）"""
+        key = f"translate:{target_language}"
+        template = self._dynamic.get(key)
+        if template is not None:
+            self._dynamic.move_to_end(key)
+            return template
+
+        template = PromptTemplate(
+            key,
+            _TRANSLATE_TO_SYSTEM.format(language=target_language),
+            _OPTIMIZE_USER,
+            _OPTIMIZE_SECTIONS,
+            count_tokens=self._count_tokens
+        )
+        self._dynamic[key] = template
+        if len(self._dynamic) > self.max_dynamic_templates:
+            self._dynamic.popitem(last=False)
+        return template
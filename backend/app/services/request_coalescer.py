@@ -0,0 +1,187 @@
+"""
+上游请求合并服务
+相同的（模型、消息、参数）并发请求只调用一次上游API，结果（包括流式token）分发给所有请求方
+"""
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.core.logger import logger
+
+
+def request_key(params: Dict[str, Any]) -> str:
+    """
+    计算请求参数的规范化哈希
+
+    参数:
+    - params: 请求参数（模型、消息、生成参数等）
+
+    返回:
+    - 十六进制哈希字符串
+    """
+    canonical = json.dumps(params, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _StreamFlight:
+    """一次共享的上游流式调用，缓存已收到的分块供所有订阅者回放"""
+
+    def __init__(self, key: str, factory: Callable[[], Awaitable[Any]], on_done: Callable[["_StreamFlight"], None]):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.cancelling = False
+        self.changed = asyncio.Event()
+        self.opened = asyncio.get_running_loop().create_future()
+        self._on_done = on_done
+        self._stream = None
+        self._task = asyncio.create_task(self._pump(factory))
+
+    async def _pump(self, factory: Callable[[], Awaitable[Any]]):
+        """建立上游流并持续读取分块"""
+        try:
+            self._stream = await factory()
+            self.opened.set_result(None)
+            async for chunk in self._stream:
+                self.chunks.append(chunk)
+                self.changed.set()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            if not self.opened.done():
+                self.opened.cancel()
+        except Exception as e:
+            self.error = e
+            if not self.opened.done():
+                self.opened.set_exception(e)
+        finally:
+            self.done = True
+            self.changed.set()
+            self._on_done(self)
+            if self._stream is not None:
+                try:
+                    await self._stream.close()
+                except Exception:
+                    pass
+
+    def cancel(self):
+        """取消上游调用"""
+        self.cancelling = True
+        if not self._task.done():
+            self._task.cancel()
+
+
+class FanOutStream:
+    """共享流的订阅者，接口与上游流式响应一致（支持 async for 和 close）"""
+
+    def __init__(self, flight: _StreamFlight):
+        self._flight = flight
+        self._closed = False
+        flight.subscribers += 1
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        flight = self._flight
+        index = 0
+        while True:
+            while index < len(flight.chunks):
+                yield flight.chunks[index]
+                index += 1
+            if flight.done:
+                if flight.error is not None and not isinstance(flight.error, asyncio.CancelledError):
+                    raise flight.error
+                return
+            flight.changed.clear()
+            await flight.changed.wait()
+
+    async def close(self):
+        """退订；最后一个订阅者退订时取消上游调用"""
+        if self._closed:
+            return
+        self._closed = True
+        self._flight.subscribers -= 1
+        if self._flight.subscribers <= 0:
+            self._flight.cancel()
+
+
+class RequestCoalescer:
+    """单飞（single-flight）请求合并器"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.coalesced_count = 0
+
+    async def execute(self, params: Dict[str, Any], factory: Callable[[], Awaitable[Any]], stream: bool):
+        """
+        执行请求，相同参数的并发请求共享一次上游调用
+
+        参数:
+        - params: 用于计算合并键的请求参数
+        - factory: 实际调用上游的协程工厂
+        - stream: 是否为流式请求
+
+        返回:
+        - 非流式时返回上游响应对象；流式时返回可迭代的共享流
+        """
+        key = request_key({**params, "stream": stream})
+        if stream:
+            return await self._execute_stream(key, factory)
+        return await self._execute_call(key, factory)
+
+    async def _execute_call(self, key: str, factory: Callable[[], Awaitable[Any]]):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._calls[key] = task
+
+            def _remove(finished: asyncio.Task):
+                if self._calls.get(key) is finished:
+                    del self._calls[key]
+                # 所有请求方都已取消时避免“异常未被获取”的警告
+                if not finished.cancelled():
+                    finished.exception()
+
+            task.add_done_callback(_remove)
+        else:
+            self._log_coalesced(key, stream=False)
+
+        # shield: 单个请求方被取消不影响其他请求方
+        return await asyncio.shield(task)
+
+    async def _execute_stream(self, key: str, factory: Callable[[], Awaitable[Any]]):
+        flight = self._streams.get(key)
+        if flight is None or flight.cancelling:
+            flight = _StreamFlight(key, factory, self._remove_stream)
+            self._streams[key] = flight
+        else:
+            self._log_coalesced(key, stream=True)
+
+        subscriber = FanOutStream(flight)
+        try:
+            await asyncio.shield(flight.opened)
+        except BaseException:
+            await subscriber.close()
+            raise
+        return subscriber
+
+    def _remove_stream(self, flight: _StreamFlight):
+        if self._streams.get(flight.key) is flight:
+            del self._streams[flight.key]
+
+    def _log_coalesced(self, key: str, stream: bool):
+        self.coalesced_count += 1
+        logger.info({
+            "message": "合并相同的上游请求",
+            "request_key": key[:16],
+            "stream": stream,
+            "coalesced_total": self.coalesced_count
+        })
+
+
+# 创建全局请求合并器实例
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,299 @@
+"""
+响应缓存服务
+按内容寻址缓存非补全类端点（文本优化、论文结构、大纲）的生成结果，相同的输入直接返回，不再请求上游：
+- 缓存键为 (端点, 模型, 规范化的参数, 输入文本) 的哈希，提示词版本作为参数的一部分
+- 内存中按结果大小做LRU淘汰，持久化由可替换的后端提供（SQLite 或仅内存），重启后保留并在多个进程间共享
+- 各端点单独设置有效期，生成温度高于阈值的请求不使用缓存
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.logger import logger
+
+# 每写入多少条结果清理一次持久化后端中过期的条目
+_PRUNE_INTERVAL = 256
+
+
+def cache_key(endpoint: str, model: str, params: Dict[str, Any], text: str = "") -> str:
+    """
+    计算缓存键
+
+    参数:
+    - endpoint: 端点名称
+    - model: 模型名称
+    - params: 影响结果的参数，值为空的参数忽略
+    - text: 输入文本，忽略首尾空白并统一换行符
+
+    返回:
+    - 缓存键（SHA-256十六进制）
+    """
+    canonical = json.dumps(
+        {
+            "endpoint": endpoint,
+            "model": model,
+            "params": {name: value for name, value in params.items() if value is not None},
+            "text": text.replace("\r\n", "\n").strip()
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCacheBackend:
+    """响应缓存持久化后端接口，方法均为同步调用，由缓存在线程池中执行"""
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """
+        读取结果
+
+        参数:
+        - key: 缓存键
+
+        返回:
+        - (JSON序列化的结果, 过期时间)；不存在或已过期时返回None
+        """
+        return None
+
+    def put(self, key: str, endpoint: str, value: str, expires_at: float):
+        """保存结果"""
+
+    def close(self):
+        """关闭后端"""
+
+
+class SQLiteResponseCacheBackend(ResponseCacheBackend):
+    """SQLite持久化后端：多个进程共享同一个数据库文件，过期条目定期清理"""
+
+    def __init__(self, path: str):
+        """
+        初始化SQLite后端
+
+        参数:
+        - path: 数据库文件路径
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, endpoint TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_expires ON response_cache (expires_at)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, key, endpoint, value, expires_at):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, endpoint, value, expires_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, endpoint, value, expires_at, now)
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_INTERVAL == 0:
+                self._db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_backend(kind: str, path: str) -> ResponseCacheBackend:
+    """
+    根据配置创建持久化后端，SQLite不可用时只缓存在内存中
+
+    参数:
+    - kind: 后端类型，sqlite 或 memory
+    - path: SQLite数据库文件路径
+
+    返回:
+    - 持久化后端实例
+    """
+    if kind == "sqlite":
+        try:
+            return SQLiteResponseCacheBackend(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.error({
+                "message": "SQLite响应缓存不可用，结果只缓存在内存中",
+                "error": str(e)
+            })
+    return ResponseCacheBackend()
+
+
+class ResponseCache:
+    """响应缓存：按大小淘汰的内存LRU + 持久化后端"""
+
+    def __init__(
+        self,
+        backend: ResponseCacheBackend,
+        ttls: Dict[str, float],
+        max_bytes: int = 64 * 1024 * 1024,
+        max_temperature: float = 0.7
+    ):
+        """
+        初始化响应缓存
+
+        参数:
+        - backend: 持久化后端
+        - ttls: 各端点结果的有效期（秒），未配置或为0的端点不缓存
+        - max_bytes: 内存中缓存结果的总大小上限（字节）
+        - max_temperature: 生成温度高于该值的请求不使用缓存
+        """
+        self.backend = backend
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.max_temperature = max_temperature
+        # {缓存键: (JSON序列化的结果, 过期时间, 字节数)}
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, settings: Any) -> "ResponseCache":
+        """
+        根据配置创建响应缓存，RESPONSE_CACHE_TTLS（JSON）为各端点的有效期
+
+        参数:
+        - settings: 全局配置
+        """
+        try:
+            ttls = {endpoint: float(ttl) for endpoint, ttl in json.loads(settings.RESPONSE_CACHE_TTLS).items()}
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.error({
+                "message": "RESPONSE_CACHE_TTLS 配置无效，不使用响应缓存",
+                "error": str(e)
+            })
+            ttls = {}
+        return cls(
+            create_backend(settings.RESPONSE_CACHE_BACKEND, settings.RESPONSE_CACHE_PATH),
+            ttls,
+            max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+            max_temperature=settings.RESPONSE_CACHE_MAX_TEMPERATURE
+        )
+
+    def cacheable(self, endpoint: str, temperature: Optional[float] = None) -> bool:
+        """
+        端点的结果是否使用缓存
+
+        参数:
+        - endpoint: 端点名称
+        - temperature: 本次请求的生成温度
+
+        返回:
+        - 端点配置了有效期且温度不高于阈值时返回True
+        """
+        if self.ttls.get(endpoint, 0) <= 0:
+            return False
+        return temperature is None or temperature <= self.max_temperature
+
+    def _cache(self, key: str, value: str, expires_at: float):
+        self._evict(key)
+        size = len(value.encode("utf-8"))
+        self._entries[key] = (value, expires_at, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._entries:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def _evict(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    async def get(self, key: str) -> Optional[Any]:
+        """
+        读取结果，内存中没有时从持久化后端加载
+
+        参数:
+        - key: 缓存键
+
+        返回:
+        - 结果；不存在或已过期时返回None
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.time():
+            self._evict(key)
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+        else:
+            try:
+                entry = await asyncio.to_thread(self.backend.get, key)
+            except sqlite3.Error as e:
+                logger.error({
+                    "message": "读取响应缓存失败",
+                    "error": str(e)
+                })
+                entry = None
+            if entry is not None:
+                self._cache(key, *entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(entry[0])
+
+    async def put(self, key: str, endpoint: str, value: Any):
+        """
+        保存结果
+
+        参数:
+        - key: 缓存键
+        - endpoint: 端点名称，用于选择有效期
+        - value: 结果（可JSON序列化）
+        """
+        ttl = self.ttls.get(endpoint, 0)
+        if ttl <= 0:
+            return
+        serialized = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + ttl
+        self._cache(key, serialized, expires_at)
+        try:
+            await asyncio.to_thread(self.backend.put, key, endpoint, serialized, expires_at)
+        except sqlite3.Error as e:
+            logger.error({
+                "message": "保存响应缓存失败",
+                "error": str(e)
+            })
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取缓存当前状态
+
+        返回:
+        - 包含条目数、占用大小和命中次数的字典
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def close(self):
+        """关闭持久化后端"""
+        self.backend.close()
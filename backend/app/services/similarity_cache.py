@@ -0,0 +1,314 @@
+"""
+近似重复请求缓存
+同一课程的学生经常提交只有细微差别的大纲和常见问题请求，
+按字符二元组的MinHash签名和LSH分桶在本地查找相似的已有请求，校验通过时直接返回其结果：
+- 不依赖GPU和外部向量服务，签名计算和查找都在进程内完成
+- 影响结果的精确参数（模型、文档类型、学科等）组成作用域，只在同一作用域内比较输入文本
+- 比较前统一同义词（如 人工智能 -> ai）并去掉虚词和套话（如 的、在、领域、请介绍一下）
+- 候选条目除字符二元组的Jaccard相似度达到阈值外，还必须与输入使用完全相同的字符（只允许语序不同），
+  替换、增加或删除任何一个实词都不会命中
+"""
+import hashlib
+import json
+import random
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from app.core.logger import logger
+
+# MinHash使用的梅森素数
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# 规范化时去掉的字符：空白、标点和符号
+_NON_WORD = re.compile(r"[\W_]+")
+
+# 默认同义词表：{统一后的写法: 其他写法}，写法按 normalize_text 规范化后比较
+DEFAULT_ALIASES: Dict[str, List[str]] = {
+    "ai": ["人工智能", "artificialintelligence"],
+    "机器学习": ["machinelearning"],
+    "深度学习": ["deeplearning"],
+    "大语言模型": ["大模型", "llm", "largelanguagemodel"],
+    "自然语言处理": ["nlp", "naturallanguageprocessing"],
+    "计算机视觉": ["cv", "computervision"],
+    "物联网": ["iot", "internetofthings"]
+}
+
+# 默认忽略的虚词和套话，不影响请求的含义
+DEFAULT_FILLERS: List[str] = [
+    "请问", "请介绍一下", "介绍一下", "请简述", "关于", "浅谈", "浅析", "试论",
+    "领域", "方面", "当中", "之中", "中的", "的", "在", "与", "和", "及"
+]
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：统一全半角、忽略大小写，去掉空白和标点"""
+    return _NON_WORD.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def text_shingles(text: str) -> FrozenSet[str]:
+    """
+    计算规范化文本的字符二元组集合
+
+    参数:
+    - text: 规范化后的文本
+
+    返回:
+    - 字符二元组集合；只有一个字符时返回该字符
+    """
+    if len(text) < 2:
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+class SimilarityEntry:
+    """一条已缓存的请求"""
+
+    __slots__ = ("scope", "normalized", "canonical", "shingles", "bands", "value", "expires_at")
+
+    def __init__(
+        self,
+        scope: str,
+        normalized: str,
+        canonical: str,
+        shingles: FrozenSet[str],
+        bands: List[Tuple[int, ...]],
+        value: Any,
+        expires_at: float
+    ):
+        self.scope = scope
+        self.normalized = normalized
+        self.canonical = canonical
+        self.shingles = shingles
+        self.bands = bands
+        self.value = value
+        self.expires_at = expires_at
+
+
+class SimilarityCache:
+    """基于MinHash/LSH的近似重复请求缓存"""
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        max_entries: int = 4096,
+        ttl: float = 7 * 24 * 3600,
+        num_perm: int = 64,
+        bands: int = 16,
+        max_temperature: float = 0.7,
+        aliases: Optional[Dict[str, List[str]]] = None,
+        fillers: Optional[List[str]] = None
+    ):
+        """
+        初始化缓存
+
+        参数:
+        - threshold: 返回缓存结果所需的最低Jaccard相似度
+        - max_entries: 最多缓存的条目数（LRU淘汰）
+        - ttl: 条目的有效期（秒），0表示不使用缓存
+        - num_perm: MinHash签名长度
+        - bands: LSH分段数，签名按段分桶，任一段相同即成为候选
+        - max_temperature: 生成温度高于该值的请求不使用缓存
+        - aliases: 同义词表 {统一后的写法: 其他写法}，为空时使用默认表
+        - fillers: 比较时忽略的虚词和套话，为空时使用默认表
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = bands
+        self.rows = max(1, num_perm // bands)
+        self.max_temperature = max_temperature
+        rng = random.Random(0x5EED)
+        self._permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(self.bands * self.rows)
+        ]
+
+        # 同义词和虚词合并为一个正则，较长的写法优先匹配，一次替换完成
+        self._replacements: Dict[str, str] = {}
+        for filler in DEFAULT_FILLERS if fillers is None else fillers:
+            filler = normalize_text(filler)
+            if filler:
+                self._replacements[filler] = ""
+        for canonical, variants in (DEFAULT_ALIASES if aliases is None else aliases).items():
+            canonical = normalize_text(canonical)
+            for variant in variants:
+                variant = normalize_text(variant)
+                if variant and variant != canonical:
+                    self._replacements[variant] = canonical
+        self._canonical_pattern = re.compile(
+            "|".join(re.escape(term) for term in sorted(self._replacements, key=len, reverse=True))
+        ) if self._replacements else None
+
+        self._entries: "OrderedDict[int, SimilarityEntry]" = OrderedDict()
+        # {(作用域, 段序号, 段签名): 条目ID集合}
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[int]] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, settings: Any) -> "SimilarityCache":
+        """
+        根据配置创建缓存，SIMILARITY_CACHE_ALIASES（JSON）中的写法替换或补充默认同义词表
+
+        参数:
+        - settings: 全局配置
+        """
+        aliases = dict(DEFAULT_ALIASES)
+        if settings.SIMILARITY_CACHE_ALIASES:
+            try:
+                for canonical, variants in json.loads(settings.SIMILARITY_CACHE_ALIASES).items():
+                    if not isinstance(variants, list):
+                        raise TypeError(f"{canonical} 的同义词必须是列表")
+                    aliases[canonical] = [str(variant) for variant in variants]
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error({
+                    "message": "SIMILARITY_CACHE_ALIASES 配置无效，使用默认同义词表",
+                    "error": str(e)
+                })
+                aliases = dict(DEFAULT_ALIASES)
+        return cls(
+            threshold=settings.SIMILARITY_CACHE_THRESHOLD,
+            max_entries=settings.SIMILARITY_CACHE_MAX_ENTRIES,
+            ttl=settings.SIMILARITY_CACHE_TTL,
+            max_temperature=settings.RESPONSE_CACHE_MAX_TEMPERATURE,
+            aliases=aliases
+        )
+
+    def cacheable(self, temperature: Optional[float] = None) -> bool:
+        """本次请求是否使用缓存（启用了缓存且温度不高于阈值）"""
+        if self.ttl <= 0:
+            return False
+        return temperature is None or temperature <= self.max_temperature
+
+    def canonicalize(self, normalized: str) -> str:
+        """
+        统一同义词并去掉虚词
+
+        参数:
+        - normalized: normalize_text 规范化后的文本
+
+        返回:
+        - 用于比较的文本
+        """
+        if self._canonical_pattern is None:
+            return normalized
+        return self._canonical_pattern.sub(lambda match: self._replacements[match.group(0)], normalized)
+
+    def _signature_bands(self, shingles: FrozenSet[str]) -> List[Tuple[int, ...]]:
+        """计算MinHash签名并按LSH分段"""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in shingles
+        ]
+        signature = [
+            min((a * value + b) % _MERSENNE_PRIME for value in hashes)
+            for a, b in self._permutations
+        ]
+        return [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for index, band in enumerate(entry.bands):
+            key = (entry.scope, index, band)
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def lookup(self, scope: str, text: str, exact: bool = False) -> Optional[Tuple[Any, float]]:
+        """
+        查找相似的已缓存请求
+
+        参数:
+        - scope: 作用域
+        - text: 输入文本
+        - exact: 为True时只返回规范化后（忽略大小写、全半角、空白和标点）与输入完全相同的请求
+
+        返回:
+        - (缓存的结果, 相似度)；没有通过校验的条目时返回None
+        """
+        normalized = normalize_text(text)
+        canonical = self.canonicalize(normalized)
+        shingles = text_shingles(canonical)
+        if not shingles:
+            return None
+        candidates: Set[int] = set()
+        for index, band in enumerate(self._signature_bands(shingles)):
+            candidates.update(self._buckets.get((scope, index, band), ()))
+
+        now = time.time()
+        characters = sorted(canonical)
+        best_id, best_similarity = None, 0.0
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self._remove(entry_id)
+                continue
+            if exact:
+                if entry.normalized != normalized:
+                    continue
+            elif sorted(entry.canonical) != characters:
+                # 字符不同说明至少有一个实词不同（如 优点/缺点），不论相似度多高都不复用
+                continue
+            similarity = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+            if similarity > best_similarity:
+                best_id, best_similarity = entry_id, similarity
+
+        if best_id is None or best_similarity < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best_id)
+        self.hits += 1
+        return self._entries[best_id].value, best_similarity
+
+    def add(self, scope: str, text: str, value: Any):
+        """
+        缓存请求的结果
+
+        参数:
+        - scope: 作用域
+        - text: 输入文本
+        - value: 结果
+        """
+        normalized = normalize_text(text)
+        canonical = self.canonicalize(normalized)
+        shingles = text_shingles(canonical)
+        if not shingles or self.ttl <= 0:
+            return
+        bands = self._signature_bands(shingles)
+        # 相同的输入只保留最新的结果
+        for index, band in enumerate(bands):
+            for entry_id in list(self._buckets.get((scope, index, band), ())):
+                if self._entries[entry_id].normalized == normalized:
+                    self._remove(entry_id)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = SimilarityEntry(
+            scope, normalized, canonical, shingles, bands, value, time.time() + self.ttl
+        )
+        for index, band in enumerate(bands):
+            self._buckets.setdefault((scope, index, band), set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取缓存当前状态
+
+        返回:
+        - 包含条目数、LSH桶数和命中次数的字典
+        """
+        return {
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,283 @@
+"""
+翻译记忆服务
+按段落保存翻译结果（原文 + 目标语言 + 模型 + 提示词版本 -> 译文），重新翻译修改过的文档时未改变的段落直接复用，
+只有新增或修改的段落调用上游：
+- 内存中缓存最近使用的段落（LRU），持久化由可替换的后端提供（SQLite 或仅内存）
+- 切换模型或更新提示词模板后不再复用旧的译文，条目超过有效期后也不再复用
+- 一次上游调用翻译多个段落时，译文按段落分隔对齐后逐段保存，无法对齐时不保存
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.core.logger import logger
+
+# 段落分隔：中间只有空白的两个换行
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+# 每写入多少批译文清理一次持久化后端中过期的条目
+_PRUNE_INTERVAL = 64
+
+
+def segment_key(text: str, target_language: str, model: str, prompt_version: str) -> str:
+    """
+    计算段落译文的键
+
+    参数:
+    - text: 段落原文，忽略首尾空白
+    - target_language: 目标语言
+    - model: 生成译文的模型
+    - prompt_version: 翻译提示词模板的版本
+
+    返回:
+    - 键（SHA-256十六进制）
+    """
+    canonical = json.dumps(
+        [text.strip(), target_language, model, prompt_version],
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def align_segments(segments: Sequence[str], translation: str) -> List[Tuple[str, str]]:
+    """
+    把一次上游调用的译文按段落对齐到原文段落
+
+    参数:
+    - segments: 原文段落
+    - translation: 译文
+
+    返回:
+    - [(原文段落, 译文段落)]；段落数不一致时返回空列表
+    """
+    translation = translation.strip()
+    if not segments or not translation:
+        return []
+    if len(segments) == 1:
+        return [(segments[0], translation)]
+    parts = [part.strip() for part in _PARAGRAPH_BREAK.split(translation) if part.strip()]
+    if len(parts) != len(segments):
+        return []
+    return list(zip(segments, parts))
+
+
+class TranslationMemoryBackend:
+    """翻译记忆持久化后端接口，方法均为同步调用，由翻译记忆在线程池中执行"""
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[str, float]]:
+        """
+        批量读取译文
+
+        参数:
+        - keys: 段落译文的键
+
+        返回:
+        - {键: (译文, 过期时间)}，只包含已保存且未过期的条目
+        """
+        return {}
+
+    def put_many(self, entries: List[Tuple[str, str, float]]):
+        """批量保存译文 [(键, 译文, 过期时间)]"""
+
+    def close(self):
+        """关闭后端"""
+
+
+class SQLiteTranslationMemoryBackend(TranslationMemoryBackend):
+    """SQLite持久化后端：同一个键只保留最新的译文，过期条目定期清理"""
+
+    def __init__(self, path: str):
+        """
+        初始化SQLite后端
+
+        参数:
+        - path: 数据库文件路径
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # 键包含模型和提示词版本；旧版本按 (原文哈希, 目标语言) 保存的 translation_memory 表不再读取
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS translation_segments ("
+            "key TEXT PRIMARY KEY, translation TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS translation_segments_expires ON translation_segments (expires_at)")
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            # 分批查询，避免超出SQLite的参数个数限制
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._db.execute(
+                    "SELECT key, translation, expires_at FROM translation_segments "
+                    f"WHERE key IN ({','.join('?' * len(batch))}) AND expires_at > ?",
+                    (*batch, now)
+                ).fetchall()
+                found.update({key: (translation, expires_at) for key, translation, expires_at in rows})
+        return found
+
+    def put_many(self, entries):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO translation_segments (key, translation, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                [(key, translation, expires_at, now) for key, translation, expires_at in entries]
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_INTERVAL == 0:
+                self._db.execute("DELETE FROM translation_segments WHERE expires_at <= ?", (now,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_backend(kind: str, path: str) -> TranslationMemoryBackend:
+    """
+    根据配置创建持久化后端，SQLite不可用时只保存在内存中
+
+    参数:
+    - kind: 后端类型，sqlite 或 memory
+    - path: SQLite数据库文件路径
+
+    返回:
+    - 持久化后端实例
+    """
+    if kind == "sqlite":
+        try:
+            return SQLiteTranslationMemoryBackend(path)
+        except (sqlite3.Error, OSError) as e:
+            logger.error({
+                "message": "SQLite翻译记忆不可用，译文只保存在内存中",
+                "error": str(e)
+            })
+    return TranslationMemoryBackend()
+
+
+class TranslationMemory:
+    """翻译记忆：内存LRU缓存 + 持久化后端"""
+
+    def __init__(self, backend: TranslationMemoryBackend, max_entries: int = 10000, ttl: float = 30 * 24 * 3600):
+        """
+        初始化翻译记忆
+
+        参数:
+        - backend: 持久化后端
+        - max_entries: 内存中最多缓存的段落数
+        - ttl: 译文的有效期（秒），0表示不使用翻译记忆
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # {键: (译文, 过期时间)}
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache(self, key: str, translation: str, expires_at: float):
+        self._entries[key] = (translation, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def lookup(
+        self,
+        segments: Sequence[str],
+        target_language: str,
+        model: str,
+        prompt_version: str
+    ) -> List[Optional[str]]:
+        """
+        查询段落的译文，内存中没有时从持久化后端批量加载
+
+        参数:
+        - segments: 原文段落
+        - target_language: 目标语言
+        - model: 本次翻译使用的模型
+        - prompt_version: 翻译提示词模板的版本
+
+        返回:
+        - 与段落一一对应的译文，未保存或已过期的段落为None
+        """
+        if self.ttl <= 0:
+            return [None] * len(segments)
+        now = time.time()
+        keys = [segment_key(segment, target_language, model, prompt_version) for segment in segments]
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+        missing = list({key for key in keys if key not in self._entries})
+        if missing:
+            try:
+                for key, (translation, expires_at) in (await asyncio.to_thread(self.backend.get_many, missing)).items():
+                    self._cache(key, translation, expires_at)
+            except sqlite3.Error as e:
+                # 持久化后端出错时只使用内存中的译文
+                logger.error({
+                    "message": "读取翻译记忆失败",
+                    "error": str(e)
+                })
+
+        translations = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            translations.append(entry[0] if entry is not None else None)
+        hits = sum(translation is not None for translation in translations)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return translations
+
+    async def store(
+        self,
+        pairs: Sequence[Tuple[str, str]],
+        target_language: str,
+        model: str,
+        prompt_version: str
+    ):
+        """
+        保存段落译文
+
+        参数:
+        - pairs: [(原文段落, 译文段落)]
+        - target_language: 目标语言
+        - model: 生成译文的模型
+        - prompt_version: 翻译提示词模板的版本
+        """
+        if not pairs or self.ttl <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        entries = []
+        for segment, translation in pairs:
+            key = segment_key(segment, target_language, model, prompt_version)
+            self._cache(key, translation, expires_at)
+            entries.append((key, translation, expires_at))
+        try:
+            await asyncio.to_thread(self.backend.put_many, entries)
+        except sqlite3.Error as e:
+            logger.error({
+                "message": "保存翻译记忆失败",
+                "error": str(e)
+            })
+
+    def close(self):
+        """关闭持久化后端"""
+        self.backend.close()
@@ -0,0 +1,311 @@
+"""
+上游并发控制服务
+在OpenAI客户端之前按AIMD（加性增、乘性减）方式自适应调整并发上限，并按每分钟token数（TPM）限流：
+- 请求成功且延迟正常时缓慢提高并发上限
+- 收到429或延迟明显升高时成倍降低并发上限，429时按Retry-After暂停全部派发
+- 超出并发上限或TPM预算的请求交给调度器按延迟等级和用户公平性排队
+"""
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from app.core.logger import logger
+from app.services.upstream_scheduler import (
+    UpstreamScheduler,
+    QueuedRequest,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NORMAL,
+    PRIORITY_BULK
+)
+
+
+class UpstreamLease:
+    """一次上游调用占用的并发槽位和TPM预算"""
+
+    __slots__ = ("governor", "tokens", "kind", "started", "released")
+
+    def __init__(self, governor: "UpstreamGovernor", tokens: int, kind: Any):
+        self.governor = governor
+        self.tokens = tokens
+        self.kind = kind
+        self.started = time.monotonic()
+        self.released = False
+
+    def succeeded(self, used_tokens: Optional[int] = None):
+        """
+        记录上游已正常响应（流式请求为收到响应头）
+
+        参数:
+        - used_tokens: 服务商返回的实际token用量，用于修正TPM预算
+        """
+        self.governor._on_success(self, time.monotonic() - self.started, used_tokens)
+
+    def throttled(self, retry_after: Optional[float] = None):
+        """记录上游返回429"""
+        self.governor._on_throttled(retry_after)
+
+    def failed(self):
+        """记录上游超时、连接错误或5xx"""
+        self.governor._on_overload()
+
+    def release(self):
+        """归还并发槽位（可重复调用）"""
+        if not self.released:
+            self.released = True
+            self.governor._release()
+
+
+class UpstreamGovernor:
+    """AIMD并发与TPM控制器，所有上游调用共享一个实例"""
+
+    def __init__(
+        self,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        tokens_per_minute: int = 0,
+        latency_tolerance: float = 2.0,
+        bulk_share: float = 0.75,
+        scheduler: Optional[UpstreamScheduler] = None
+    ):
+        """
+        初始化上游并发控制器
+
+        参数:
+        - initial_limit: 初始并发上限
+        - min_limit: 最小并发上限
+        - max_limit: 最大并发上限
+        - tokens_per_minute: 每分钟token预算，0表示不限制
+        - latency_tolerance: 延迟超过基准延迟的倍数时视为过载
+        - bulk_share: 批量改写请求最多占用的槽位比例，其余留给行内补全和对话
+        - scheduler: 排队调度器
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tokens_per_minute = tokens_per_minute
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.throttled_count = 0
+        self.scheduler = scheduler or UpstreamScheduler()
+        # 各等级可占用的槽位比例
+        self.class_shares = {
+            PRIORITY_INTERACTIVE: 1.0,
+            PRIORITY_NORMAL: 1.0,
+            PRIORITY_BULK: bulk_share
+        }
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._wake_handle: Optional[asyncio.TimerHandle] = None
+
+        # 各类请求的基准延迟（缓慢上浮的最小值）
+        self._baseline: Dict[Any, float] = {}
+
+        # TPM令牌桶
+        self._tpm_tokens = float(tokens_per_minute)
+        self._tpm_updated = time.monotonic()
+
+    async def acquire(
+        self,
+        priority: int = PRIORITY_NORMAL,
+        tokens: int = 0,
+        kind: Any = None,
+        user_key: str = "anonymous",
+        supersede_key: Optional[str] = None
+    ) -> UpstreamLease:
+        """
+        获取一个上游并发槽位，必要时交给调度器排队等待
+
+        参数:
+        - priority: 请求的延迟等级
+        - tokens: 预估的token消耗（提示词 + 最大生成长度）
+        - kind: 请求类别，同类请求共享基准延迟
+        - user_key: 用户标识，同一等级内按用户公平排队
+        - supersede_key: 取代键，行内补全排队时被同一取代键的新请求取代（只用于单个编辑会话）
+
+        返回:
+        - 槽位租约，调用结束后必须 release()
+
+        异常:
+        - UpstreamRequestDropped: 请求在排队期间过期或被取代
+        """
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        now = time.monotonic()
+        if self.scheduler.peek(now) is None and self._can_dispatch(priority, tokens, now):
+            return self._grant(tokens, kind)
+
+        request = QueuedRequest(
+            priority,
+            user_key,
+            tokens,
+            kind,
+            asyncio.get_running_loop().create_future(),
+            self.scheduler.deadline_for(priority, now),
+            supersede_key
+        )
+        self.scheduler.push(request)
+        self._dispatch()
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled() and request.future.exception() is None:
+                # 槽位已分配但等待方被取消
+                request.future.result().release()
+            raise
+
+    def _slot_cap(self, priority: int) -> int:
+        """某一等级可以占用的槽位数，低等级为行内补全预留余量"""
+        return max(1, int(int(self.limit) * self.class_shares.get(priority, 1.0)))
+
+    def _can_dispatch(self, priority: int, tokens: int, now: float) -> bool:
+        if now < self._paused_until or self.in_flight >= self._slot_cap(priority):
+            return False
+        if self.tokens_per_minute:
+            self._refill(now)
+            return self._tpm_tokens >= tokens
+        return True
+
+    def _refill(self, now: float):
+        elapsed = now - self._tpm_updated
+        self._tpm_updated = now
+        self._tpm_tokens = min(
+            float(self.tokens_per_minute),
+            self._tpm_tokens + elapsed * self.tokens_per_minute / 60.0
+        )
+
+    def _grant(self, tokens: int, kind: Any) -> UpstreamLease:
+        self.in_flight += 1
+        if self.tokens_per_minute:
+            self._tpm_tokens -= tokens
+        return UpstreamLease(self, tokens, kind)
+
+    def _dispatch(self):
+        """按调度器给出的顺序为排队的请求分配槽位"""
+        now = time.monotonic()
+        self.scheduler.expire(now)
+        while True:
+            request = self.scheduler.peek(now)
+            if request is None or not self._can_dispatch(request.priority, request.tokens, now):
+                break
+            self.scheduler.pop()
+            request.future.set_result(self._grant(request.tokens, request.kind))
+
+        if request is None:
+            return
+
+        wake_at = self.scheduler.next_deadline()
+        if self.in_flight < self._slot_cap(request.priority):
+            # 队首因暂停或TPM预算不足而等待，到期后重新派发
+            delay = max(0.0, self._paused_until - now)
+            if self.tokens_per_minute and now >= self._paused_until:
+                delay = max(delay, (request.tokens - self._tpm_tokens) * 60.0 / self.tokens_per_minute)
+            wake_at = now + delay if wake_at is None else min(wake_at, now + delay)
+        if wake_at is not None:
+            self._schedule_wake(max(0.0, wake_at - now))
+
+    def _schedule_wake(self, delay: float):
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        self._wake_handle = asyncio.get_running_loop().call_later(delay + 0.001, self._dispatch)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _on_success(self, lease: UpstreamLease, latency: float, used_tokens: Optional[int]):
+        if used_tokens is not None and self.tokens_per_minute:
+            # 用实际用量修正预估
+            self._tpm_tokens += lease.tokens - used_tokens
+            lease.tokens = used_tokens
+
+        baseline = self._baseline.get(lease.kind)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            baseline += 0.02 * (latency - baseline)
+        self._baseline[lease.kind] = baseline
+
+        if latency > baseline * self.latency_tolerance:
+            self._decrease(0.9, "latency")
+        elif self.in_flight >= int(self.limit) - 1:
+            # 只有在槽位接近用满时才继续提高上限
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._dispatch()
+
+    def _on_throttled(self, retry_after: Optional[float]):
+        self.throttled_count += 1
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + (retry_after if retry_after else 1.0))
+        self._decrease(0.5, "throttled")
+        if self.tokens_per_minute:
+            self._tpm_tokens = min(self._tpm_tokens, 0.0)
+
+    def _on_overload(self):
+        self._decrease(0.9, "error")
+
+    def _decrease(self, factor: float, reason: str):
+        """降低并发上限；同一批在途请求连续失败时只降低一次"""
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        logger.warning({
+            "message": "降低上游并发上限",
+            "reason": reason,
+            "previous_limit": round(previous, 2),
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self.scheduler)
+        })
+    
+    def saturated(self) -> bool:
+        """上游是否处于高负载：槽位已用满或有请求在排队"""
+        return self.in_flight >= int(self.limit) or self.scheduler.peek(time.monotonic()) is not None
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取控制器当前状态
+
+        返回:
+        - 包含并发上限、在途请求数、排队数等信息的字典
+        """
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            self._refill(now)
+        return {
+            "limit": int(self.limit),
+            "limit_estimate": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.scheduler.queued_by_class(),
+            "dropped_total": self.scheduler.dropped_count,
+            "paused_seconds": round(max(0.0, self._paused_until - now), 3),
+            "tokens_per_minute": self.tokens_per_minute,
+            "tpm_available": round(self._tpm_tokens) if self.tokens_per_minute else None,
+            "throttled_total": self.throttled_count
+        }
+
+
+class GovernedStream:
+    """包装上游流式响应，流结束或关闭时归还并发槽位"""
+
+    def __init__(self, stream: Any, lease: UpstreamLease):
+        self._stream = stream
+        self._lease = lease
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            self._lease.release()
+
+    async def close(self):
+        self._lease.release()
+        await self._stream.close()
@@ -0,0 +1,325 @@
+"""
+上游端点池
+管理多个OpenAI兼容的上游端点，按健康状况和延迟（EWMA或最少在途请求）选择端点，
+并可对延迟敏感的流式补全发起对冲请求：首个token超过观测到的p90仍未到达时向另一个端点发送相同请求，
+先返回首个token的一方胜出，另一方被取消
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import openai
+
+from app.core.logger import logger
+
+
+def _has_content(chunk: Any) -> bool:
+    """流式分块是否包含生成的文本"""
+    choices = getattr(chunk, "choices", None)
+    if not choices:
+        return False
+    delta = getattr(choices[0], "delta", None)
+    return bool(getattr(delta, "content", None))
+
+
+class UpstreamEndpoint:
+    """单个上游端点及其健康和延迟统计"""
+
+    __slots__ = ("name", "client", "outstanding", "latency", "failures", "cooldown_until")
+
+    def __init__(self, name: str, client: Any):
+        self.name = name
+        self.client = client
+        self.outstanding = 0
+        self.latency: Optional[float] = None  # 延迟的指数加权平均（秒）
+        self.failures = 0                     # 连续失败次数
+        self.cooldown_until = 0.0             # 在此之前不参与路由
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+
+class EndpointStream:
+    """某个端点上的流式响应，记录首个token延迟，结束或关闭时归还端点的在途计数"""
+
+    def __init__(self, pool: "UpstreamPool", endpoint: UpstreamEndpoint, stream: Any, started: float):
+        self.endpoint = endpoint
+        self._pool = pool
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._started = started
+        self._buffered: List[Any] = []
+        self._first_token = False
+        self._finished = False
+
+    async def _next(self) -> Any:
+        chunk = await self._iterator.__anext__()
+        if not self._first_token and _has_content(chunk):
+            self._first_token = True
+            self._pool._observe(self.endpoint, time.monotonic() - self._started, first_token=True)
+        return chunk
+
+    async def prime(self):
+        """预读到第一个包含文本的分块（或流结束）为止"""
+        while not self._first_token:
+            try:
+                self._buffered.append(await self._next())
+            except StopAsyncIteration:
+                return
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        try:
+            while self._buffered:
+                yield self._buffered.pop(0)
+            while True:
+                try:
+                    chunk = await self._next()
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self._pool._end(self.endpoint)
+
+    async def close(self):
+        self._finish()
+        await self._stream.close()
+
+
+class UpstreamPool:
+    """上游端点池，负责端点选择、健康摘除和对冲请求"""
+
+    def __init__(
+        self,
+        endpoints: List[UpstreamEndpoint],
+        policy: str = "ewma",
+        hedge_ratio: float = 0.1,
+        hedge_min_delay: float = 0.1,
+        failure_cooldown: float = 5.0
+    ):
+        """
+        初始化上游端点池
+
+        参数:
+        - endpoints: 上游端点列表
+        - policy: 路由策略，ewma（延迟加权）或 least_outstanding（最少在途请求）
+        - hedge_ratio: 对冲请求占可对冲请求的最大比例
+        - hedge_min_delay: 发起对冲前的最短等待时间（秒）
+        - failure_cooldown: 端点连续失败时的基础摘除时间（秒），随连续失败次数加倍
+        """
+        if not endpoints:
+            raise ValueError("至少需要一个上游端点")
+        self.endpoints = endpoints
+        self.policy = policy
+        self.hedge_ratio = hedge_ratio
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_cooldown = failure_cooldown
+        self.hedge_eligible = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # 最近的首个token延迟样本，用于计算对冲等待时间
+        self._first_token_samples = deque(maxlen=200)
+
+    def pick(self, exclude: Optional[UpstreamEndpoint] = None) -> Optional[UpstreamEndpoint]:
+        """
+        选择一个端点
+
+        参数:
+        - exclude: 需要排除的端点（对冲请求不能发往同一端点）
+
+        返回:
+        - 选中的端点；排除后没有可用端点时返回None
+        """
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint is not exclude]
+        if not candidates:
+            return None
+        healthy = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not healthy:
+            if exclude is not None:
+                return None
+            # 全部端点都在摘除期时选择最早恢复的端点
+            return min(candidates, key=lambda endpoint: endpoint.cooldown_until)
+
+        if self.policy == "least_outstanding":
+            return min(healthy, key=lambda endpoint: (endpoint.outstanding, endpoint.latency or 0.0))
+        # 延迟加权：没有延迟数据的端点优先被探测
+        return min(healthy, key=lambda endpoint: (endpoint.latency or 0.0) * (endpoint.outstanding + 1))
+
+    def healthy_count(self) -> int:
+        """当前未被摘除的端点数"""
+        now = time.monotonic()
+        return sum(1 for endpoint in self.endpoints if endpoint.available(now))
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        对冲等待时间：最近首个token延迟的p90
+
+        返回:
+        - 等待秒数；样本不足时返回None（不对冲）
+        """
+        if len(self._first_token_samples) < 20:
+            return None
+        samples = sorted(self._first_token_samples)
+        return max(self.hedge_min_delay, samples[int(len(samples) * 0.9) - 1])
+
+    async def create(self, hedge: bool = False, **kwargs):
+        """
+        发送chat.completions请求
+
+        参数:
+        - hedge: 是否允许对冲（仅对流式请求有效）
+        - kwargs: chat.completions.create 的参数
+
+        返回:
+        - 非流式时返回响应对象；流式时返回 EndpointStream
+        """
+        if hedge and kwargs.get("stream") and len(self.endpoints) > 1:
+            return await self._create_hedged(kwargs)
+        return await self._open(self.pick(), kwargs)
+
+    async def _open(self, endpoint: UpstreamEndpoint, kwargs: Dict[str, Any], prime: bool = False):
+        """在指定端点上发送请求并记录结果"""
+        started = time.monotonic()
+        endpoint.outstanding += 1
+        try:
+            response = await endpoint.client.chat.completions.create(**kwargs)
+        except BaseException as e:
+            self._end(endpoint)
+            self._record_error(endpoint, e)
+            raise
+
+        if not kwargs.get("stream"):
+            self._end(endpoint)
+            self._observe(endpoint, time.monotonic() - started)
+            return response
+
+        stream = EndpointStream(self, endpoint, response, started)
+        if prime:
+            try:
+                await stream.prime()
+            except BaseException as e:
+                await stream.close()
+                self._record_error(endpoint, e)
+                raise
+        return stream
+
+    async def _create_hedged(self, kwargs: Dict[str, Any]) -> EndpointStream:
+        """发送可对冲的流式请求，返回先收到首个token的流"""
+        self.hedge_eligible += 1
+        primary = self.pick()
+        tasks = {asyncio.create_task(self._open(primary, kwargs, prime=True)): primary}
+        # 各请求的发送时间，用于计算被取消一方的等待时间
+        started = {task: time.monotonic() for task in tasks}
+
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                secondary = None if done else self.pick(exclude=primary)
+                if secondary is not None and self.hedged < self.hedge_ratio * self.hedge_eligible + 1:
+                    self.hedged += 1
+                    task = asyncio.create_task(self._open(secondary, kwargs, prime=True))
+                    tasks[task] = secondary
+                    started[task] = time.monotonic()
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is None:
+                    error = next(iter(done)).exception()
+                    continue
+
+                for task in done:
+                    if task is not winner and task.exception() is None:
+                        await task.result().close()
+                for task in pending:
+                    task.cancel()
+                    self._observe_cancelled(tasks[task], time.monotonic() - started[task])
+                if len(tasks) > 1:
+                    self.hedge_wins += tasks[winner] is not primary
+                    logger.info({
+                        "message": "对冲请求完成",
+                        "winner": tasks[winner].name,
+                        "primary": primary.name,
+                        "hedge_delay": delay
+                    })
+                return winner.result()
+            raise error
+        except BaseException:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            raise
+
+    def _end(self, endpoint: UpstreamEndpoint):
+        endpoint.outstanding -= 1
+
+    def _observe(self, endpoint: UpstreamEndpoint, latency: float, first_token: bool = False):
+        endpoint.failures = 0
+        endpoint.latency = latency if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * latency
+        if first_token:
+            self._first_token_samples.append(latency)
+
+    def _observe_cancelled(self, endpoint: UpstreamEndpoint, waited: float):
+        """
+        记录对冲中被取消一方的等待时间
+
+        该端点没有返回结果，等待时间只是延迟的下限：只在超过当前估计时调高延迟，
+        不计入首个token样本（避免抬高对冲等待时间），也不重置连续失败次数
+        """
+        if endpoint.latency is None:
+            endpoint.latency = waited
+        elif waited > endpoint.latency:
+            endpoint.latency = 0.8 * endpoint.latency + 0.2 * waited
+
+    def _record_error(self, endpoint: UpstreamEndpoint, error: BaseException):
+        """根据错误类型摘除端点"""
+        if isinstance(error, openai.RateLimitError):
+            cooldown = self.failure_cooldown
+        elif isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+            endpoint.failures += 1
+            cooldown = self.failure_cooldown * 2 ** min(endpoint.failures - 1, 5)
+        else:
+            return
+        endpoint.cooldown_until = time.monotonic() + cooldown
+        logger.warning({
+            "message": "上游端点暂时摘除",
+            "endpoint": endpoint.name,
+            "error_type": type(error).__name__,
+            "cooldown_seconds": cooldown
+        })
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        获取端点池当前状态
+
+        返回:
+        - 各端点的在途请求数、延迟和健康状况，以及对冲统计
+        """
+        now = time.monotonic()
+        return {
+            "policy": self.policy,
+            "endpoints": [
+                {
+                    "name": endpoint.name,
+                    "outstanding": endpoint.outstanding,
+                    "latency_ms": round(endpoint.latency * 1000) if endpoint.latency is not None else None,
+                    "healthy": endpoint.available(now)
+                }
+                for endpoint in self.endpoints
+            ],
+            "hedge_delay_ms": round(self.hedge_delay() * 1000) if self.hedge_delay() is not None else None,
+            "hedged_total": self.hedged,
+            "hedge_wins": self.hedge_wins
+        }
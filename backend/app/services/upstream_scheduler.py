@@ -0,0 +1,211 @@
+"""
+上游请求调度服务
+按延迟等级将等待上游槽位的请求分队：
+- 等级之间严格按优先级服务，行内补全总是排在批量改写之前
+- 同一等级内按用户做加权公平排队（WFQ），一个用户的长文翻译不会挤占其他用户
+- 行内补全请求在队列中等待过久，或被同一编辑会话（WebSocket连接）的新补全请求取代时直接丢弃；
+  用户标识只用于公平排队，同一IP下的多个标签页或用户不会互相取代
+"""
+import asyncio
+import heapq
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+
+# 延迟等级（数值越小越优先）
+PRIORITY_INTERACTIVE = 0  # 行内补全等需要即时响应的请求
+PRIORITY_NORMAL = 1       # 对话、学术结构等
+PRIORITY_BULK = 2         # 扩写、翻译等批量改写
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_NORMAL: "normal",
+    PRIORITY_BULK: "bulk"
+}
+
+
+class UpstreamRequestDropped(Exception):
+    """请求在排队期间被丢弃（等待过久或已被新的请求取代）"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"上游请求已被丢弃: {reason}")
+        self.reason = reason
+
+
+class QueuedRequest:
+    """排队等待上游槽位的请求"""
+
+    __slots__ = ("priority", "user_key", "tokens", "kind", "future", "deadline", "start_tag", "supersede_key")
+
+    def __init__(
+        self,
+        priority: int,
+        user_key: str,
+        tokens: int,
+        kind: Any,
+        future: asyncio.Future,
+        deadline: Optional[float],
+        supersede_key: Optional[str] = None
+    ):
+        self.priority = priority
+        self.user_key = user_key
+        self.tokens = tokens
+        self.kind = kind
+        self.future = future
+        self.deadline = deadline
+        self.start_tag = 0.0
+        # 取代键：同一取代键下新的行内补全请求会丢弃排队中的旧请求，为空时不会被取代
+        self.supersede_key = supersede_key
+
+    def drop(self, reason: str):
+        if not self.future.done():
+            self.future.set_exception(UpstreamRequestDropped(reason))
+
+
+class _ClassQueue:
+    """单个延迟等级内按用户加权公平排队的队列"""
+
+    __slots__ = ("heap", "virtual_time", "finish_tags", "queued_per_user")
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, QueuedRequest]] = []
+        self.virtual_time = 0.0
+        # 每个用户最后一个请求的虚拟完成时间
+        self.finish_tags: Dict[str, float] = {}
+        self.queued_per_user: Dict[str, int] = {}
+
+
+class UpstreamScheduler:
+    """按延迟等级和用户公平性排列等待上游槽位的请求"""
+
+    def __init__(
+        self,
+        stale_after: Optional[Dict[int, float]] = None,
+        user_weights: Optional[Dict[str, float]] = None
+    ):
+        """
+        初始化调度器
+
+        参数:
+        - stale_after: 各等级请求的最长排队时间（秒），超过后丢弃；未配置的等级不丢弃
+        - user_weights: 用户权重，权重越大分到的份额越多（默认1）
+        """
+        self.stale_after = stale_after if stale_after is not None else {PRIORITY_INTERACTIVE: 2.0}
+        self.user_weights = user_weights or {}
+        self._queues = {priority: _ClassQueue() for priority in PRIORITY_NAMES}
+        self._seq = itertools.count()
+        # 每个取代键排队中的行内补全请求，同一会话的新请求到来时旧请求已经没有意义
+        self._interactive: Dict[str, QueuedRequest] = {}
+        self.dropped_count = 0
+
+    def push(self, request: QueuedRequest):
+        """
+        请求入队
+
+        参数:
+        - request: 排队请求
+        """
+        if request.priority == PRIORITY_INTERACTIVE and request.supersede_key is not None:
+            previous = self._interactive.get(request.supersede_key)
+            if previous is not None and not previous.future.done():
+                self._drop(previous, "superseded")
+                # 被取代的请求不再占用该用户的份额
+                queue = self._queues[PRIORITY_INTERACTIVE]
+                queue.finish_tags[previous.user_key] = previous.start_tag
+            self._interactive[request.supersede_key] = request
+
+        queue = self._queues.get(request.priority) or self._queues[PRIORITY_NORMAL]
+        weight = self.user_weights.get(request.user_key, 1.0)
+        request.start_tag = max(queue.virtual_time, queue.finish_tags.get(request.user_key, 0.0))
+        finish_tag = request.start_tag + max(1, request.tokens) / weight
+        queue.finish_tags[request.user_key] = finish_tag
+        queue.queued_per_user[request.user_key] = queue.queued_per_user.get(request.user_key, 0) + 1
+        heapq.heappush(queue.heap, (finish_tag, next(self._seq), request))
+
+    def peek(self, now: float) -> Optional[QueuedRequest]:
+        """
+        获取下一个应被派发的请求（不出队），顺带清理已取消和已过期的请求
+
+        返回:
+        - 最高等级中虚拟完成时间最小的请求，队列为空时返回None
+        """
+        for queue in self._queues.values():
+            while queue.heap:
+                request = queue.heap[0][2]
+                if request.future.done():
+                    self._remove_head(queue)
+                    continue
+                if request.deadline is not None and now > request.deadline:
+                    self._drop(request, "stale")
+                    self._remove_head(queue)
+                    continue
+                return request
+        return None
+
+    def pop(self) -> QueuedRequest:
+        """取出 peek() 返回的请求"""
+        for queue in self._queues.values():
+            if queue.heap:
+                request = self._remove_head(queue)
+                queue.virtual_time = max(queue.virtual_time, request.start_tag)
+                if len(queue.finish_tags) > 1024:
+                    # 完成时间已落后于虚拟时间的用户与新用户等价，可以清除
+                    queue.finish_tags = {
+                        user_key: tag for user_key, tag in queue.finish_tags.items()
+                        if tag > queue.virtual_time or user_key in queue.queued_per_user
+                    }
+                return request
+        raise IndexError("调度队列为空")
+
+    def _remove_head(self, queue: _ClassQueue) -> QueuedRequest:
+        request = heapq.heappop(queue.heap)[2]
+        user_key = request.user_key
+        remaining = queue.queued_per_user.get(user_key, 1) - 1
+        if remaining > 0:
+            queue.queued_per_user[user_key] = remaining
+        else:
+            queue.queued_per_user.pop(user_key, None)
+        if request.supersede_key is not None and self._interactive.get(request.supersede_key) is request:
+            del self._interactive[request.supersede_key]
+        return request
+
+    def _drop(self, request: QueuedRequest, reason: str):
+        self.dropped_count += 1
+        request.drop(reason)
+
+    def expire(self, now: float):
+        """丢弃所有已超过排队期限的请求（出队在到达队首时进行）"""
+        for priority in self.stale_after:
+            queue = self._queues.get(priority)
+            if queue is None:
+                continue
+            for _, _, request in queue.heap:
+                if request.deadline is not None and now > request.deadline and not request.future.done():
+                    self._drop(request, "stale")
+
+    def deadline_for(self, priority: int, now: float) -> Optional[float]:
+        """计算新入队请求的丢弃期限"""
+        stale_after = self.stale_after.get(priority)
+        return now + stale_after if stale_after is not None else None
+
+    def next_deadline(self) -> Optional[float]:
+        """排队请求中最早的丢弃期限"""
+        deadlines = []
+        for priority, queue in self._queues.items():
+            if priority in self.stale_after:
+                deadlines.extend(
+                    request.deadline for _, _, request in queue.heap
+                    if request.deadline is not None and not request.future.done()
+                )
+        return min(deadlines) if deadlines else None
+
+    def __len__(self) -> int:
+        return sum(
+            1 for queue in self._queues.values() for _, _, request in queue.heap if not request.future.done()
+        )
+
+    def queued_by_class(self) -> Dict[str, int]:
+        """各等级排队中的请求数"""
+        return {
+            PRIORITY_NAMES[priority]: sum(1 for _, _, request in queue.heap if not request.future.done())
+            for priority, queue in self._queues.items()
+        }
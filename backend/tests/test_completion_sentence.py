@@ -0,0 +1,28 @@
+"""补全在第一个句号处结束，不依赖上游的 finish_reason 猜测句号是否被截掉"""
+import pytest
+
+pytest.importorskip("openai")
+
+from app.services.openai_service import COMPLETION_STOP_SEQUENCES, OpenAIService  # noqa: E402
+
+
+def test_full_stop_is_not_a_stop_sequence():
+    for stops in COMPLETION_STOP_SEQUENCES.values():
+        assert "。" not in stops
+
+
+def test_natural_end_is_left_unchanged():
+    # 自然结束（EOS）时不补句号
+    assert OpenAIService.end_at_first_sentence("数据库连接池，", "technical") == "数据库连接池，"
+    assert OpenAIService.end_at_first_sentence("the connection pool", "general") == "the connection pool"
+
+
+def test_paragraph_stop_is_left_unchanged():
+    # 命中 "\n\n" 停止时返回的文本不含停止序列，同样不补句号
+    assert OpenAIService.end_at_first_sentence("第一段没有句号", "general") == "第一段没有句号"
+
+
+def test_cut_after_first_full_stop():
+    text = "连接池会复用连接。之后的句子不再保留。"
+    assert OpenAIService.end_at_first_sentence(text, "technical") == "连接池会复用连接。"
+    assert OpenAIService.end_at_first_sentence(text, "academic") == text
@@ -0,0 +1,41 @@
+"""文档会话的片段表编辑（偏移按UTF-16码元计算）"""
+import pytest
+
+from app.services.document_session import DocumentSession, DocumentSyncError, PieceTable
+
+
+def test_offsets_are_utf16_code_units():
+    # 浏览器中 "a😀b".length 为4，emoji占两个码元
+    table = PieceTable("a😀b")
+    assert table.utf16_length == 4
+
+    table.insert(3, "c")
+    assert table.text() == "a😀cb"
+
+    table.delete(1, 2)
+    assert table.text() == "acb"
+    assert len(table) == 3
+
+
+def test_edits_after_inserted_astral_text():
+    table = PieceTable("开头结尾")
+    table.insert(2, "𠀀😀")
+    table.insert(6, "中间")
+    assert table.text() == "开头𠀀😀中间结尾"
+
+    table.delete(4, 2)
+    assert table.text() == "开头𠀀中间结尾"
+    assert table.utf16_length == 8
+
+
+def test_position_inside_surrogate_pair_is_rejected():
+    table = PieceTable("a😀b")
+    with pytest.raises(IndexError):
+        table.insert(2, "x")
+
+
+def test_invalid_offset_requires_resync():
+    session = DocumentSession("doc", "😀", version=1)
+    with pytest.raises(DocumentSyncError):
+        session.apply_ops([{"op": "delete", "pos": 1, "length": 1}], base_version=1)
+    assert session.version == -1
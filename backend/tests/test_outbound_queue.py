@@ -0,0 +1,38 @@
+"""WebSocket发送队列：积压时丢弃的token改为resync消息"""
+import pytest
+
+pytest.importorskip("fastapi")
+
+from app.api.endpoints.websocket import OutboundQueue  # noqa: E402
+
+
+def token(text, request_id="r1"):
+    return {"type": "token", "token": text, "request_id": request_id, "action": "completion"}
+
+
+def test_dropped_tokens_become_resync_with_full_text():
+    queue = OutboundQueue()
+    queue.put(token("a" * 100), batch_max_chars=10_000)
+    queue.put({"type": "system", "message": "x"}, batch_max_chars=10_000)
+    queue.put(token("b" * 100), batch_max_chars=10_000)
+
+    assert queue.drop_tokens(max_chars=80) == 2
+    queue.put(token("c"), batch_max_chars=10_000)
+
+    frames = queue.drain()
+    assert [frame["type"] for frame in frames] == ["resync", "system"]
+    assert frames[0]["text"] == "a" * 100 + "b" * 100 + "c"
+
+    # 重新同步之后的token照常发送
+    queue.put(token("d"), batch_max_chars=10_000)
+    assert queue.drain() == [token("d")]
+
+
+def test_finish_fills_pending_resync_and_releases_text():
+    queue = OutboundQueue()
+    queue.put(token("a" * 100), batch_max_chars=10_000)
+    queue.drop_tokens(max_chars=10)
+    queue.finish("r1")
+
+    assert not queue.streams
+    assert queue.drain()[0]["text"] == "a" * 100
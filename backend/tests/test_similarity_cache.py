@@ -0,0 +1,46 @@
+"""近似重复请求缓存的匹配规则"""
+from app.services.similarity_cache import SimilarityCache
+
+
+def make_cache() -> SimilarityCache:
+    return SimilarityCache(threshold=0.75)
+
+
+def test_synonym_rewording_hits():
+    cache = make_cache()
+    cache.add("outline", "人工智能在医疗中的应用", ["cached"])
+
+    result = cache.lookup("outline", "AI在医疗领域的应用")
+
+    assert result is not None
+    assert result[0] == ["cached"]
+
+
+def test_changed_content_word_misses():
+    cache = make_cache()
+    cache.add("outline", "请介绍一下Python语言的优点", ["advantages"])
+
+    assert cache.lookup("outline", "请介绍一下Python语言的缺点") is None
+
+
+def test_added_word_misses():
+    cache = make_cache()
+    cache.add("outline", "人工智能在医疗中的应用", ["cached"])
+
+    assert cache.lookup("outline", "人工智能在医疗教育中的应用") is None
+
+
+def test_scopes_are_isolated():
+    cache = make_cache()
+    cache.add("outline:science", "人工智能在医疗中的应用", ["cached"])
+
+    assert cache.lookup("outline:humanities", "人工智能在医疗中的应用") is None
+
+
+def test_exact_lookup_ignores_only_formatting():
+    cache = make_cache()
+    cache.add("chat", "请介绍一下Python语言的优点", "answer")
+
+    assert cache.lookup("chat", "请介绍一下 python 语言的优点？", exact=True) is not None
+    assert cache.lookup("chat", "介绍一下Python语言的优点", exact=True) is None
+    assert cache.lookup("chat", "请介绍一下Python语言的缺点", exact=True) is None
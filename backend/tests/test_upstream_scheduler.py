@@ -0,0 +1,40 @@
+"""上游调度器：行内补全只被同一编辑会话的新请求取代"""
+import asyncio
+
+from app.services.upstream_scheduler import PRIORITY_INTERACTIVE, QueuedRequest, UpstreamScheduler
+
+
+def queued(loop, user_key, supersede_key=None):
+    return QueuedRequest(PRIORITY_INTERACTIVE, user_key, 10, None, loop.create_future(), None, supersede_key)
+
+
+def test_same_user_key_without_session_is_not_superseded():
+    loop = asyncio.new_event_loop()
+    try:
+        scheduler = UpstreamScheduler()
+        first, second = queued(loop, "10.0.0.1"), queued(loop, "10.0.0.1")
+        scheduler.push(first)
+        scheduler.push(second)
+
+        assert not first.future.done()
+        assert len(scheduler) == 2
+    finally:
+        loop.close()
+
+
+def test_same_session_supersedes_queued_request():
+    loop = asyncio.new_event_loop()
+    try:
+        scheduler = UpstreamScheduler()
+        first = queued(loop, "conn_1", "conn_1")
+        second = queued(loop, "conn_1", "conn_1")
+        other = queued(loop, "conn_2", "conn_2")
+        for request in (first, other, second):
+            scheduler.push(request)
+
+        assert first.future.done()
+        assert first.future.exception().reason == "superseded"
+        assert not other.future.done()
+        assert len(scheduler) == 2
+    finally:
+        loop.close()
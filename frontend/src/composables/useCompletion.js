@@ -168,6 +168,10 @@ export function useCompletion(options = {}) {
     } else if (data.type === 'token') {
       completionBuffer.value += data.token
       currentCompletion.value = completionBuffer.value
+    } else if (data.type === 'resync') {
+      // 服务端积压时丢弃了部分token，用已生成的全文替换
+      completionBuffer.value = data.text || ''
+      currentCompletion.value = completionBuffer.value
     } else if (data.type === 'end') {
       currentCompletion.value = data.completion || completionBuffer.value
       isGenerating.value = false
@@ -72,8 +72,8 @@ class WebSocketService {
 
         this._notifyListeners('message', data);
 
-        // 处理补全消息（包括错误消息）
-        if (data.type === 'token' || data.type === 'start' || data.type === 'end' || data.type === 'error') {
+        // 处理补全消息（包括错误消息和积压后重新同步全文的resync消息）
+        if (data.type === 'token' || data.type === 'resync' || data.type === 'start' || data.type === 'end' || data.type === 'error') {
           this._notifyListeners('completion', data);
         }
       };
@@ -305,6 +305,43 @@ class WebSocketService {
       temperature: 0.5
     });
   }
+  
+  /**
+   * 请求AI聊天回复（流式返回）
+   * @param {string} message - 用户消息
+   * @param {string} conversationId - 服务端对话ID，首次请求为空
+   * @param {string} context - 当前文档上下文
+   * @param {string} requestId - 请求ID，可用于取消
+   * @param {Array} history - 创建服务端对话时使用的初始历史（已有对话ID时忽略）
+   */
+  requestChat(message, conversationId = null, context = null, requestId = null, history = null) {
+    return this.send({
+      action: 'chat',
+      message,
+      conversation_id: conversationId,
+      context,
+      request_id: requestId,
+      conversation_history: conversationId ? null : history
+    });
+  }
+
+  /**
+   * 取消正在生成的请求（不受请求限流影响）
+   * @param {string} requestId - 请求ID，为空时取消该连接的全部请求
+   */
+  cancelRequest(requestId = null) {
+    if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+      return false;
+    }
+
+    try {
+      this.ws.send(JSON.stringify({ type: 'cancel', request_id: requestId }));
+      return true;
+    } catch (error) {
+      console.error('发送取消请求失败:', error);
+      return false;
+    }
+  }
 }
 
 export default WebSocketService;
\ No newline at end of file